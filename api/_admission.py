@@ -0,0 +1,155 @@
+"""
+Admission control for the chatbot's upstream calls
+Token buckets sized to the OpenAI request and token quotas, per-client buckets,
+and a bounded wait queue: a request that would have to wait too long, or find
+the queue full, is shed right away with Retry-After instead of piling onto a
+rate-limited upstream
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Defaults, overridable through environment variables - set the first two to
+# the account's OpenAI limits for the model
+UPSTREAM_RPM = float(os.environ.get('CHAT_UPSTREAM_RPM', '500'))
+UPSTREAM_TPM = float(os.environ.get('CHAT_UPSTREAM_TPM', '200000'))
+# Seconds of quota that may be spent in one burst
+BURST_SECONDS = float(os.environ.get('CHAT_ADMISSION_BURST', '10'))
+CLIENT_RPM = float(os.environ.get('CHAT_CLIENT_RPM', '20'))
+CLIENT_BURST = float(os.environ.get('CHAT_CLIENT_BURST', '5'))
+MAX_QUEUE = int(os.environ.get('CHAT_ADMISSION_QUEUE', '32'))
+MAX_WAIT_SECONDS = float(os.environ.get('CHAT_ADMISSION_MAX_WAIT', '5'))
+ADMISSION_ENABLED = os.environ.get('CHAT_ADMISSION', '1') not in ('0', 'false', 'no')
+
+# Client buckets kept at most; the least recently seen are dropped first
+MAX_CLIENTS = 10000
+
+
+class TokenBucket:
+    """Token bucket that may be drawn below zero, so waiters queue in arrival order
+
+    Not thread-safe on its own; AdmissionController holds the lock.
+    """
+
+    def __init__(self, per_minute, capacity):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount, now):
+        """Seconds until amount tokens are available"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount or self.rate <= 0:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class Rejected(Exception):
+    """The request was shed; status is 429 (this client) or 503 (everyone)"""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class AdmissionController:
+    """Decides whether an upstream call may start now, after a short wait, or not at all"""
+
+    def __init__(self, rpm=UPSTREAM_RPM, tpm=UPSTREAM_TPM, burst_seconds=BURST_SECONDS,
+                 client_rpm=CLIENT_RPM, client_burst=CLIENT_BURST, max_queue=MAX_QUEUE,
+                 max_wait=MAX_WAIT_SECONDS, enabled=ADMISSION_ENABLED):
+        self.requests = TokenBucket(rpm, rpm / 60.0 * burst_seconds)
+        self.tokens = TokenBucket(tpm, tpm / 60.0 * burst_seconds)
+        self.client_rpm = client_rpm
+        self.client_burst = client_burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.enabled = enabled
+        self.waiting = 0
+        self.counts = {'admitted': 0, 'queued': 0, 'rejected_client': 0, 'rejected_overload': 0}
+        self._clients = OrderedDict()  # client -> TokenBucket
+        self._lock = threading.Lock()
+
+    def check_client(self, client):
+        """Charge one request to a client's bucket, or raise Rejected (429)"""
+        if not self.enabled or not client or self.client_rpm <= 0:
+            return
+        with self._lock:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                bucket = self._clients[client] = TokenBucket(self.client_rpm, self.client_burst)
+                while len(self._clients) > MAX_CLIENTS:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(client)
+            wait = bucket.wait_for(1, time.monotonic())
+            if wait > 0:
+                self.counts['rejected_client'] += 1
+                raise Rejected(429, wait, 'client')
+            bucket.take(1)
+
+    def admit(self, tokens, max_wait=None):
+        """Reserve one request and `tokens` from the upstream quota, waiting if needed
+
+        Blocks for at most max_wait (default: the controller's) and returns the
+        seconds spent waiting; raises Rejected (503) when the wait would be longer
+        or the queue is full.
+        """
+        if not self.enabled:
+            return 0.0
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.wait_for(1, now), self.tokens.wait_for(tokens, now))
+            if wait > 0 and (wait > max_wait or self.waiting >= self.max_queue):
+                self.counts['rejected_overload'] += 1
+                raise Rejected(503, wait, 'overload')
+            # Reserve now so later arrivals queue behind this request
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.counts['queued' if wait > 0 else 'admitted'] += 1
+            if wait > 0:
+                self.waiting += 1
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        return wait
+
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                'enabled': self.enabled,
+                'upstream_rpm': self.requests.rate * 60,
+                'upstream_tpm': self.tokens.rate * 60,
+                'requests_available': round(self.requests.tokens, 1),
+                'tokens_available': round(self.tokens.tokens),
+                'waiting': self.waiting,
+                'max_queue': self.max_queue,
+                'max_wait_seconds': self.max_wait,
+                'clients_tracked': len(self._clients),
+                **self.counts
+            }
@@ -0,0 +1,341 @@
+"""
+Compiled retrieval artifact for the chatbot
+knowledge-base.json compiled ahead of time into one versioned binary file
+(chunk texts, source tags, vocabulary, IDF weights and the TF-IDF matrix) that
+is opened zero-copy with numpy.memmap instead of being parsed, chunked and
+indexed on every cold start
+
+Usage:
+    python api/_artifact.py build [--dense]   # compile knowledge-base.json
+    python api/_artifact.py check             # exit 1 if the artifact is stale or corrupt
+    python api/_artifact.py info
+"""
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import struct
+import time
+from functools import lru_cache
+from typing import Any, Dict
+
+from _retrieval import MAX_FEATURES, TfidfBackend, build_vocabulary, tokenize
+
+MAGIC = b'KBIX'
+# Bump whenever the layout below changes; older artifacts are then rebuilt
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+# Below this many chunks the compiled matrix is scored with plain Python lists
+VECTORIZE_MIN_CHUNKS = 1000
+
+# Check section checksums on every load, not just in `check` (reads the whole file)
+VERIFY_ON_LOAD = os.environ.get('CHAT_ARTIFACT_VERIFY', '0') not in ('0', 'false', 'no')
+
+
+def artifact_path(kb_path):
+    """Where the artifact for a knowledge base file lives"""
+    root, _ = os.path.splitext(kb_path)
+    return root + '.idx'
+
+
+@lru_cache(maxsize=8)
+def builder_digest(*module_names):
+    """Hash of the code that shapes the artifact, so a chunker change also invalidates it
+
+    module_names: further modules whose whole source counts (e.g. '_chunking')
+    """
+    digest = hashlib.sha256(f'{FORMAT_VERSION}:{MAX_FEATURES}'.encode('utf-8'))
+    modules = tuple(importlib.import_module(name) for name in module_names)
+    for function in (tokenize, build_vocabulary, TfidfBackend) + modules:
+        try:
+            digest.update(inspect.getsource(function).encode('utf-8'))
+        except (OSError, TypeError):
+            digest.update(getattr(function, '__qualname__', repr(function)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ArtifactError(Exception):
+    """The artifact is missing, stale or unreadable"""
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_artifact(path, chunks, source_digest, build_digest, dense=False):
+    """Compile chunks into an artifact at path (written atomically)"""
+    import numpy as np
+
+    backend = TfidfBackend([chunk['text'] for chunk in chunks])
+    terms = sorted(backend.vocabulary, key=lambda term: backend.vocabulary[term])
+    idf = np.array([backend.idf[term] for term in terms], dtype=np.float64)
+
+    sections: Dict[str, Any] = {'idf': idf}
+    if dense:
+        matrix = np.zeros((len(chunks), len(terms)), dtype=np.float32)
+        for column, term in enumerate(terms):
+            for doc_id, weight in backend.postings[term]:
+                matrix[doc_id, column] = weight
+        sections['matrix'] = matrix
+    else:
+        # Term-major CSR (an inverted index): a query only touches its own terms' rows
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indices, data = [], []
+        for column, term in enumerate(terms):
+            postings = backend.postings[term]
+            indices.extend(doc_id for doc_id, _ in postings)
+            data.extend(weight for _, weight in postings)
+            indptr[column + 1] = indptr[column] + len(postings)
+        sections['indptr'] = indptr
+        sections['indices'] = np.array(indices, dtype=np.int32)
+        sections['data'] = np.array(data, dtype=np.float32)
+
+    encoded = [chunk['text'].encode('utf-8') for chunk in chunks]
+    text_offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    text_offsets[1:] = np.cumsum([len(text) for text in encoded])
+    sections['text_offsets'] = text_offsets
+    sections['texts'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    header = {
+        'format_version': FORMAT_VERSION,
+        'source_sha256': source_digest,
+        'builder_sha256': build_digest,
+        'backend': 'tfidf',
+        'layout': 'dense' if dense else 'csr',
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        # Everything but the text (parent links, fields, keywords) rides in the header
+        'chunks': [{k: v for k, v in chunk.items() if k != 'text'} for chunk in chunks],
+        'vocabulary': terms
+    }
+    return write_sections(path, header, sections)
+
+
+def write_sections(path, header, sections, magic=MAGIC, version=FORMAT_VERSION):
+    """Write a JSON header and 64-byte aligned numpy sections to path (atomically)
+
+    The same container holds the dense retrieval store (api/_embeddings.py)
+    under its own magic and version. Returns the header as written.
+    """
+    import numpy as np
+
+    header = dict(header, sections={})
+    # Section offsets depend on the header length, so lay them out from a
+    # generous estimate and pad the header to that size
+    payload = {name: np.ascontiguousarray(array).tobytes() for name, array in sections.items()}
+    for name, array in sections.items():
+        header['sections'][name] = {
+            'offset': 0, 'dtype': array.dtype.str, 'shape': list(array.shape),
+            'sha256': hashlib.sha256(payload[name]).hexdigest()
+        }
+    header_size = _align(12 + len(json.dumps(header)) + 64 * len(sections) + 64)
+    offset = header_size
+    for name in sections:
+        header['sections'][name]['offset'] = offset
+        offset = _align(offset + len(payload[name]))
+    header_bytes = json.dumps(header).encode('utf-8')
+    if 12 + len(header_bytes) > header_size:
+        raise ArtifactError('Artifact header does not fit its reserved space')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(magic + struct.pack('<II', version, len(header_bytes)) + header_bytes)
+        for name in sections:
+            f.seek(header['sections'][name]['offset'])
+            f.write(payload[name])
+        f.truncate(offset)
+    # Atomic swap so readers never see a half-written artifact
+    os.replace(tmp_path, path)
+    return header
+
+
+def read_header(path, magic=MAGIC, expected_version=FORMAT_VERSION):
+    """The artifact's JSON header, after checking magic and format version"""
+    try:
+        with open(path, 'rb') as f:
+            prefix = f.read(12)
+            if len(prefix) < 12 or prefix[:4] != magic:
+                raise ArtifactError(f'{path} is not a knowledge base artifact')
+            version, length = struct.unpack('<II', prefix[4:])
+            if version != expected_version:
+                raise ArtifactError(f'Artifact format {version}, expected {expected_version}')
+            return json.loads(f.read(length).decode('utf-8'))
+    except OSError as e:
+        raise ArtifactError(str(e))
+    except ValueError as e:
+        raise ArtifactError(f'Corrupt artifact header: {e}')
+
+
+class CompiledTfidfBackend(TfidfBackend):
+    """TF-IDF backend over memory-mapped artifact sections; same queries, no build step"""
+
+    def __init__(self, vocabulary, sections, size):
+        import numpy as np
+
+        self._np = np
+        self.size = size
+        self.vocabulary = vocabulary
+        self.idf = dict(zip(vocabulary, sections['idf'].tolist()))
+        self._matrix = sections.get('matrix')
+        self._indptr = sections.get('indptr')
+        self._indices = sections.get('indices')
+        self._data = sections.get('data')
+        self._documents = None
+        # numpy's per-call overhead only pays off on larger knowledge bases
+        self.vectorized = size >= VECTORIZE_MIN_CHUNKS
+        if not self.vectorized:
+            self.postings = self._postings()
+
+    def _postings(self):
+        """term -> [(chunk index, weight)], the pure-Python inverted index"""
+        result = {}
+        for term, column in self.vocabulary.items():
+            if self._matrix is not None:
+                rows = self._np.nonzero(self._matrix[:, column])[0].tolist()
+                result[term] = [(i, float(self._matrix[i, column])) for i in rows]
+            else:
+                start, end = self._indptr[column], self._indptr[column + 1]
+                result[term] = list(zip(self._indices[start:end].tolist(), self._data[start:end].tolist()))
+        return result
+
+    def document_matrix(self):
+        """Dense chunks x terms weight matrix: the mapped one, or the CSR sections expanded"""
+        if self._matrix is not None:
+            return self._matrix
+        if self._documents is None:
+            np = self._np
+            matrix = np.zeros((self.size, len(self.vocabulary)), dtype=np.float32)
+            columns = np.repeat(np.arange(len(self.vocabulary)), np.diff(self._indptr))
+            matrix[self._indices, columns] = self._data
+            self._documents = matrix
+        return self._documents
+
+    def similarities(self, query, query_vector=None):
+        """Cosine similarity of the query against every chunk"""
+        if not self.vectorized:
+            return super().similarities(query, query_vector)
+        np = self._np
+        if query_vector is None:
+            query_vector = self.query_vector(query)
+        if self._matrix is not None:
+            dense = np.zeros(len(self.vocabulary), dtype=np.float32)
+            for term, weight in query_vector.items():
+                dense[self.vocabulary[term]] = weight
+            return (self._matrix @ dense).astype(np.float64).tolist()
+        scores = np.zeros(self.size, dtype=np.float64)
+        for term, weight in query_vector.items():
+            column = self.vocabulary[term]
+            start, end = self._indptr[column], self._indptr[column + 1]
+            # Indices within one row are unique, so fancy-index += is safe
+            scores[self._indices[start:end]] += weight * self._data[start:end]
+        return scores.tolist()
+
+
+def map_sections(path, header, verify=False):
+    """Memory-map the sections listed in a header as read-only numpy arrays"""
+    import numpy as np
+
+    try:
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    except (OSError, ValueError) as e:
+        raise ArtifactError(str(e))
+    sections = {}
+    for name, spec in header['sections'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        start, end = spec['offset'], spec['offset'] + count * dtype.itemsize
+        if end > buffer.size:
+            raise ArtifactError(f'Artifact is truncated (section {name})')
+        raw = buffer[start:end]
+        if verify and hashlib.sha256(raw.data).hexdigest() != spec['sha256']:
+            raise ArtifactError(f'Artifact checksum mismatch (section {name})')
+        # Views into the mapping: nothing is copied until a page is touched
+        sections[name] = raw.view(dtype).reshape(spec['shape'])
+    return sections
+
+
+def load_artifact(path, source_digest, build_digest, verify=VERIFY_ON_LOAD):
+    """Return (chunks, backend) from an up-to-date artifact, or raise ArtifactError"""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        raise ArtifactError('numpy is not installed')
+
+    header = read_header(path)
+    if header.get('source_sha256') != source_digest:
+        raise ArtifactError('Artifact is stale: knowledge base changed since it was compiled')
+    if header.get('builder_sha256') != build_digest:
+        raise ArtifactError('Artifact is stale: compiler or chunker changed since it was compiled')
+    sections = map_sections(path, header, verify)
+
+    texts = sections['texts'].tobytes()
+    offsets = sections['text_offsets'].tolist()
+    chunks = [
+        dict(meta, text=texts[offsets[i]:offsets[i + 1]].decode('utf-8'))
+        for i, meta in enumerate(header['chunks'])
+    ]
+    vocabulary = {term: i for i, term in enumerate(header['vocabulary'])}
+    return chunks, CompiledTfidfBackend(vocabulary, sections, len(chunks))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from _retrieval import PARITY_QUERIES, RetrievalIndex, top_indices
+    from _service import _file_digest, chunk_knowledge_base, find_knowledge_base_path, load_knowledge_base
+
+    parser = argparse.ArgumentParser(description="Compile knowledge-base.json into a retrieval artifact")
+    parser.add_argument('command', choices=['build', 'check', 'info'])
+    parser.add_argument('--kb', default=None, help="knowledge base JSON (default: the one the API loads)")
+    parser.add_argument('--out', default=None, help="artifact path (default: next to the JSON, .idx)")
+    parser.add_argument('--dense', action='store_true', help="store a dense matrix instead of CSR")
+    args = parser.parse_args()
+
+    kb_path = args.kb or find_knowledge_base_path()
+    if not kb_path:
+        sys.exit('knowledge-base.json not found')
+    out_path = args.out or artifact_path(kb_path)
+    source_digest = _file_digest(kb_path)
+    build_digest = builder_digest('_chunking')
+
+    if args.command == 'build':
+        started = time.perf_counter()
+        kb_chunks = chunk_knowledge_base(load_knowledge_base(kb_path))
+        written = write_artifact(out_path, kb_chunks, source_digest, build_digest, dense=args.dense)
+        print(f"Wrote {out_path}: {len(kb_chunks)} chunks, {len(written['vocabulary'])} terms, "
+              f"{written['layout']} layout, {os.path.getsize(out_path)} bytes "
+              f"in {(time.perf_counter() - started) * 1000:.1f}ms")
+    elif args.command == 'info':
+        try:
+            print(json.dumps({k: v for k, v in read_header(out_path).items() if k != 'vocabulary'}, indent=2))
+        except ArtifactError as e:
+            sys.exit(str(e))
+    else:
+        try:
+            started = time.perf_counter()
+            artifact_chunks, compiled = load_artifact(out_path, source_digest, build_digest, verify=True)
+            load_ms = (time.perf_counter() - started) * 1000
+        except ArtifactError as e:
+            print(f"STALE {out_path}: {e}")
+            sys.exit(1)
+        # The artifact must rank exactly like an index built from the JSON
+        reference = RetrievalIndex(chunk_knowledge_base(load_knowledge_base(kb_path)), backend='tfidf')
+        loaded = RetrievalIndex.from_backend(artifact_chunks, compiled)
+        mismatches = 0
+        for query in PARITY_QUERIES:
+            expected = top_indices(reference.similarities(query), 5)
+            actual = top_indices(compiled.similarities(query), 5)
+            if expected == actual:
+                # Chunk metadata must survive too: compare the merged results
+                expected = [c['id'] for c in reference.search(query, 5)]
+                actual = [c['id'] for c in loaded.search(query, 5)]
+            if expected != actual:
+                mismatches += 1
+                print(f"MISMATCH {query!r}: {expected} != {actual}")
+        print(f"OK {out_path}: up to date, checksums verified, loaded in {load_ms:.2f}ms, "
+              f"{len(PARITY_QUERIES)} queries checked, {mismatches} ranking mismatches")
+        sys.exit(1 if mismatches else 0)
@@ -0,0 +1,454 @@
+"""
+Answer caches for the chatbot
+Exact-match LRU + TTL cache with an optional JSON backing file, and a
+near-duplicate tier that matches paraphrased questions by query-vector similarity
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent writers are not serialized
+    fcntl = None
+
+# Defaults, overridable through environment variables
+DEFAULT_MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_SIZE', '256'))
+DEFAULT_TTL_SECONDS = float(os.environ.get('CHAT_CACHE_TTL', '3600'))
+DEFAULT_PATH = os.environ.get('CHAT_CACHE_PATH') or None
+# Seconds a change waits before the backing file is rewritten, so bursts cost one write
+DEFAULT_SAVE_DELAY = float(os.environ.get('CHAT_CACHE_SAVE_DELAY', '1'))
+DEFAULT_SEMANTIC_CAPACITY = int(os.environ.get('CHAT_SEMANTIC_CACHE_SIZE', '1024'))
+DEFAULT_SEMANTIC_THRESHOLD = float(os.environ.get('CHAT_SEMANTIC_CACHE_THRESHOLD', '0.9'))
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_message(message):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return _WHITESPACE.sub(' ', message.lower()).strip().rstrip('?!.').strip()
+
+
+def history_fingerprint(history):
+    """Stable hash of the user/assistant turns that go into the prompt"""
+    turns = [
+        [msg.get('role'), msg.get('content', '')]
+        for msg in history
+        if isinstance(msg, dict) and msg.get('role') in ['user', 'assistant']
+    ]
+    return hashlib.sha256(json.dumps(turns).encode('utf-8')).hexdigest()[:16]
+
+
+def chunk_set_key(chunk_ids, history):
+    """Order-insensitive key for a retrieved chunk set plus the history it was answered with"""
+    return hash((tuple(sorted(str(i) for i in chunk_ids)), history_fingerprint(history)))
+
+
+def make_key(message, chunk_ids, history):
+    """Cache key from the normalized message, retrieved chunk IDs and history"""
+    raw = json.dumps([normalize_message(message), list(chunk_ids), history_fingerprint(history)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def chunk_versions_for(chunk_ids, versions):
+    """(chunk ID, digest) pairs an answer depends on, from RetrievalIndex.chunk_versions"""
+    # ChunkTree.merge joins a parent's ID and its children's with '+'
+    return tuple(sorted(
+        (chunk_id, versions.get(chunk_id)) for merged in chunk_ids for chunk_id in str(merged).split('+')
+    ))
+
+
+def _unchanged(entry_versions, versions):
+    """True if every chunk an entry was answered from still has the same contents"""
+    return entry_versions is not None and all(
+        digest is not None and versions.get(chunk_id) == digest for chunk_id, digest in entry_versions
+    )
+
+
+class AnswerCache:
+    """Thread-safe LRU cache with per-entry expiry"""
+    
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SECONDS, path=DEFAULT_PATH,
+                 save_delay=DEFAULT_SAVE_DELAY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.save_delay = save_delay
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, answer, chunk versions)
+        self._lock = threading.Lock()
+        # Writes of the backing file happen outside _lock, one at a time
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._cleared = False
+        self._save_timer = None
+        if path:
+            self._load(path)
+    
+    def set_generation(self, generation, versions=None):
+        """Move to a new knowledge base generation, returning how many entries it dropped
+        
+        versions: the new index's chunk versions; only entries answered from a
+        chunk that changed or went away are dropped. Without them, all are.
+        """
+        if generation == self.generation:
+            return 0
+        with self._lock:
+            if generation == self.generation:
+                return 0
+            stale = [
+                key for key, (_, _, entry_versions) in self._entries.items()
+                if versions is None or not _unchanged(entry_versions, versions)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            self.generation = generation
+            self._dirty = True
+        self._schedule_save()
+        return len(stale)
+    
+    def get(self, key):
+        """Return a cached answer, or None on a miss or expired entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            # Wall-clock expiry so entries loaded from disk age correctly
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, answer, versions=None, generation=None):
+        """Store an answer, evicting the least recently used entries past capacity
+        
+        versions: chunk_versions_for() the chunks it was answered from
+        generation: the knowledge base it was answered from; an answer that
+        finished after a newer one was swapped in is not stored
+        """
+        if not answer or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.time() + self.ttl, answer, versions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+        self._schedule_save()
+    
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._dirty = True
+            self._cleared = True
+        self._schedule_save()
+    
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'persistent': bool(self.path)
+            }
+    
+    def _read_file(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return stored if isinstance(stored, dict) else None
+    
+    def _load(self, path):
+        """Read unexpired entries from the backing file"""
+        stored = self._read_file(path)
+        if stored is None:
+            return
+        now = time.time()
+        # A different knowledge base generation keeps only entries whose chunks are unchanged
+        self.generation = stored.get('generation')
+        for key, expires_at, answer, *rest in stored.get('entries', [])[-self.max_entries:]:
+            if expires_at > now:
+                # Files from before entries carried chunk versions: those go on the next edit
+                versions = rest[0] if rest else None
+                if versions is not None:
+                    versions = tuple(tuple(pair) for pair in versions)
+                self._entries[key] = (expires_at, answer, versions)
+    
+    def _schedule_save(self):
+        """Write the backing file after save_delay; changes in the meantime share the write"""
+        if not self.path:
+            return
+        if self.save_delay <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+    
+    def flush(self):
+        """Write pending changes to the backing file now (called on shutdown)"""
+        path = self.path
+        if not path:
+            return
+        with self._save_lock:
+            # Snapshot under the lock, write outside it: get() never waits on the disk
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                generation = self.generation
+                entries = [[key, exp, answer, versions] for key, (exp, answer, versions) in self._entries.items()]
+                merge = not self._cleared
+                self._dirty = self._cleared = False
+            try:
+                self._write(path, generation, entries, merge)
+            except OSError:
+                pass
+    
+    def _write(self, path, generation, entries, merge):
+        """Replace the backing file, keeping other processes' entries for the same generation"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Prefork workers share one file: take turns, and merge instead of overwriting
+        with open(f'{path}.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stored = self._read_file(path) if merge else None
+            if stored is not None and stored.get('generation') == generation:
+                now = time.time()
+                ours = {entry[0] for entry in entries}
+                theirs = [
+                    entry for entry in stored.get('entries', [])
+                    if len(entry) >= 3 and entry[0] not in ours and entry[1] > now
+                ]
+                # Ours are the most recently used; theirs go first and are trimmed first
+                entries = (theirs + entries)[-self.max_entries:]
+            # Per-process temp file, then an atomic swap so a crash never leaves a half-written file
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'generation': generation, 'entries': entries}, f)
+            os.replace(tmp_path, path)
+
+
+class SemanticCache:
+    """Near-duplicate answer cache over retrieval-space query vectors
+    
+    Query vectors live in one preallocated float32 matrix, so a lookup is a single
+    matrix-vector product regardless of how many answers are cached. An answer is
+    served when the cosine similarity passes the threshold and the new query
+    retrieved the same chunk set with the same history.
+    """
+    
+    def __init__(self, capacity=DEFAULT_SEMANTIC_CAPACITY, threshold=DEFAULT_SEMANTIC_THRESHOLD,
+                 ttl=DEFAULT_TTL_SECONDS):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._vocabulary = {}
+        self._lock = threading.Lock()
+        self._np = None
+        try:
+            import numpy
+            self._np = numpy
+        except ImportError:
+            # Tier is disabled without numpy; the exact cache still works
+            pass
+        self._reset(0)
+    
+    @property
+    def enabled(self):
+        return self._np is not None and self.capacity > 0
+    
+    def _numpy(self):
+        """The numpy module, for code that only runs while the tier is enabled"""
+        if self._np is None:
+            raise RuntimeError('The semantic cache needs numpy')
+        return self._np
+    
+    def _reset(self, dimensions):
+        """Allocate empty storage for vectors of the given size"""
+        self._size = 0
+        self._answers = [None] * self.capacity
+        self._chunk_versions = [None] * self.capacity
+        self._clock = 0
+        if not self.enabled:
+            return
+        np = self._numpy()
+        self._vectors = np.zeros((self.capacity, dimensions), dtype=np.float32)
+        self._set_keys = np.zeros(self.capacity, dtype=np.int64)
+        self._expires = np.zeros(self.capacity, dtype=np.float64)
+        self._last_used = np.zeros(self.capacity, dtype=np.int64)
+    
+    def set_generation(self, generation, vocabulary, versions=None):
+        """Move to a new knowledge base generation, returning how many answers it dropped
+        
+        versions: the new index's chunk versions; answers whose chunks are
+        unchanged are kept and their vectors moved into the new vocabulary.
+        Without them, the cache starts over.
+        """
+        if generation == self.generation:
+            return 0
+        with self._lock:
+            if generation == self.generation:
+                return 0
+            dropped = self._size
+            if versions is not None and self.enabled and self._size:
+                dropped -= self._carry_over(vocabulary, versions)
+            else:
+                self._vocabulary = vocabulary
+                self._reset(len(vocabulary))
+            self.invalidations += dropped
+            self.generation = generation
+            return dropped
+    
+    def _carry_over(self, vocabulary, versions):
+        """Keep the answers whose chunks are unchanged, in the new retrieval space; returns how many"""
+        np = self._numpy()
+        keep = [slot for slot in range(self._size) if _unchanged(self._chunk_versions[slot], versions)]
+        vectors = self._vectors[keep]
+        if vocabulary != self._vocabulary:
+            # Shared terms keep their weights; the IDF shift makes the vectors approximate,
+            # but a hit still needs the new query to retrieve the same chunk set
+            shared = [(column, vocabulary[term]) for term, column in self._vocabulary.items() if term in vocabulary]
+            moved = np.zeros((len(keep), len(vocabulary)), dtype=np.float32)
+            if shared:
+                old_columns, new_columns = (list(columns) for columns in zip(*shared))
+                moved[:, new_columns] = vectors[:, old_columns]
+            norms = np.linalg.norm(moved, axis=1)
+            # A query made only of terms that left the vocabulary can never match again
+            live = norms > 0
+            vectors = moved[live] / norms[live][:, None]
+            keep = [slot for slot, alive in zip(keep, live) if alive]
+        
+        set_keys, expires, last_used = self._set_keys[keep], self._expires[keep], self._last_used[keep]
+        answers = [self._answers[slot] for slot in keep]
+        chunk_versions = [self._chunk_versions[slot] for slot in keep]
+        clock = self._clock
+        self._vocabulary = vocabulary
+        self._reset(len(vocabulary))
+        n = len(keep)
+        self._vectors[:n] = vectors
+        self._set_keys[:n] = set_keys
+        self._expires[:n] = expires
+        self._last_used[:n] = last_used
+        self._answers[:n] = answers
+        self._chunk_versions[:n] = chunk_versions
+        self._size, self._clock = n, clock
+        return n
+    
+    def _dense(self, query_vector):
+        """Unit-length dense float32 vector, or None if the query has no known terms"""
+        np = self._numpy()
+        dense = np.zeros(len(self._vocabulary), dtype=np.float32)
+        for term, weight in query_vector.items():
+            column = self._vocabulary.get(term)
+            if column is not None:
+                dense[column] = weight
+        norm = float(np.linalg.norm(dense))
+        return dense / norm if norm else None
+    
+    def get(self, query_vector, set_key):
+        """Return the answer of the most similar cached query, or None"""
+        if not self.enabled or not query_vector:
+            return None
+        np = self._numpy()
+        with self._lock:
+            dense = self._dense(query_vector)
+            if dense is None or not self._size:
+                self.misses += 1
+                return None
+            n = self._size
+            similarities = self._vectors[:n] @ dense
+            eligible = (
+                (similarities >= self.threshold)
+                & (self._set_keys[:n] == set_key)
+                & (self._expires[:n] > time.time())
+            )
+            if not eligible.any():
+                self.misses += 1
+                return None
+            best = int(np.argmax(np.where(eligible, similarities, -1.0)))
+            self._clock += 1
+            self._last_used[best] = self._clock
+            self.hits += 1
+            return self._answers[best]
+    
+    def put(self, query_vector, set_key, answer, versions=None, generation=None):
+        """Store an answer, replacing the least recently used slot when full
+        
+        versions and generation: as for AnswerCache.put
+        """
+        if not self.enabled or not query_vector or not answer:
+            return
+        np = self._numpy()
+        with self._lock:
+            # The vector belongs to the retrieval space it was made in
+            if generation is not None and generation != self.generation:
+                return
+            dense = self._dense(query_vector)
+            if dense is None:
+                return
+            if self._size < self.capacity:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+            self._clock += 1
+            self._vectors[slot] = dense
+            self._set_keys[slot] = set_key
+            self._expires[slot] = time.time() + self.ttl
+            self._last_used[slot] = self._clock
+            self._answers[slot] = answer
+            self._chunk_versions[slot] = versions
+    
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': self._size,
+                'capacity': self.capacity,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
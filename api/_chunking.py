@@ -0,0 +1,165 @@
+"""
+Field-aware chunking of the chatbot knowledge base
+Emits one small chunk per responsibility, project field and skill category,
+each linked to a short parent chunk (the role, project or skill list it belongs
+to) and tagged with the keyword fields the hybrid scorer boosts
+"""
+
+# Extra words that point a query at a whole section
+SECTION_KEYWORDS = {
+    'about': ['background', 'summary', 'bio', 'who'],
+    'skills': ['skill', 'tool', 'language', 'stack'],
+    'experience': ['experience', 'job', 'work', 'intern', 'internship', 'role'],
+    'education': ['education', 'school', 'degree', 'university', 'college', 'study', 'coursework'],
+    'projects': ['project', 'built', 'build', 'portfolio'],
+}
+
+SKILL_CATEGORIES = [
+    ('programming', 'Programming'),
+    ('libraries', 'Libraries'),
+    ('databases', 'Databases'),
+    ('visualization', 'Visualization'),
+    ('methodologies', 'Methodologies'),
+]
+
+PROJECT_FIELDS = [
+    ('description', 'Description'),
+    ('problem', 'Problem'),
+    ('outcome', 'Outcome'),
+]
+
+
+def _chunk(chunk_id, text, source, field, parent=None, detail=None, keywords=None):
+    """A chunk dict; detail is the text shown when merged under its parent"""
+    chunk = {'id': chunk_id, 'text': text, 'source': source, 'field': field}
+    if parent is not None:
+        chunk['parent'] = parent
+        chunk['detail'] = detail or text
+    chunk['keywords'] = {'section': SECTION_KEYWORDS.get(source, [])}
+    for name, values in (keywords or {}).items():
+        values = [v for v in values if v]
+        if values:
+            chunk['keywords'][name] = values
+    return chunk
+
+
+def chunk_knowledge_base(kb):
+    """Convert knowledge base into searchable chunks"""
+    chunks = []
+
+    if 'about' in kb:
+        about = kb['about']
+        name = about.get('name', 'Mohammed-Taqi Jalil')
+        chunks.append(_chunk(
+            'about', f"About {name}: {about.get('summary', '')}", 'about', 'summary',
+            keywords={'name': [name], 'role': [about.get('title')], 'location': [about.get('location')]}
+        ))
+        if 'skills' in about:
+            skills = about['skills']
+            chunks.append(_chunk('about-skills', 'Skills:', 'skills', 'skills'))
+            for key, label in SKILL_CATEGORIES:
+                if not skills.get(key):
+                    continue
+                listed = ', '.join(skills[key])
+                chunks.append(_chunk(
+                    f'about-skills-{key}', f"{label} skills: {listed}.", 'skills', key,
+                    parent='about-skills', detail=f"{label} - {listed}.",
+                    keywords={'skills': skills[key], 'category': [label]}
+                ))
+
+    if 'experience' in kb:
+        for i, exp in enumerate(kb['experience']):
+            role, company = exp.get('role', ''), exp.get('company', '')
+            parent_id = f'experience-{i}'
+            header = f"{role} at {company} ({exp.get('period', '')})."
+            if exp.get('technologies'):
+                header += f" Technologies: {', '.join(exp['technologies'])}."
+            shared = {'company': [company], 'role': [role]}
+            chunks.append(_chunk(
+                parent_id, header, 'experience', 'role',
+                keywords=dict(shared, technologies=exp.get('technologies', []))
+            ))
+            for j, responsibility in enumerate(exp.get('responsibilities', [])):
+                chunks.append(_chunk(
+                    f'{parent_id}-{j}', f"{role} at {company}: {responsibility}", 'experience',
+                    'responsibility', parent=parent_id, detail=responsibility, keywords=shared
+                ))
+
+    if 'education' in kb:
+        edu = kb['education']
+        edu_text = f"Education: {edu.get('degree', '')} from {edu.get('institution', '')} ({edu.get('graduation', '')}). "
+        edu_text += f"Coursework: {', '.join(edu.get('coursework', []))}"
+        chunks.append(_chunk(
+            'education', edu_text, 'education', 'education',
+            keywords={'institution': [edu.get('institution')], 'coursework': edu.get('coursework', [])}
+        ))
+
+    if 'projects' in kb:
+        for i, project in enumerate(kb['projects']):
+            title = project.get('title', '')
+            parent_id = f"project-{project.get('id', i)}"
+            header = f"Project: {title} ({project.get('category', '')})."
+            if project.get('github'):
+                header += f" GitHub: {project['github']}"
+            shared = {'title': [title], 'category': [project.get('category')]}
+            chunks.append(_chunk(parent_id, header, 'projects', 'title', keywords=shared))
+            for key, label in PROJECT_FIELDS:
+                if project.get(key):
+                    chunks.append(_chunk(
+                        f'{parent_id}-{key}', f"{title} - {label}: {project[key]}", 'projects', key,
+                        parent=parent_id, detail=f"{label}: {project[key]}", keywords=shared
+                    ))
+            if project.get('technologies'):
+                listed = ', '.join(project['technologies'])
+                chunks.append(_chunk(
+                    f'{parent_id}-technologies', f"{title} - Technologies used: {listed}", 'projects',
+                    'technologies', parent=parent_id, detail=f"Technologies used: {listed}",
+                    keywords=dict(shared, technologies=project['technologies'])
+                ))
+
+    return chunks
+
+
+class ChunkTree:
+    """Parent links between chunks, for merging retrieved children under their parent"""
+
+    def __init__(self, chunks):
+        self.by_id = {chunk['id']: chunk for chunk in chunks}
+        self.position = {chunk['id']: i for i, chunk in enumerate(chunks)}
+        self.children = {}
+        for chunk in chunks:
+            if chunk.get('parent'):
+                self.children.setdefault(chunk['parent'], []).append(chunk)
+
+    def merge(self, ranked):
+        """Group ranked chunks under their parents, best group first
+
+        Each group becomes one chunk: the parent's text followed by the details
+        of its retrieved children in knowledge-base order. A parent retrieved on
+        its own is only a heading, so it brings all of its children.
+        """
+        groups = {}
+        for chunk in ranked:
+            root = chunk.get('parent') or chunk['id']
+            groups.setdefault(root, []).append(chunk)
+
+        merged = []
+        for root, members in groups.items():
+            parent = self.by_id.get(root)
+            if parent is None:
+                merged.extend(members)
+                continue
+            children = [c for c in members if c.get('parent')] or self.children.get(root, [])
+            if not children:
+                merged.append(parent)
+                continue
+            children = sorted(children, key=lambda c: self.position[c['id']])
+            parts = [parent['text']] + [c['detail'] for c in children]
+            merged.append({
+                'id': '+'.join([root] + [c['id'] for c in children]),
+                'text': ' '.join(parts),
+                'source': parent['source'],
+                'field': parent['field'],
+                'parts': parts
+            })
+        return merged
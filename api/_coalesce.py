@@ -0,0 +1,202 @@
+"""
+Single-flight coalescing for the chatbot
+Concurrent requests with the same answer-cache key share one upstream call: the
+first becomes the leader, the rest wait on its flight and receive the same
+answer, streamed deltas included. Waiters are bounded per flight and time out.
+"""
+import os
+import threading
+
+# Defaults, overridable through environment variables
+COALESCE_ENABLED = os.environ.get('CHAT_COALESCE', '1') not in ('0', 'false', 'no')
+DEFAULT_MAX_WAITERS = int(os.environ.get('CHAT_COALESCE_MAX_WAITERS', '64'))
+# Longest a waiter goes without a new delta before giving up on the flight
+DEFAULT_WAIT_TIMEOUT = float(os.environ.get('CHAT_COALESCE_TIMEOUT', '25'))
+
+
+class CoalesceTimeout(Exception):
+    """The shared upstream call made no progress within the wait timeout"""
+
+
+class Flight:
+    """One in-flight upstream call: its deltas so far and how it ended"""
+
+    def __init__(self, key):
+        self.key = key
+        self.parts = []
+        self.done = False
+        self.error = None      # exception raised by the upstream call
+        self.result = None     # error or fallback ChatResult of the leader
+        self.waiters = 0
+        self._cond = threading.Condition()
+
+    def publish(self, delta):
+        with self._cond:
+            self.parts.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error=None, result=None):
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self.result = result
+            self._cond.notify_all()
+
+    def follow(self, timeout=DEFAULT_WAIT_TIMEOUT):
+        """Yield the flight's deltas from the start, blocking the calling thread"""
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self.parts) and not self.done:
+                    if not self._cond.wait(timeout):
+                        raise CoalesceTimeout(f'No progress on the shared answer in {timeout:g}s')
+                parts, done = self.parts[seen:], self.done
+            seen += len(parts)
+            yield from parts
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class LeaderStream:
+    """The leader's deltas, forwarded to its client and to every waiter
+
+    An object rather than a generator so that close() ends the flight and
+    releases the upstream stream even when nothing ever iterated it (e.g. the
+    client disconnected before the response headers went out).
+    """
+
+    def __init__(self, registry, flight, deltas):
+        self.registry = registry
+        self.flight = flight
+        self.deltas = deltas
+        self._ended = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._ended:
+            raise StopIteration
+        try:
+            delta = next(self.deltas)
+        except StopIteration:
+            self._end()
+            raise
+        except Exception as e:
+            self._end(error=e)
+            raise
+        self.flight.publish(delta)
+        return delta
+
+    def close(self):
+        """Stop early; waiters still get the whole answer"""
+        if self._ended:
+            return
+        if self.flight.waiters and not self.flight.done:
+            # The leader's client went away; finish the answer for the others
+            try:
+                for delta in self.deltas:
+                    self.flight.publish(delta)
+            except Exception as e:
+                self._end(error=e)
+                return
+        self._end()
+
+    def _end(self, error=None):
+        self._ended = True
+        close = getattr(self.deltas, 'close', None)
+        if close:
+            close()
+        self.registry.finish(self.flight, error=error)
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls keyed by answer-cache key"""
+
+    def __init__(self, max_waiters=DEFAULT_MAX_WAITERS, wait_timeout=DEFAULT_WAIT_TIMEOUT,
+                 enabled=COALESCE_ENABLED):
+        self.max_waiters = max_waiters
+        self.wait_timeout = wait_timeout
+        self.enabled = enabled
+        self.leaders = 0
+        self.followers = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return (flight, role) with role 'leader', 'follower', 'overflow' or None
+
+        Only a follower waits; the others make the upstream call, and a leader
+        must end its flight with lead() or finish() so the followers are released.
+        Overflow (the flight already has max_waiters) and None (coalescing is
+        off) come without a flight.
+        """
+        if not self.enabled:
+            return None, None
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(key)
+                self.leaders += 1
+                return flight, 'leader'
+            if flight.waiters >= self.max_waiters:
+                # Queue is full - this request makes its own upstream call
+                self.overflows += 1
+                return None, 'overflow'
+            flight.waiters += 1
+            self.followers += 1
+            return flight, 'follower'
+
+    def finish(self, flight, error=None, result=None):
+        """End a flight and stop new requests from joining it"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.finish(error, result)
+
+    def lead(self, flight, result):
+        """Share the leader's ChatResult with the flight, returning the result to send"""
+        if result.status != 200 or result.degraded:
+            self.finish(flight, result=result)
+            return result
+        if not result.is_stream:
+            flight.publish(result.body.get('response', ''))
+            self.finish(flight)
+            return result
+        return type(result)(deltas=LeaderStream(self, flight, result.deltas),
+                            headers=result.headers, timer=result.timer)
+
+    def follow(self, flight, timeout=DEFAULT_WAIT_TIMEOUT):
+        """flight.follow() for a follower; it stops counting as a waiter once this stops"""
+        try:
+            yield from flight.follow(timeout)
+        finally:
+            self.leave(flight)
+
+    def leave(self, flight):
+        with self._lock:
+            flight.waiters = max(0, flight.waiters - 1)
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self._flights),
+                'max_waiters': self.max_waiters,
+                'wait_timeout_seconds': self.wait_timeout,
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'overflows': self.overflows,
+                'timeouts': self.timeouts
+            }
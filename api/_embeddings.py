@@ -0,0 +1,447 @@
+"""
+Dense embedding retrieval for the chatbot
+Optional backend (CHAT_RETRIEVAL_BACKEND=dense) that matches questions to
+chunks by meaning rather than shared words. Text is embedded by a small static
+embedding model read from disk (Model2Vec layout: subword vectors averaged and
+normalised, numpy only, no network). Chunk embeddings are precomputed once into
+an int8 store that is memory-mapped, ranked with argpartition, and optionally
+split into IVF lists so a query only scans the lists nearest to it.
+
+Usage:
+    CHAT_EMBEDDING_MODEL=models/potion-base-8M python api/_embeddings.py build
+    python api/_embeddings.py info
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+import unicodedata
+from functools import lru_cache
+
+from _artifact import ArtifactError, map_sections, read_header, write_sections
+from _retrieval import partition_top
+
+# Directory of the embedding model: model.safetensors + tokenizer.json (Model2Vec),
+# or embeddings.npy + vocab.txt
+MODEL_PATH = os.environ.get('CHAT_EMBEDDING_MODEL') or None
+# Precomputed chunk embeddings; rewritten when the chunks or the model change
+STORE_PATH = os.environ.get('CHAT_DENSE_STORE') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'knowledge-base.emb'
+)
+# IVF lists for large knowledge bases (0 scans every chunk), and lists probed per query
+IVF_LISTS = int(os.environ.get('CHAT_DENSE_IVF_LISTS', '0'))
+IVF_PROBE = int(os.environ.get('CHAT_DENSE_IVF_PROBE', '8'))
+
+STORE_MAGIC = b'KBEM'
+# Bump whenever the store layout or the quantization changes
+STORE_VERSION = 1
+# Fewer chunks per list than this and IVF saves nothing; the store stays exact
+IVF_MIN_LIST_SIZE = 32
+# k-means rounds when training the IVF centroids
+IVF_ITERATIONS = 10
+# Rows of int8 codes widened to float32 at a time while scoring
+SCORE_BLOCK_ROWS = 4096
+# Tokens per text, as in Model2Vec
+MAX_TOKENS = 512
+
+_SAFETENSORS_DTYPES = {'F64': '<f8', 'F32': '<f4', 'F16': '<f2', 'I64': '<i8', 'I32': '<i4', 'I8': 'i1', 'U8': 'u1'}
+
+
+class EmbeddingError(Exception):
+    """The embedding model is missing or in a format this module can't read"""
+
+
+def read_safetensors(path):
+    """{name: array} from a .safetensors file, memory-mapped without the safetensors package"""
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length))
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    tensors = {}
+    for name, spec in header.items():
+        if name == '__metadata__':
+            continue
+        start, end = (8 + length + offset for offset in spec['data_offsets'])
+        raw = buffer[start:end]
+        if spec['dtype'] == 'BF16':
+            # bfloat16 is the top half of a float32
+            tensors[name] = (raw.view('<u2').astype(np.uint32) << 16).view(np.float32).reshape(spec['shape'])
+        elif spec['dtype'] in _SAFETENSORS_DTYPES:
+            tensors[name] = raw.view(_SAFETENSORS_DTYPES[spec['dtype']]).reshape(spec['shape'])
+        else:
+            raise EmbeddingError(f"Unsupported tensor dtype {spec['dtype']} in {path}")
+    return tensors
+
+
+def _is_punctuation(char):
+    """BERT's definition: ASCII symbols count too, not just Unicode P* categories"""
+    code = ord(char)
+    if 33 <= code <= 47 or 58 <= code <= 64 or 91 <= code <= 96 or 123 <= code <= 126:
+        return True
+    return unicodedata.category(char).startswith('P')
+
+
+class StaticEmbeddingModel:
+    """Static subword embeddings: a text's vector is the mean of its WordPiece token vectors"""
+
+    def __init__(self, embeddings, vocabulary, unk_token='[UNK]', lowercase=True, prefix='##',
+                 max_word_chars=100, weights=None, mapping=None, normalize=True, name=None):
+        self.embeddings = embeddings
+        self.vocabulary = vocabulary
+        self.unk_id = vocabulary.get(unk_token)
+        self.lowercase = lowercase
+        self.prefix = prefix
+        self.max_word_chars = max_word_chars
+        self.weights = weights
+        self.mapping = mapping
+        self.normalize = normalize
+        self.name = name or 'static'
+        self.dimensions = embeddings.shape[1]
+        self._words = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read a model directory; weights are memory-mapped where the format allows"""
+        import numpy as np
+
+        if not path or not os.path.isdir(path):
+            raise EmbeddingError(f'Embedding model directory not found: {path!r} (set CHAT_EMBEDDING_MODEL)')
+        config = {}
+        if os.path.exists(os.path.join(path, 'config.json')):
+            with open(os.path.join(path, 'config.json'), 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        name = os.path.basename(os.path.normpath(path))
+
+        if os.path.exists(os.path.join(path, 'model.safetensors')):
+            tensors = read_safetensors(os.path.join(path, 'model.safetensors'))
+            if 'embeddings' not in tensors:
+                raise EmbeddingError(f'{path}/model.safetensors has no "embeddings" tensor')
+            try:
+                with open(os.path.join(path, 'tokenizer.json'), 'r', encoding='utf-8') as f:
+                    tokenizer = json.load(f)
+            except OSError as e:
+                raise EmbeddingError(f'Cannot read the tokenizer: {e}')
+            model = tokenizer.get('model') or {}
+            if model.get('type') != 'WordPiece':
+                raise EmbeddingError(f"Only WordPiece tokenizers are supported, not {model.get('type')}")
+            normalizer = tokenizer.get('normalizer') or {}
+            return cls(
+                tensors['embeddings'], model['vocab'],
+                unk_token=model.get('unk_token', '[UNK]'),
+                lowercase=normalizer.get('lowercase', True),
+                prefix=model.get('continuing_subword_prefix', '##'),
+                max_word_chars=model.get('max_input_chars_per_word', 100),
+                weights=tensors.get('weights'), mapping=tensors.get('mapping'),
+                normalize=config.get('normalize', True), name=name
+            )
+
+        if os.path.exists(os.path.join(path, 'embeddings.npy')):
+            with open(os.path.join(path, 'vocab.txt'), 'r', encoding='utf-8') as f:
+                vocabulary = {line.rstrip('\n'): i for i, line in enumerate(f)}
+            embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r')
+            return cls(embeddings, vocabulary, lowercase=config.get('lowercase', True),
+                       normalize=config.get('normalize', True), name=name)
+
+        raise EmbeddingError(f'{path} has neither model.safetensors nor embeddings.npy')
+
+    @property
+    def fingerprint(self):
+        """Identifies the weights, so a store built with another model is never reused"""
+        digest = hashlib.sha256(f'{self.name}:{self.embeddings.shape}:{len(self.vocabulary)}'.encode('utf-8'))
+        # A sample of rows is enough to tell models apart without reading all the weights
+        step = max(1, self.embeddings.shape[0] // 64)
+        digest.update(self.embeddings[::step].tobytes())
+        return digest.hexdigest()[:16]
+
+    def _split(self, text):
+        """BERT basic tokenization: lowercase, strip accents, split on whitespace and punctuation"""
+        if self.lowercase:
+            text = ''.join(
+                c for c in unicodedata.normalize('NFD', text.lower()) if unicodedata.category(c) != 'Mn'
+            )
+        words, current = [], []
+        for char in text:
+            if char.isspace() or _is_punctuation(char):
+                if current:
+                    words.append(''.join(current))
+                    current = []
+                if not char.isspace():
+                    words.append(char)
+            else:
+                current.append(char)
+        if current:
+            words.append(''.join(current))
+        return words
+
+    def _word_pieces(self, word):
+        """Greedy longest-match-first WordPiece IDs of one word (cached; words repeat a lot)"""
+        pieces = self._words.get(word)
+        if pieces is not None:
+            return pieces
+        pieces, start = [], 0
+        while start < len(word) and len(word) <= self.max_word_chars:
+            end = len(word)
+            while end > start:
+                piece = word[start:end] if start == 0 else self.prefix + word[start:end]
+                if piece in self.vocabulary:
+                    break
+                end -= 1
+            if end == start:
+                break
+            pieces.append(self.vocabulary[piece])
+            start = end
+        if start < len(word):
+            # Like WordPiece, a word that can't be fully split is unknown as a whole
+            pieces = [self.unk_id]
+        if len(self._words) < 100000:
+            self._words[word] = pieces
+        return pieces
+
+    def token_ids(self, text):
+        """Vocabulary IDs of a text, unknown words dropped"""
+        ids = [i for word in self._split(text) for i in self._word_pieces(word) if i is not None and i != self.unk_id]
+        return ids[:MAX_TOKENS]
+
+    def encode(self, texts):
+        """float32 matrix with one embedding per text (unit length when the model normalizes)"""
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            ids = self.token_ids(text)
+            if not ids:
+                continue
+            ids = np.asarray(ids)
+            rows = self.mapping[ids] if self.mapping is not None else ids
+            tokens = np.asarray(self.embeddings[rows], dtype=np.float32)
+            if self.weights is not None:
+                tokens = tokens * np.asarray(self.weights[ids], dtype=np.float32)[:, None]
+            vectors[row] = tokens.mean(axis=0)
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms > 0, norms, 1.0)
+        return vectors
+
+
+@lru_cache(maxsize=2)
+def load_model(path=MODEL_PATH):
+    """The embedding model at path, loaded once per process (hot reloads reuse it)"""
+    return StaticEmbeddingModel.load(path)
+
+
+def quantize(vectors):
+    """Symmetric per-row int8 codes and float32 scales: vectors ~= codes * scales[:, None]"""
+    import numpy as np
+
+    peaks = np.abs(vectors).max(axis=1) if len(vectors) else np.zeros(0, dtype=np.float32)
+    scales = np.where(peaks > 0, peaks / 127.0, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def train_ivf(vectors, lists, iterations=IVF_ITERATIONS, seed=0):
+    """Spherical k-means: (unit centroids, list of every vector)"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    # Seed from distinct vectors: knowledge bases repeat boilerplate chunks
+    distinct = np.unique(vectors, axis=0)
+    centroids = distinct[rng.choice(len(distinct), min(lists, len(distinct)), replace=False)].copy()
+    for _ in range(iterations):
+        similarities = vectors @ centroids.T
+        assignment = np.argmax(similarities, axis=1)
+        fit = similarities[np.arange(len(vectors)), assignment]
+        counts = np.bincount(assignment, minlength=len(centroids))
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        centroids = np.where((norms > 0)[:, None], sums / np.where(norms > 0, norms, 1.0)[:, None], centroids)
+        # An empty list restarts at the vectors its neighbours serve worst
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            centroids[empty] = vectors[np.argsort(fit, kind='stable')[:empty.size]]
+    return centroids.astype(np.float32), np.argmax(vectors @ centroids.T, axis=1)
+
+
+def build_store(vectors, lists=IVF_LISTS):
+    """int8 store sections for chunk embeddings, rows grouped by IVF list when lists > 0"""
+    import numpy as np
+
+    size = len(vectors)
+    if lists > 0 and size >= lists * IVF_MIN_LIST_SIZE:
+        centroids, assignment = train_ivf(vectors, lists)
+        # Rows of one list are contiguous, so probing a list reads one slice
+        order = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.zeros(lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=lists))
+    else:
+        centroids, order, offsets = None, np.arange(size, dtype=np.int32), None
+    codes, scales = quantize(vectors[order])
+    sections = {'codes': codes, 'scales': scales, 'order': order}
+    if centroids is not None:
+        sections.update(centroids=centroids, offsets=offsets)
+    return sections
+
+
+class DenseBackend:
+    """Cosine similarity of embedded queries against int8 chunk embeddings"""
+
+    name = 'dense'
+
+    def __init__(self, texts, model=None, store_path=STORE_PATH, ivf_lists=IVF_LISTS, probe=IVF_PROBE):
+        import numpy as np
+
+        self._np = np
+        self.model = model or load_model()
+        self.size = len(texts)
+        self.probe = probe
+        # Query vectors are {dimension: value}, so the semantic answer cache works unchanged
+        self.vocabulary = {i: i for i in range(self.model.dimensions)}
+        digest = hashlib.sha256(
+            json.dumps([STORE_VERSION, self.model.fingerprint, ivf_lists, texts]).encode('utf-8')
+        ).hexdigest()
+        self.store = 'memory'
+        sections = self._load_store(store_path, digest)
+        if sections is None:
+            sections = build_store(self.model.encode(texts), ivf_lists)
+            sections = self._save_store(store_path, digest, sections) or sections
+        self.codes = sections['codes']
+        self.scales = sections['scales']
+        self.order = sections['order']
+        self.centroids = sections.get('centroids')
+        self.offsets = sections.get('offsets')
+
+    def _load_store(self, path, digest):
+        """Sections of an up-to-date store at path, memory-mapped, or None"""
+        if not path:
+            return None
+        try:
+            header = read_header(path, STORE_MAGIC, STORE_VERSION)
+            if header.get('digest') != digest:
+                return None
+            sections = map_sections(path, header)
+        except ArtifactError:
+            return None
+        self.store = 'loaded'
+        return sections
+
+    def _save_store(self, path, digest, sections):
+        """Write the store and map it back; None when the filesystem is read-only"""
+        if not path:
+            return None
+        header = {
+            'digest': digest,
+            'model': self.model.name,
+            'dimensions': self.model.dimensions,
+            'chunks': self.size,
+            'ivf_lists': 0 if 'centroids' not in sections else len(sections['centroids']),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        try:
+            header = write_sections(path, header, sections, STORE_MAGIC, STORE_VERSION)
+            mapped = map_sections(path, header)
+        except (OSError, ArtifactError):
+            return None
+        self.store = 'rebuilt'
+        return mapped
+
+    def query_vector(self, query):
+        """Sparse {dimension: value} form of the query embedding"""
+        embedding = self.model.encode([query])[0]
+        return {i: float(v) for i, v in enumerate(embedding.tolist()) if v}
+
+    def _dense_queries(self, queries, query_vectors):
+        """queries x dimensions float32 matrix"""
+        np = self._np
+        if query_vectors is None:
+            return self.model.encode(list(queries))
+        matrix = np.zeros((len(query_vectors), self.model.dimensions), dtype=np.float32)
+        for row, vector in enumerate(query_vectors):
+            for dimension, value in vector.items():
+                matrix[row, dimension] = value
+        return matrix
+
+    def _scan(self, matrix, start, end):
+        """Scores of store rows start:end against each query (columns), block by block"""
+        np = self._np
+        scores = np.empty((end - start, matrix.shape[1]), dtype=np.float32)
+        for block in range(start, end, SCORE_BLOCK_ROWS):
+            stop = min(end, block + SCORE_BLOCK_ROWS)
+            # Widen one block of codes at a time; a full float copy would undo the int8 saving
+            scores[block - start:stop - start] = (
+                self.codes[block:stop].astype(np.float32) @ matrix
+            ) * self.scales[block:stop, None]
+        return scores
+
+    def _scores(self, queries_matrix):
+        """queries x chunks cosine similarities, in chunk order"""
+        np = self._np
+        centroids, offsets = self.centroids, self.offsets
+        if centroids is None or offsets is None:
+            result = np.zeros((len(queries_matrix), self.size), dtype=np.float64)
+            if self.size:
+                result[:, self.order] = self._scan(queries_matrix.T, 0, self.size).T
+            return result
+        # IVF: each query scans only its nearest lists. The other chunks score -inf,
+        # so they never outrank a scanned chunk, even one with a negative cosine
+        result = np.full((len(queries_matrix), self.size), -np.inf, dtype=np.float64)
+        probe = min(self.probe, len(centroids))
+        for row, query in enumerate(queries_matrix):
+            for list_id in partition_top(centroids @ query, probe).tolist():
+                start, end = int(offsets[list_id]), int(offsets[list_id + 1])
+                if end > start:
+                    result[row, self.order[start:end]] = self._scan(query[:, None], start, end)[:, 0]
+        return result
+
+    def similarities(self, query, query_vector=None):
+        """Cosine similarity of the query against every chunk, as a numpy array"""
+        matrix = self._dense_queries([query], None if query_vector is None else [query_vector])
+        return self._scores(matrix)[0]
+
+    def similarity_matrix(self, queries, query_vectors=None):
+        """Cosine similarities of several queries at once, one row per query"""
+        return self._scores(self._dense_queries(queries, query_vectors))
+
+    def stats(self):
+        return {
+            'model': self.model.name,
+            'dimensions': self.model.dimensions,
+            'chunks': self.size,
+            'store': self.store,
+            'store_bytes': int(self.codes.nbytes + self.scales.nbytes),
+            'ivf_lists': 0 if self.centroids is None else len(self.centroids),
+            'ivf_probe': self.probe
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from _service import chunk_knowledge_base, find_knowledge_base_path, load_knowledge_base
+
+    parser = argparse.ArgumentParser(description="Precompute the dense retrieval store for knowledge-base.json")
+    parser.add_argument('command', choices=['build', 'info'])
+    parser.add_argument('--model', default=MODEL_PATH, help="embedding model directory (default: CHAT_EMBEDDING_MODEL)")
+    parser.add_argument('--out', default=STORE_PATH, help="store path (default: CHAT_DENSE_STORE)")
+    parser.add_argument('--ivf-lists', type=int, default=IVF_LISTS)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'info':
+            print(json.dumps(read_header(args.out, STORE_MAGIC, STORE_VERSION), indent=2))
+            sys.exit(0)
+        kb_path = find_knowledge_base_path()
+        if not kb_path:
+            sys.exit('knowledge-base.json not found')
+        started = time.perf_counter()
+        kb_chunks = chunk_knowledge_base(load_knowledge_base(kb_path))
+        backend = DenseBackend([chunk['text'] for chunk in kb_chunks], load_model(args.model), args.out, args.ivf_lists)
+    except (ArtifactError, EmbeddingError) as e:
+        sys.exit(str(e))
+    stats = backend.stats()
+    print(f"{stats['store'].capitalize()} {args.out}: {stats['chunks']} chunks x {stats['dimensions']} dimensions, "
+          f"{stats['store_bytes']} bytes of int8 codes and scales, {stats['ivf_lists']} IVF lists "
+          f"in {(time.perf_counter() - started) * 1000:.1f}ms")
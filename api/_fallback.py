@@ -0,0 +1,78 @@
+"""
+Extractive fallback answers for the chatbot
+When OpenAI is too slow or unavailable, answer from the retrieved chunks alone:
+pick the sentences that best match the question and fill a short template per
+knowledge base section, so the visitor still gets something useful in time
+"""
+import os
+import re
+
+from _retrieval import tokenize
+
+# Answer from the chunks when OpenAI fails or misses the request deadline
+FALLBACK_ENABLED = os.environ.get('CHAT_FALLBACK', '1') not in ('0', 'false', 'no')
+# Time kept back from the upstream call to build and send the fallback
+RESERVE_SECONDS = float(os.environ.get('CHAT_FALLBACK_RESERVE', '0.5'))
+
+# Chunks and sentences per chunk that go into a fallback answer
+MAX_CHUNKS = 3
+MAX_SENTENCES = 2
+
+TEMPLATES = {
+    'about': "{text}",
+    'skills': "His skills include: {text}",
+    'experience': "From his work experience: {text}",
+    'projects': "From his projects: {text}",
+    'education': "{text}",
+}
+DEFAULT_TEMPLATE = "From his portfolio: {text}"
+
+NOTICE = ("(I'm answering in a limited mode right now, straight from the portfolio. "
+          "Please try again in a moment for a fuller reply.)")
+NO_CONTEXT = ("I'm having trouble reaching my language model right now. Please try again "
+              "in a moment, or have a look at the portfolio sections on this page.")
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9])')
+
+
+def _sentence(text):
+    """Text as a sentence; a bare label ("Skills:") says nothing and is dropped"""
+    text = text.strip()
+    if text.endswith(':'):
+        return ''
+    if not text or text[-1] in '.!?' or text.split()[-1].startswith('http'):
+        return text
+    return text + '.'
+
+
+def _best_sentences(query_terms, candidates, limit):
+    """Up to limit candidates with the most query terms, kept in their original order"""
+    scored = [
+        (len(query_terms & set(tokenize(sentence))), -i, sentence)
+        for i, sentence in enumerate(candidates)
+    ]
+    best = sorted(scored, reverse=True)[:limit]
+    return [sentence for _, _, sentence in sorted(best, key=lambda s: -s[1])]
+
+
+def fallback_answer(query, chunks, max_chunks=MAX_CHUNKS, max_sentences=MAX_SENTENCES):
+    """Answer text built only from retrieved chunks (best-ranked first)"""
+    if not chunks:
+        return NO_CONTEXT
+    query_terms = set(tokenize(query))
+    paragraphs = []
+    for chunk in chunks[:max_chunks]:
+        # Merged chunks keep their parent heading and children separately
+        parts = chunk.get('parts')
+        if parts:
+            heading, candidates = _sentence(parts[0]), [_sentence(p) for p in parts[1:]]
+        else:
+            heading, candidates = '', [_sentence(s) for s in _SENTENCE_END.split(chunk['text'])]
+        picked = _best_sentences(query_terms, [c for c in candidates if c], max_sentences)
+        text = ' '.join(s for s in [heading] + picked if s)
+        if text:
+            template = TEMPLATES.get(chunk.get('source'), DEFAULT_TEMPLATE)
+            paragraphs.append(template.format(text=text))
+    if not paragraphs:
+        return NO_CONTEXT
+    return '\n\n'.join(paragraphs + [NOTICE])
@@ -0,0 +1,167 @@
+"""
+Memory profiling for long-running chat servers
+Opt-in (CHAT_MEMPROFILE=1): tracemalloc snapshots diffed every N requests and
+logged as the fastest-growing allocation sites, plus allocations kept by each
+pipeline stage. Resident set size (RSS) growth is reported either way.
+"""
+import json
+import os
+import sys
+import threading
+import tracemalloc
+from typing import Optional
+
+from _metrics import LOG_JSON, set_allocation_probe
+
+MEMPROFILE_ENABLED = os.environ.get('CHAT_MEMPROFILE', '0') not in ('0', 'false', 'no')
+# Requests between two tracemalloc snapshots
+SNAPSHOT_EVERY = int(os.environ.get('CHAT_MEMPROFILE_EVERY', '1000'))
+# Stack frames kept per traced allocation; more frames cost memory and time
+TRACE_FRAMES = int(os.environ.get('CHAT_MEMPROFILE_FRAMES', '1'))
+
+# Allocation sites reported per snapshot diff
+TOP_SITES = 10
+
+# Allocations made by the profiler itself and the import machinery
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def rss_bytes():
+    """Resident set size of this process in bytes, or None where it can't be read"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Only the peak is available here: kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def allocation_probe():
+    """(live memory blocks, traced bytes); the change across a stage is what it kept
+
+    Both counters are process-wide, so with several worker threads a stage is
+    also charged for what other requests allocated meanwhile.
+    """
+    return sys.getallocatedblocks(), tracemalloc.get_traced_memory()[0]
+
+
+class MemoryProfiler:
+    """RSS growth per request, and tracemalloc snapshot diffs when enabled"""
+
+    def __init__(self, enabled=MEMPROFILE_ENABLED, every=SNAPSHOT_EVERY, frames=TRACE_FRAMES):
+        self.enabled = enabled
+        self.every = max(1, every)
+        self.frames = frames
+        self.requests = 0
+        self.snapshots = 0
+        self.last_report = None
+        self._baseline = (rss_bytes(), 0)  # (RSS, requests) when the server became ready
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+
+    def start(self):
+        """Mark the warm server as the baseline, and start tracing if enabled"""
+        if self.enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            set_allocation_probe(allocation_probe)
+            self._previous = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        with self._lock:
+            self._baseline = (rss_bytes(), self.requests)
+
+    def request_done(self):
+        """Count a finished request; every `every` requests, diff a new snapshot"""
+        with self._lock:
+            self.requests += 1
+            due = self._previous is not None and self.requests % self.every == 0
+        # One snapshot at a time; a request arriving meanwhile just skips it
+        if due and self._snapshot_lock.acquire(blocking=False):
+            try:
+                self.snapshot()
+            finally:
+                self._snapshot_lock.release()
+
+    def snapshot(self):
+        """Diff a tracemalloc snapshot against the previous one and log the top growth"""
+        previous = self._previous
+        if previous is None:
+            raise RuntimeError('Memory profiling is not started')
+        current = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        growth = [s for s in current.compare_to(previous, 'lineno') if s.size_diff > 0]
+        self._previous = current
+        traced, peak = tracemalloc.get_traced_memory()
+        report = dict(self.rss_report(), **{
+            'traced_bytes': traced,
+            'traced_peak_bytes': peak,
+            'top_growth': [
+                {
+                    'site': f'{s.traceback[0].filename}:{s.traceback[0].lineno}',
+                    'size_diff': s.size_diff,
+                    'count_diff': s.count_diff
+                }
+                for s in growth[:TOP_SITES]
+            ]
+        })
+        self.snapshots += 1
+        self.last_report = report
+        if LOG_JSON:
+            print(json.dumps({'event': 'memory_snapshot', **report}), flush=True)
+        return report
+
+    def rss_report(self):
+        """Current RSS and its growth since the server became ready"""
+        rss = rss_bytes()
+        with self._lock:
+            (baseline_rss, baseline_requests), requests = self._baseline, self.requests
+        served = requests - baseline_requests
+        growth = rss - baseline_rss if rss is not None and baseline_rss is not None else None
+        return {
+            'requests': requests,
+            'rss_bytes': rss,
+            'rss_growth_bytes': growth,
+            'rss_growth_per_request_bytes': round(growth / served, 1) if growth is not None and served else None
+        }
+
+    def gauges(self):
+        """Gauges for /metrics, in MetricsRegistry.render_prometheus's extra_gauges form"""
+        report = self.rss_report()
+        gauges = {}
+        if report['rss_bytes'] is not None:
+            gauges['process_resident_memory_bytes'] = (report['rss_bytes'], 'Resident set size in bytes')
+        if report['rss_growth_bytes'] is not None:
+            gauges['chat_rss_growth_bytes'] = (report['rss_growth_bytes'], 'RSS growth since the server became ready')
+        if report['rss_growth_per_request_bytes'] is not None:
+            gauges['chat_rss_growth_per_request_bytes'] = (
+                report['rss_growth_per_request_bytes'], 'RSS growth per request served since the server became ready'
+            )
+        if tracemalloc.is_tracing():
+            traced, peak = tracemalloc.get_traced_memory()
+            gauges['chat_traced_memory_bytes'] = (traced, 'Memory allocated by Python and still live (tracemalloc)')
+            gauges['chat_traced_memory_peak_bytes'] = (peak, 'Peak traced memory (tracemalloc)')
+        return gauges
+
+    def stats(self):
+        """State for the diagnostics endpoint"""
+        return {
+            'enabled': self.enabled,
+            'snapshot_every': self.every,
+            'snapshots': self.snapshots,
+            **self.rss_report(),
+            'last_snapshot': self.last_report
+        }
+
+
+# Process-wide profiler; local_server.py starts it once the server is warm
+memory_profiler = MemoryProfiler()
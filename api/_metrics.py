@@ -0,0 +1,247 @@
+"""
+Latency and usage metrics for the chatbot
+Per-request stage timers (Server-Timing, JSON log lines) and process-wide
+aggregates rendered in Prometheus text format
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+# Emit one structured JSON log line per chat request
+LOG_JSON = os.environ.get('CHAT_LOG_JSON', '1') not in ('0', 'false', 'no')
+
+# Samples kept per summary for quantile estimates (a sliding window)
+SUMMARY_WINDOW = int(os.environ.get('CHAT_METRICS_WINDOW', '2048'))
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Set by the memory profiler: returns (blocks, bytes) counters to diff across each stage
+_probe: Optional[Callable[[], Tuple[int, int]]] = None
+
+
+def set_allocation_probe(probe):
+    """Diff probe()'s counters across every timed stage from now on (None to stop)"""
+    global _probe
+    _probe = probe
+
+
+class RequestTimer:
+    """Wall-clock durations of the stages of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+        self.allocations = {}  # stage -> [blocks, bytes] kept, when profiling
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block; repeated stages accumulate"""
+        probe = _probe
+        before = probe() if probe is not None else None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+            if probe is not None and before is not None:
+                after = probe()
+                kept = self.allocations.setdefault(name, [0, 0])
+                kept[0] += after[0] - before[0]
+                kept[1] += after[1] - before[1]
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing header value, durations in milliseconds"""
+        parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items()]
+        parts.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(parts)
+
+
+class Summary:
+    """Count, sum and sliding-window quantiles of observed values"""
+
+    def __init__(self, window=SUMMARY_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self._window = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self._window.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self._window)
+        if not ordered:
+            return {q: None for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class MetricsRegistry:
+    """Thread-safe counters and summaries for one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}   # (name, labels) -> value
+        self._summaries = {}  # (name, labels) -> Summary
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary()
+            summary.observe(value)
+
+    def record_request(self, timer, status):
+        """Fold one finished request into the aggregates and log it"""
+        total = timer.elapsed()
+        self.inc('chat_requests_total', status=status)
+        self.observe('chat_request_duration_seconds', total)
+        for stage, seconds in timer.stages.items():
+            self.observe('chat_stage_duration_seconds', seconds, stage=stage)
+        for stage, (blocks, size) in timer.allocations.items():
+            self.observe('chat_stage_alloc_blocks', blocks, stage=stage)
+            self.observe('chat_stage_alloc_bytes', size, stage=stage)
+
+        fields = timer.fields
+        cache = fields.get('cache')
+        if cache:
+            self.inc('chat_cache_hits_total', tier=cache)
+        elif 'cache' in fields:
+            self.inc('chat_cache_misses_total')
+        if fields.get('degraded'):
+            self.inc('chat_degraded_total', reason=fields['degraded'])
+        if fields.get('admission'):
+            self.inc('chat_admission_total', outcome=fields['admission'])
+        if fields.get('coalesced'):
+            self.inc('chat_coalesced_total', role=fields['coalesced'])
+        if fields.get('retries'):
+            self.inc('chat_upstream_retries_total', fields['retries'])
+        if fields.get('prompt_tokens_saved'):
+            self.inc('chat_prompt_tokens_saved_total', fields['prompt_tokens_saved'])
+        for kind in ('prompt', 'completion'):
+            tokens = fields.get(f'{kind}_tokens')
+            if tokens:
+                self.inc('chat_tokens_total', tokens, kind=kind)
+                self.observe('chat_tokens_per_request', tokens, kind=kind)
+
+        if LOG_JSON:
+            print(json.dumps({
+                'event': 'chat_request',
+                'status': status,
+                'total_ms': round(total * 1000, 2),
+                'stages_ms': {name: round(s * 1000, 2) for name, s in timer.stages.items()},
+                **fields
+            }), flush=True)
+
+    def record_batch(self, timer, status):
+        """Fold one finished batch request into the aggregates and log it
+
+        Its items are recorded one by one with record_request().
+        """
+        total = timer.elapsed()
+        self.inc('chat_batch_requests_total', status=status)
+        self.observe('chat_batch_duration_seconds', total)
+        if timer.fields.get('batch_items'):
+            self.inc('chat_batch_items_total', timer.fields['batch_items'])
+
+        if LOG_JSON:
+            print(json.dumps({
+                'event': 'chat_batch',
+                'status': status,
+                'total_ms': round(total * 1000, 2),
+                'stages_ms': {name: round(s * 1000, 2) for name, s in timer.stages.items()},
+                **timer.fields
+            }), flush=True)
+
+    def snapshot(self):
+        """Stage quantiles in milliseconds, for the JSON diagnostics endpoint"""
+        with self._lock:
+            result = {}
+            for (name, labels), summary in self._summaries.items():
+                if not name.endswith('_seconds'):
+                    continue
+                label = dict(labels).get('stage') or ('batch' if name.startswith('chat_batch') else 'total')
+                result[label] = {
+                    f'p{int(q * 100)}': round(v * 1000, 2) if v is not None else None
+                    for q, v in summary.quantiles().items()
+                }
+                result[label]['count'] = summary.count
+            return result
+
+    def render_prometheus(self, extra_gauges=None):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        described = set()
+
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._help.get(name, (default_kind, name))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                header(name, 'counter')
+                lines.append(f'{name}{_labels(labels)} {value}')
+            for (name, labels), summary in sorted(self._summaries.items()):
+                header(name, 'summary')
+                for q, v in summary.quantiles().items():
+                    if v is not None:
+                        lines.append(f'{name}{_labels(labels + (("quantile", q),))} {v:.6f}')
+                lines.append(f'{name}_sum{_labels(labels)} {summary.total:.6f}')
+                lines.append(f'{name}_count{_labels(labels)} {summary.count}')
+
+        for name, (value, text) in (extra_gauges or {}).items():
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry shared by every request handler
+metrics = MetricsRegistry()
+metrics.describe('chat_requests_total', 'counter', 'Chat requests by HTTP status')
+metrics.describe('chat_request_duration_seconds', 'summary', 'End-to-end chat request latency')
+metrics.describe('chat_stage_duration_seconds', 'summary', 'Chat pipeline latency by stage')
+metrics.describe('chat_stage_alloc_blocks', 'summary', 'Memory blocks kept per stage (memory profiling only)')
+metrics.describe('chat_stage_alloc_bytes', 'summary', 'Traced bytes kept per stage (memory profiling only)')
+metrics.describe('chat_cache_hits_total', 'counter', 'Answers served from cache by tier')
+metrics.describe('chat_cache_misses_total', 'counter', 'Requests that missed every cache tier')
+metrics.describe('chat_degraded_total', 'counter', 'Fallback answers built without OpenAI, by reason')
+metrics.describe('chat_admission_total', 'counter', 'Upstream admission decisions by outcome')
+metrics.describe('chat_coalesced_total', 'counter', 'Requests by single-flight role (leader, follower, overflow)')
+metrics.describe('chat_batch_requests_total', 'counter', 'Batch chat requests by HTTP status')
+metrics.describe('chat_batch_duration_seconds', 'summary', 'End-to-end batch request latency')
+metrics.describe('chat_batch_items_total', 'counter', 'Questions received in batch requests')
+metrics.describe('chat_upstream_retries_total', 'counter', 'Upstream completion retries')
+metrics.describe('chat_tokens_total', 'counter', 'OpenAI tokens by kind')
+metrics.describe('chat_prompt_tokens_saved_total', 'counter', 'Prompt tokens removed by budgeted assembly')
+metrics.describe('chat_tokens_per_request', 'summary', 'OpenAI tokens per request by kind')
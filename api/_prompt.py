@@ -0,0 +1,288 @@
+"""
+Token-budgeted prompt assembly for the chatbot
+Fits the system prompt, retrieved context and conversation history into a fixed
+token budget: context already quoted in history is dropped, long turns are
+truncated and older turns are folded into a cached extractive summary
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from _cache import history_fingerprint
+
+# Defaults, overridable through environment variables
+PROMPT_BUDGET = int(os.environ.get('CHAT_PROMPT_BUDGET', '1500'))
+TURN_MAX_TOKENS = int(os.environ.get('CHAT_TURN_MAX_TOKENS', '300'))
+SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', '150'))
+SUMMARY_CACHE_SIZE = int(os.environ.get('CHAT_SUMMARY_CACHE_SIZE', '256'))
+# 'estimate' (about 4 characters per token) or 'tiktoken' (exact, needs the
+# tiktoken package and its encoding files)
+TOKENIZER = os.environ.get('CHAT_TOKENIZER', 'estimate').lower()
+
+# Share of the free budget reserved for retrieved context before history is added
+CONTEXT_SHARE = 0.6
+# A chunk counts as already quoted when this share of its word 8-grams is in history
+QUOTED_OVERLAP = 0.5
+SHINGLE_SIZE = 8
+
+# Chat format overhead: tokens per message plus the reply primer
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMER_TOKENS = 3
+
+_WORD = re.compile(r"[a-z0-9']+")
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+# tiktoken.Encoding once loaded; stays None when tiktoken can't be used
+_encoder = None
+_encoder_loaded = False
+
+
+def _tiktoken_encoder():
+    """The gpt-3.5-turbo encoding, or None if tiktoken is unavailable or not selected"""
+    global _encoder, _encoder_loaded
+    if TOKENIZER != 'tiktoken':
+        return None
+    if not _encoder_loaded:
+        try:
+            import tiktoken
+            _encoder = tiktoken.encoding_for_model('gpt-3.5-turbo')
+        except Exception:
+            # Missing package or encoding file - fall back to the estimate
+            _encoder = None
+        _encoder_loaded = True
+    return _encoder
+
+
+@lru_cache(maxsize=1024)
+def _tiktoken_count(text):
+    encoder = _tiktoken_encoder()
+    return len(encoder.encode(text)) if encoder is not None else (len(text) + 3) // 4
+
+
+def count_tokens(text):
+    """Number of tokens in a string"""
+    if not text:
+        return 0
+    if _tiktoken_encoder() is not None:
+        return _tiktoken_count(text)
+    return (len(text) + 3) // 4
+
+
+def message_tokens(messages):
+    """Prompt tokens of an OpenAI message list"""
+    return sum(count_tokens(m.get('content', '')) + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_PRIMER_TOKENS
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to roughly max_tokens, preferring a sentence boundary"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoder = _tiktoken_encoder()
+    if encoder is not None:
+        prefix = encoder.decode(encoder.encode(text)[:max(0, max_tokens - 1)])
+    else:
+        prefix = text[:max(0, max_tokens - 1) * 4]
+    sentence_end = max(prefix.rfind('. '), prefix.rfind('! '), prefix.rfind('? '))
+    if sentence_end > len(prefix) // 2:
+        prefix = prefix[:sentence_end + 1]
+    return prefix.rstrip() + '…'
+
+
+def _shingles(text):
+    words = _WORD.findall(text.lower())
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+
+
+def _first_sentence(text, max_words):
+    sentence = _SENTENCE_END.split(text.strip(), 1)[0]
+    words = sentence.split()
+    if len(words) > max_words:
+        return ' '.join(words[:max_words]) + '…'
+    return sentence
+
+
+class PromptBuilder:
+    """Chooses the context chunks and history turns that fit the token budget
+
+    The wording of the prompt belongs to the caller: render(message, history,
+    chunks, summary) must return the OpenAI message list for a selection.
+    """
+
+    def __init__(self, budget=PROMPT_BUDGET, turn_max_tokens=TURN_MAX_TOKENS,
+                 summary_max_tokens=SUMMARY_MAX_TOKENS, summary_cache_size=SUMMARY_CACHE_SIZE):
+        self.budget = budget
+        self.turn_max_tokens = turn_max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_cache_size = summary_cache_size
+        self._summaries = OrderedDict()  # prefix fingerprint -> summary text
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.compacted = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.chunks_deduped = 0
+        self.summary_hits = 0
+        self.summary_misses = 0
+
+    def build(self, message, history, chunks, render):
+        """Return (messages, report) for chunks ranked best-first"""
+        turns = [
+            {'role': msg['role'], 'content': msg.get('content', '')}
+            for msg in history
+            if isinstance(msg, dict) and msg.get('role') in ['user', 'assistant']
+        ]
+        before = message_tokens(render(message, turns, chunks, None))
+        report = {'tokens_before': before, 'chunks_deduped': 0, 'chunks_dropped': 0,
+                  'turns_truncated': 0, 'turns_summarized': 0}
+
+        # Context the visitor has already been shown is only repeated tokens
+        quoted = set()
+        for turn in turns:
+            quoted |= _shingles(turn['content'])
+        kept_chunks = []
+        for chunk in chunks:
+            shingles = _shingles(chunk['text'])
+            if turns and len(shingles & quoted) >= QUOTED_OVERLAP * len(shingles):
+                report['chunks_deduped'] += 1
+            else:
+                kept_chunks.append(chunk)
+        if not kept_chunks and chunks:
+            # Keep the best chunk so the prompt never loses its grounding
+            kept_chunks = chunks[:1]
+            report['chunks_deduped'] -= 1
+
+        messages = render(message, turns, kept_chunks, None)
+        if message_tokens(messages) > self.budget:
+            messages = self._fit(message, turns, kept_chunks, render, report)
+
+        report['tokens_after'] = message_tokens(messages)
+        report['tokens_saved'] = report['tokens_before'] - report['tokens_after']
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += report['tokens_before']
+            self.tokens_after += report['tokens_after']
+            self.chunks_deduped += report['chunks_deduped']
+            if report['tokens_saved'] > 0:
+                self.compacted += 1
+        return messages, report
+
+    def _fit(self, message, turns, chunks, render, report):
+        """Trim context and history until the rendered prompt fits the budget"""
+        fixed = message_tokens(render(message, [], chunks[:1], None))
+        available = max(0, self.budget - fixed)
+
+        # Best-ranked chunks first, up to the context share (the top chunk is in `fixed`)
+        context_budget = int(available * CONTEXT_SHARE)
+        selected, used = chunks[:1], 0
+        for chunk in chunks[1:]:
+            cost = count_tokens(chunk['text']) + 1
+            if used + cost > context_budget:
+                break
+            selected.append(chunk)
+            used += cost
+
+        # Newest turns verbatim, capped per turn; older turns go into the summary
+        history_budget = available - used
+        recent, history_used = [], 0
+        for turn in reversed(turns):
+            content = turn['content']
+            truncated = count_tokens(content) > self.turn_max_tokens
+            if truncated:
+                content = truncate_to_tokens(content, self.turn_max_tokens)
+            cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if history_used + cost > history_budget:
+                break
+            recent.insert(0, {'role': turn['role'], 'content': content})
+            history_used += cost
+            report['turns_truncated'] += truncated
+        older = turns[:len(turns) - len(recent)]
+
+        summary = None
+        if older:
+            report['turns_summarized'] = len(older)
+            summary_budget = min(self.summary_max_tokens, history_budget - history_used - MESSAGE_OVERHEAD_TOKENS)
+            # Make room for a summary by giving up the oldest verbatim turn if needed
+            while summary_budget < 20 and recent:
+                dropped = recent.pop(0)
+                older.append(dropped)
+                history_used -= count_tokens(dropped['content']) + MESSAGE_OVERHEAD_TOKENS
+                summary_budget = min(self.summary_max_tokens, history_budget - history_used - MESSAGE_OVERHEAD_TOKENS)
+                report['turns_summarized'] += 1
+            if summary_budget >= 20:
+                summary = truncate_to_tokens(self.summarize(older), summary_budget)
+                history_used += count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+
+        # Hand anything history did not need back to lower-ranked context
+        spare = history_budget - history_used
+        for chunk in chunks[len(selected):]:
+            cost = count_tokens(chunk['text']) + 1
+            if cost > spare:
+                break
+            selected.append(chunk)
+            spare -= cost
+        report['chunks_dropped'] = len(chunks) - len(selected)
+
+        messages = render(message, recent, selected, summary)
+        # The per-part accounting is approximate; trim until the whole prompt fits
+        while message_tokens(messages) > self.budget and (recent or summary or len(selected) > 1):
+            if recent:
+                # Fold the oldest verbatim turn into the summary
+                older.append(turns[len(turns) - len(recent)])
+                recent.pop(0)
+                report['turns_summarized'] = len(older)
+                summary = truncate_to_tokens(self.summarize(older), self.summary_max_tokens)
+            elif summary:
+                summary = None
+            else:
+                selected.pop()
+                report['chunks_dropped'] += 1
+            messages = render(message, recent, selected, summary)
+        return messages
+
+    def summarize(self, turns):
+        """Extractive summary of older turns, cached by their content"""
+        key = history_fingerprint(turns)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+                self.summary_hits += 1
+                return summary
+            self.summary_misses += 1
+
+        lines = []
+        for turn in turns:
+            if turn['role'] == 'user':
+                lines.append(f"The visitor asked: {_first_sentence(turn['content'], 25)}")
+            else:
+                lines.append(f"You answered: {_first_sentence(turn['content'], 30)}")
+        # Drop the oldest lines first so the most recent context survives
+        while len(lines) > 1 and count_tokens('\n'.join(lines)) > self.summary_max_tokens:
+            lines.pop(0)
+        summary = '\n'.join(lines)
+
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.summary_cache_size:
+                self._summaries.popitem(last=False)
+        return summary
+
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            return {
+                'budget_tokens': self.budget,
+                'tokenizer': TOKENIZER,
+                'requests': self.requests,
+                'compacted_requests': self.compacted,
+                'avg_tokens_before': round(self.tokens_before / self.requests, 1) if self.requests else None,
+                'avg_tokens_after': round(self.tokens_after / self.requests, 1) if self.requests else None,
+                'tokens_saved': self.tokens_before - self.tokens_after,
+                'reduction': round(1 - self.tokens_after / self.tokens_before, 3) if self.tokens_before else None,
+                'chunks_deduped': self.chunks_deduped,
+                'summaries_cached': len(self._summaries),
+                'summary_hits': self.summary_hits,
+                'summary_misses': self.summary_misses
+            }
@@ -0,0 +1,147 @@
+"""
+Knowledge base hot reload for long-running servers
+A watcher thread polls knowledge-base.json and, once an edit has settled, has
+the new version parsed, chunked, indexed and validated off the request path.
+The caller then swaps it in (read-copy-update): requests already running
+finish on the index they started with.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from _metrics import LOG_JSON
+from _retrieval import PARITY_QUERIES
+
+# Seconds between two looks at the knowledge base file; 0 turns the watcher off
+WATCH_INTERVAL = float(os.environ.get('CHAT_KB_WATCH_INTERVAL', '1'))
+
+
+class KnowledgeBaseError(Exception):
+    """The knowledge base can't be parsed or would not serve requests"""
+
+
+def read_knowledge_base(file_path):
+    """(parsed knowledge base, SHA-256 of exactly the bytes parsed)"""
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise KnowledgeBaseError(f'Cannot read {file_path}: {e}')
+    try:
+        kb = json.loads(data)
+    except ValueError as e:
+        # Often a save still in progress; the next edit event retries
+        raise KnowledgeBaseError(f'Invalid JSON: {e}')
+    return kb, hashlib.sha256(data).hexdigest()
+
+
+def validate_index(kb, index, probes=PARITY_QUERIES):
+    """Raise KnowledgeBaseError unless the knowledge base and its index can serve requests"""
+    if not isinstance(kb, dict) or not kb:
+        raise KnowledgeBaseError('The knowledge base must be a non-empty JSON object')
+    if not index.chunks:
+        raise KnowledgeBaseError('The knowledge base produced no chunks')
+    ids = [chunk['id'] for chunk in index.chunks]
+    if len(set(ids)) != len(ids):
+        duplicates = sorted({i for i in ids if ids.count(i) > 1})
+        raise KnowledgeBaseError(f'Duplicate chunk IDs: {", ".join(duplicates[:5])}')
+    empty = [chunk['id'] for chunk in index.chunks if not chunk['text'].strip()]
+    if empty:
+        raise KnowledgeBaseError(f'Empty chunks: {", ".join(empty[:5])}')
+    try:
+        retrieved = [index.search(query, 3) for query in probes]
+    except Exception as e:
+        raise KnowledgeBaseError(f'Retrieval failed: {type(e).__name__}: {e}')
+    if not any(retrieved):
+        raise KnowledgeBaseError('None of the probe questions retrieved anything')
+
+
+def diff_versions(old, new):
+    """Chunk IDs (changed, added, removed) between two RetrievalIndex.chunk_versions maps"""
+    changed = sorted(chunk_id for chunk_id in old.keys() & new.keys() if old[chunk_id] != new[chunk_id])
+    return changed, sorted(new.keys() - old.keys()), sorted(old.keys() - new.keys())
+
+
+class KnowledgeBaseWatcher:
+    """Polls the knowledge base file and calls reload() once an edit has settled
+
+    reload() returns a report dict, or None when the contents did not change,
+    and raises KnowledgeBaseError to reject the new version.
+    """
+
+    def __init__(self, path, reload, interval=WATCH_INTERVAL):
+        self.path = path
+        self.reload = reload
+        self.interval = interval
+        self.reloads = 0
+        self.rejected = 0
+        self.last_reload = None
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        """Identity of the file's current version; editors often replace the file outright"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='kb-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        seen, pending = self._stat(), None
+        while not self._stopped.wait(self.interval):
+            current = self._stat()
+            if current == seen or current is None:
+                pending = None
+                continue
+            # Editors and deploys write in several steps; wait for one quiet interval
+            if current != pending:
+                pending = current
+                continue
+            seen, pending = current, None
+            self.check()
+
+    def check(self):
+        """Reload now; a rejected or failed version leaves the serving index in place"""
+        started = time.perf_counter()
+        try:
+            report = self.reload()
+        except Exception as e:
+            self.rejected += 1
+            self.last_error = {'at': time.time(), 'error': f'{type(e).__name__}: {str(e)[:200]}'}
+            self._log('kb_reload_rejected', self.last_error)
+            return None
+        if report is None:
+            return None
+        self.reloads += 1
+        self.last_error = None
+        self.last_reload = dict(report, at=time.time(),
+                                duration_ms=round((time.perf_counter() - started) * 1000, 2))
+        self._log('kb_reload', self.last_reload)
+        return self.last_reload
+
+    def _log(self, event, fields):
+        if LOG_JSON:
+            print(json.dumps({'event': event, **fields}), flush=True)
+
+    def stats(self):
+        """State for the diagnostics endpoint"""
+        return {
+            'path': self.path,
+            'interval_seconds': self.interval,
+            'reloads': self.reloads,
+            'rejected': self.rejected,
+            'last_reload': self.last_reload,
+            'last_error': self.last_error
+        }
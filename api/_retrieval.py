@@ -0,0 +1,592 @@
+"""
+Retrieval backends for the chatbot
+Pure-Python TF-IDF and BM25 indexes, plus the original scikit-learn path, and a
+keyword index over exact names that the retrieval index blends in (hybrid scoring)
+"""
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+
+from _chunking import ChunkTree
+
+# Similarity threshold below which a chunk is not considered relevant
+SIMILARITY_THRESHOLD = 0.05
+
+# Share of the hybrid score that comes from exact keyword matches (0 disables them)
+KEYWORD_WEIGHT = float(os.environ.get('CHAT_KEYWORD_WEIGHT', '0.5'))
+
+# How much a keyword match counts, by the chunk field it was found in
+FIELD_BOOSTS = {
+    'title': 2.0,
+    'company': 2.0,
+    'institution': 2.0,
+    'name': 1.5,
+    'technologies': 1.5,
+    'skills': 1.5,
+    'role': 1.2,
+    'category': 1.2,
+    'coursework': 1.2,
+    'location': 1.0,
+    'text': 1.0,
+    'section': 0.5,
+}
+
+# Candidates scoring below this share of the best one stay out of the prompt
+RELATIVE_CUTOFF = 0.3
+# Candidates considered per requested result before merging under parents
+CANDIDATES_PER_RESULT = 3
+
+# Score vectors at least this long are ranked with numpy's argpartition
+PARTITION_MIN_SIZE = 1000
+
+# Vocabulary size used by the original TfidfVectorizer setup
+MAX_FEATURES = 100
+
+# Same tokenisation as scikit-learn's default token_pattern
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+# scikit-learn's ENGLISH_STOP_WORDS, copied so the hot path does not import sklearn
+ENGLISH_STOP_WORDS = frozenset("""
+    a about above across after afterwards again against all almost alone
+    along already also although always am among amongst amoungst amount
+    an and another any anyhow anyone anything anyway anywhere are around
+    as at back be became because become becomes becoming been before
+    beforehand behind being below beside besides between beyond bill
+    both bottom but by call can cannot cant co con could couldnt cry de
+    describe detail do done down due during each eg eight either eleven
+    else elsewhere empty enough etc even ever every everyone everything
+    everywhere except few fifteen fifty fill find fire first five for
+    former formerly forty found four from front full further get give go
+    had has hasnt have he hence her here hereafter hereby herein
+    hereupon hers herself him himself his how however hundred i ie if in
+    inc indeed interest into is it its itself keep last latter latterly
+    least less ltd made many may me meanwhile might mill mine more
+    moreover most mostly move much must my myself name namely neither
+    never nevertheless next nine no nobody none noone nor not nothing
+    now nowhere of off often on once one only onto or other others
+    otherwise our ours ourselves out over own part per perhaps please
+    put rather re same see seem seemed seeming seems serious several she
+    should show side since sincere six sixty so some somehow someone
+    something sometime sometimes somewhere still such system take ten
+    than that the their them themselves then thence there thereafter
+    thereby therefore therein thereupon these they thick thin third this
+    those though three through throughout thru thus to together too top
+    toward towards twelve twenty two un under until up upon us very via
+    was we well were what whatever when whence whenever where whereafter
+    whereas whereby wherein whereupon wherever whether which while
+    whither who whoever whole whom whose why will with within without
+    would yet you your yours yourself yourselves
+""".split())
+
+
+def tokenize(text):
+    """Lowercase, split into word tokens and drop English stop words"""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in ENGLISH_STOP_WORDS]
+
+
+def build_vocabulary(token_lists, max_features=MAX_FEATURES):
+    """Pick the max_features most frequent terms, ties broken alphabetically"""
+    totals = Counter()
+    for tokens in token_lists:
+        totals.update(tokens)
+    terms = sorted(totals)
+    if max_features is not None and len(terms) > max_features:
+        terms = sorted(sorted(terms, key=lambda t: -totals[t])[:max_features])
+    return {term: i for i, term in enumerate(terms)}
+
+
+def dense_matrix(postings, vocabulary, size):
+    """Chunks x terms numpy matrix from an inverted index"""
+    import numpy as np
+    
+    matrix = np.zeros((size, len(vocabulary)))
+    for term, entries in postings.items():
+        column = vocabulary[term]
+        for doc_id, weight in entries:
+            matrix[doc_id, column] = weight
+    return matrix
+
+
+def query_matrix(query_vectors, vocabulary):
+    """Queries x terms numpy matrix from sparse {term: weight} query vectors"""
+    import numpy as np
+    
+    matrix = np.zeros((len(query_vectors), len(vocabulary)))
+    for row, vector in enumerate(query_vectors):
+        for term, weight in vector.items():
+            matrix[row, vocabulary[term]] = weight
+    return matrix
+
+
+class TfidfBackend:
+    """Pure-Python TF-IDF with an inverted index, matching TfidfVectorizer defaults"""
+    
+    name = 'tfidf'
+    
+    def __init__(self, texts, max_features=MAX_FEATURES):
+        token_lists = [tokenize(text) for text in texts]
+        self.size = len(texts)
+        self.vocabulary = build_vocabulary(token_lists, max_features)
+        
+        # Smoothed IDF: ln((1 + n) / (1 + df)) + 1
+        df = Counter()
+        for tokens in token_lists:
+            df.update({t for t in tokens if t in self.vocabulary})
+        self.idf = {
+            term: math.log((1 + self.size) / (1 + df[term])) + 1
+            for term in self.vocabulary
+        }
+        
+        # Inverted index: term -> [(chunk index, L2-normalised weight)]
+        self.postings = {term: [] for term in self.vocabulary}
+        for doc_id, tokens in enumerate(token_lists):
+            weights = self._weights(tokens)
+            for term, weight in weights.items():
+                self.postings[term].append((doc_id, weight))
+        self._documents = None
+    
+    def _weights(self, tokens):
+        """L2-normalised TF-IDF weights for a token list"""
+        counts = Counter(t for t in tokens if t in self.vocabulary)
+        weights = {term: count * self.idf[term] for term, count in counts.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm:
+            return {}
+        return {term: w / norm for term, w in weights.items()}
+    
+    def query_vector(self, query):
+        """Sparse {term: weight} vector for a query"""
+        return self._weights(tokenize(query))
+    
+    def similarities(self, query, query_vector=None):
+        """Cosine similarity of the query against every chunk"""
+        if query_vector is None:
+            query_vector = self.query_vector(query)
+        scores = [0.0] * self.size
+        for term, q_weight in query_vector.items():
+            for doc_id, d_weight in self.postings[term]:
+                scores[doc_id] += q_weight * d_weight
+        return scores
+    
+    def document_matrix(self):
+        """Dense chunks x terms weight matrix (numpy), built on first use"""
+        if self._documents is None:
+            self._documents = dense_matrix(self.postings, self.vocabulary, self.size)
+        return self._documents
+    
+    def similarity_matrix(self, queries, query_vectors=None):
+        """Cosine similarities of several queries at once, one row per query"""
+        if query_vectors is None:
+            query_vectors = [self.query_vector(query) for query in queries]
+        return query_matrix(query_vectors, self.vocabulary) @ self.document_matrix().T
+
+
+class Bm25Backend:
+    """Okapi BM25 over an inverted index, with scores scaled into [0, 1)"""
+    
+    name = 'bm25'
+    
+    def __init__(self, texts, k1=1.5, b=0.75):
+        token_lists = [tokenize(text) for text in texts]
+        self.size = len(texts)
+        self.k1 = k1
+        lengths = [len(tokens) for tokens in token_lists]
+        avg_length = (sum(lengths) / self.size) if self.size else 0.0
+        
+        df = Counter()
+        for tokens in token_lists:
+            df.update(set(tokens))
+        # BM25+ style IDF that never goes negative for common terms
+        self.idf = {
+            term: math.log(1 + (self.size - n + 0.5) / (n + 0.5))
+            for term, n in df.items()
+        }
+        self.vocabulary = {term: i for i, term in enumerate(sorted(self.idf))}
+        
+        # Inverted index: term -> [(chunk index, saturated term frequency)]
+        self.postings = {}
+        for doc_id, tokens in enumerate(token_lists):
+            norm = k1 * (1 - b + b * lengths[doc_id] / avg_length) if avg_length else k1
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, []).append(
+                    (doc_id, tf * (k1 + 1) / (tf + norm))
+                )
+        self._documents = None
+    
+    def query_vector(self, query):
+        """Sparse {term: idf} vector for the known terms of a query"""
+        return {term: self.idf[term] for term in set(tokenize(query)) if term in self.idf}
+    
+    def similarities(self, query, query_vector=None):
+        """BM25 score of every chunk, divided by the best score the query could reach"""
+        scores = [0.0] * self.size
+        terms = self.query_vector(query) if query_vector is None else query_vector
+        if not terms:
+            return scores
+        for term, idf in terms.items():
+            for doc_id, tf_weight in self.postings[term]:
+                scores[doc_id] += idf * tf_weight
+        # Each term contributes at most idf * (k1 + 1)
+        ceiling = sum(terms.values()) * (self.k1 + 1)
+        return [score / ceiling for score in scores]
+    
+    def similarity_matrix(self, queries, query_vectors=None):
+        """Scaled BM25 scores of several queries at once, one row per query"""
+        if query_vectors is None:
+            query_vectors = [self.query_vector(query) for query in queries]
+        if self._documents is None:
+            self._documents = dense_matrix(self.postings, self.vocabulary, self.size)
+        queries = query_matrix(query_vectors, self.vocabulary)
+        ceilings = queries.sum(axis=1, keepdims=True) * (self.k1 + 1)
+        ceilings[ceilings == 0] = 1.0
+        return (queries @ self._documents.T) / ceilings
+
+
+class SklearnBackend:
+    """The original scikit-learn TfidfVectorizer path"""
+    
+    name = 'sklearn'
+    
+    def __init__(self, texts, max_features=MAX_FEATURES, vocabulary=None):
+        from scipy.sparse import csr_matrix
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        
+        self.size = len(texts)
+        if vocabulary is not None:
+            max_features = None
+        self.vectorizer = TfidfVectorizer(
+            max_features=max_features, stop_words='english', vocabulary=vocabulary
+        )
+        # fit_transform/transform are typed as returning anything; pin them to CSR
+        self.matrix = csr_matrix(self.vectorizer.fit_transform(texts))
+        self.vocabulary = self.vectorizer.vocabulary_
+        self._terms = self.vectorizer.get_feature_names_out()
+    
+    def query_vector(self, query):
+        """Sparse {term: weight} vector for a query"""
+        vector = self._transform([query])
+        return {self._terms[i]: float(w) for i, w in zip(vector.indices, vector.data)}
+    
+    def similarities(self, query, query_vector=None):
+        """Cosine similarity of the query against every chunk"""
+        # TF-IDF rows are L2-normalised, so a single sparse dot product is the cosine
+        return (self.matrix @ self._transform([query]).T).toarray().ravel().tolist()
+    
+    def similarity_matrix(self, queries, query_vectors=None):
+        """Cosine similarities of several queries at once, one row per query"""
+        return (self._transform(queries) @ self.matrix.T).toarray()
+    
+    def _transform(self, texts):
+        from scipy.sparse import csr_matrix
+        
+        return csr_matrix(self.vectorizer.transform(texts))
+
+
+_KEYWORD_TOKEN = re.compile(r'\w+')
+
+
+def keyword_tokens(text):
+    """Lowercase word tokens with plurals folded, so 'projects' matches 'project'"""
+    return [
+        t[:-1] if len(t) > 3 and t.endswith('s') and not t.endswith('ss') else t
+        for t in _KEYWORD_TOKEN.findall(text.lower())
+    ]
+
+
+class KeywordIndex:
+    """Inverted index of exact phrases (technologies, companies, titles) with field boosts
+    
+    Phrases come from each chunk's 'keywords' fields. Named phrases also count,
+    at the plain 'text' boost, in any chunk whose text mentions them.
+    """
+    
+    def __init__(self, chunks):
+        self.size = len(chunks)
+        weights = [{} for _ in chunks]  # chunk -> {phrase: boost}
+        named = set()
+        for i, chunk in enumerate(chunks):
+            for field, values in (chunk.get('keywords') or {}).items():
+                boost = FIELD_BOOSTS.get(field, 1.0)
+                for value in values:
+                    phrase = tuple(keyword_tokens(value))
+                    if phrase and boost > weights[i].get(phrase, 0.0):
+                        weights[i][phrase] = boost
+                    if phrase and field != 'section':
+                        named.add(phrase)
+        self.max_words = max((len(p) for p in named), default=1)
+        for i, chunk in enumerate(chunks):
+            for phrase in self._phrases(keyword_tokens(chunk['text']), named):
+                weights[i].setdefault(phrase, FIELD_BOOSTS['text'])
+        
+        self.postings = {}
+        for i, phrase_weights in enumerate(weights):
+            for phrase, boost in phrase_weights.items():
+                self.postings.setdefault(phrase, []).append((i, boost))
+        # Rare phrases (a company name) outweigh common ones (a section word)
+        self.idf = {
+            phrase: math.log(1 + self.size / len(postings))
+            for phrase, postings in self.postings.items()
+        }
+    
+    def _phrases(self, tokens, known):
+        """Known phrases of up to max_words tokens that occur in a token list"""
+        found = set()
+        for n in range(1, self.max_words + 1):
+            for start in range(len(tokens) - n + 1):
+                phrase = tuple(tokens[start:start + n])
+                if phrase in known:
+                    found.add(phrase)
+        return found
+    
+    def scores(self, query):
+        """Keyword score of every chunk scaled to [0, 1], or None if nothing matched"""
+        matched = self._phrases(keyword_tokens(query), self.postings)
+        if not matched:
+            return None
+        scores = [0.0] * self.size
+        for phrase in matched:
+            idf = self.idf[phrase]
+            for i, boost in self.postings[phrase]:
+                scores[i] += boost * idf
+        best = max(scores)
+        return [score / best for score in scores]
+
+
+def dense_backend(texts):
+    """Embedding backend (api/_embeddings.py); needs CHAT_EMBEDDING_MODEL, imported only when used"""
+    from _embeddings import DenseBackend
+    return DenseBackend(texts)
+
+
+BACKENDS = {
+    'tfidf': TfidfBackend,
+    'bm25': Bm25Backend,
+    'sklearn': SklearnBackend,
+    'dense': dense_backend,
+}
+
+# Retrieval backend used for the warm index
+DEFAULT_BACKEND = os.environ.get('CHAT_RETRIEVAL_BACKEND', 'tfidf').lower()
+
+
+def fallback_results(chunks, top_k):
+    """Top-level chunks to return when nothing passes the similarity threshold"""
+    return [c for c in chunks if not c.get('parent')][:top_k]
+
+
+def top_indices(similarities, top_k):
+    """Indices of the top_k scores, best first (same order as argsort()[-k:][::-1])"""
+    if top_k <= 0:
+        return []
+    if len(similarities) >= PARTITION_MIN_SIZE:
+        try:
+            import numpy as np
+            return partition_top(np.asarray(similarities, dtype=np.float64), top_k).tolist()
+        except ImportError:
+            pass
+    ranked = sorted(range(len(similarities)), key=similarities.__getitem__)
+    return ranked[-top_k:][::-1]
+
+
+def partition_top(scores, top_k):
+    """top_indices() for a 1-D numpy array: argpartition (O(n)), then a sort of the top_k only"""
+    import numpy as np
+    
+    size = scores.shape[0]
+    if top_k >= size:
+        return np.argsort(scores, kind='stable')[::-1]
+    # Selecting from the low end of the negated scores: introselect degrades badly near
+    # the top of a mostly-equal array, which is what IVF's unscanned -inf scores produce
+    negated = -scores
+    kth = -negated[np.argpartition(negated, top_k - 1)[top_k - 1]]
+    # Ties at the cut go to the highest indices, as in the reversed stable sort
+    above = np.flatnonzero(scores > kth)
+    tied = np.flatnonzero(scores == kth)[::-1][:top_k - above.size]
+    chosen = np.concatenate([above, tied])
+    return chosen[np.lexsort((-chosen, -scores[chosen]))]
+
+
+class RetrievalIndex:
+    """Index over knowledge base chunks, built once and queried many times"""
+    
+    def __init__(self, chunks, fingerprint=None, backend=None):
+        backend = backend or DEFAULT_BACKEND
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown retrieval backend '{backend}'")
+        
+        self.chunks = chunks
+        self.fingerprint = fingerprint
+        # Built on the chunks only so queries never shift the index weights
+        self.backend = BACKENDS[backend]([chunk['text'] for chunk in chunks]) if chunks else None
+        self.keywords = KeywordIndex(chunks)
+        self.tree = ChunkTree(chunks)
+    
+    @classmethod
+    def from_backend(cls, chunks, backend, fingerprint=None):
+        """Wrap a backend that is already built (e.g. loaded from a compiled artifact)"""
+        index = cls.__new__(cls)
+        index.chunks = chunks
+        index.fingerprint = fingerprint
+        index.backend = backend
+        index.keywords = KeywordIndex(chunks)
+        index.tree = ChunkTree(chunks)
+        return index
+    
+    @property
+    def vocabulary(self):
+        """Term -> column mapping of the retrieval space"""
+        return self.backend.vocabulary if self.backend is not None else {}
+    
+    @property
+    def chunk_versions(self):
+        """Chunk ID -> digest of the chunk; answer caches compare these across KB edits"""
+        versions = self.__dict__.get('_chunk_versions')
+        if versions is None:
+            versions = self._chunk_versions = {
+                chunk['id']: hashlib.sha256(json.dumps(chunk, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+                for chunk in self.chunks
+            }
+        return versions
+    
+    def query_vector(self, query):
+        """Sparse {term: weight} retrieval-space vector for a query"""
+        if self.backend is None:
+            return {}
+        return self.backend.query_vector(query)
+    
+    def similarities(self, query, query_vector=None):
+        """Score of the query against every chunk"""
+        if self.backend is None:
+            return [0.0] * len(self.chunks)
+        return self.backend.similarities(query, query_vector)
+    
+    def scores(self, query, query_vector=None):
+        """Hybrid score of every chunk: vector similarity blended with keyword matches"""
+        similarities = self.similarities(query, query_vector)
+        keyword_scores = self.keywords.scores(query) if KEYWORD_WEIGHT > 0 else None
+        if keyword_scores is None:
+            return similarities
+        if not isinstance(similarities, list):
+            # A numpy row (dense backend) is blended without a Python loop
+            import numpy as np
+            return (1 - KEYWORD_WEIGHT) * similarities + KEYWORD_WEIGHT * np.asarray(keyword_scores)
+        return [
+            (1 - KEYWORD_WEIGHT) * vector + KEYWORD_WEIGHT * keyword
+            for vector, keyword in zip(similarities, keyword_scores)
+        ]
+    
+    def search(self, query, top_k=3, query_vector=None):
+        """Return up to top_k chunks for a query, children merged under their parents"""
+        if not self.chunks:
+            return []
+        scores = self.scores(query, query_vector)
+        return self._select(scores, top_indices(scores, top_k * CANDIDATES_PER_RESULT), top_k)
+    
+    def search_many(self, queries, top_k=3, query_vectors=None):
+        """search() for several queries, scored together in one matrix product"""
+        if not self.chunks or self.backend is None:
+            return [self.search(query, top_k) for query in queries]
+        if query_vectors is None:
+            query_vectors = [self.query_vector(query) for query in queries]
+        try:
+            import numpy as np
+        except ImportError:
+            return [self.search(q, top_k, v) for q, v in zip(queries, query_vectors)]
+        
+        scores = np.asarray(self.backend.similarity_matrix(queries, query_vectors), dtype=np.float64)
+        if KEYWORD_WEIGHT > 0:
+            for row, query in enumerate(queries):
+                keyword_scores = self.keywords.scores(query)
+                if keyword_scores is not None:
+                    scores[row] = (1 - KEYWORD_WEIGHT) * scores[row] + KEYWORD_WEIGHT * np.array(keyword_scores)
+        
+        # Partial sort per query: the same order top_indices() gives
+        count = top_k * CANDIDATES_PER_RESULT
+        return [self._select(row.tolist(), partition_top(row, count).tolist(), top_k) for row in scores]
+    
+    def _select(self, scores, candidates, top_k):
+        """Candidates that pass the thresholds, merged under their parents"""
+        best = scores[candidates[0]] if candidates else 0.0
+        ranked = [
+            self.chunks[idx] for idx in candidates
+            if scores[idx] > SIMILARITY_THRESHOLD and scores[idx] >= RELATIVE_CUTOFF * best
+        ]
+        
+        # If no results found, return top-level chunks anyway
+        if not ranked:
+            ranked = fallback_results(self.chunks, top_k)
+        
+        return self.tree.merge(ranked)[:top_k]
+
+
+PARITY_QUERIES = [
+    "What projects has he built?",
+    "What are his skills?",
+    "Tell me about his experience",
+    "Where did he go to school?",
+    "Has he used XGBoost?",
+    "What did he do at SNH AI?",
+    "Does he know Tableau and SQL?",
+    "Tell me about the RNA-seq analysis",
+    "What programming languages does he know?",
+    "How can I contact him?",
+    "hello",
+]
+
+
+def check_parity(chunks, queries=PARITY_QUERIES, top_k=5, tolerance=1e-9):
+    """Compare the pure-Python TF-IDF backend with scikit-learn, returning mismatches
+
+    Top-k results are compared against the stock TfidfVectorizer setup. Raw scores
+    are compared against TfidfVectorizer pinned to the same vocabulary, because
+    scikit-learn picks between equally frequent terms at the max_features cutoff
+    with numpy's unstable argsort while this module breaks those ties alphabetically.
+    Batched search (search_many) is compared against one query at a time.
+    """
+    reference = RetrievalIndex(chunks, backend='sklearn')
+    candidate = RetrievalIndex(chunks, backend='tfidf')
+    texts = [chunk['text'] for chunk in chunks]
+    pinned = SklearnBackend(texts, vocabulary=candidate.vocabulary) if chunks else None
+    
+    mismatches = []
+    for query in queries:
+        expected = [c['text'] for c in reference.search(query, top_k)]
+        actual = [c['text'] for c in candidate.search(query, top_k)]
+        if expected != actual:
+            mismatches.append({'query': query, 'expected': expected, 'actual': actual})
+        if pinned is not None:
+            drift = max(
+                abs(a - b) for a, b in zip(candidate.similarities(query), pinned.similarities(query))
+            )
+            if drift > tolerance:
+                mismatches.append({'query': query, 'score_drift': drift})
+    
+    # Batched retrieval must rank exactly like one query at a time
+    for query, results in zip(queries, candidate.search_many(queries, top_k)):
+        expected = [c['text'] for c in candidate.search(query, top_k)]
+        actual = [c['text'] for c in results]
+        if expected != actual:
+            mismatches.append({'query': query, 'expected': expected, 'actual': actual, 'batched': True})
+    return mismatches
+
+
+if __name__ == '__main__':
+    # Parity check: python api/_retrieval.py
+    import sys
+    from _service import chunk_knowledge_base, load_knowledge_base
+    
+    kb_chunks = chunk_knowledge_base(load_knowledge_base())
+    problems = check_parity(kb_chunks)
+    for problem in problems:
+        print(f"MISMATCH {problem['query']!r}")
+        if 'score_drift' in problem:
+            print(f"  score drift: {problem['score_drift']:.3g}")
+        else:
+            expected_label, actual_label = ('single', 'batched') if problem.get('batched') else ('sklearn', 'tfidf')
+            print(f"  {expected_label}: {[t[:40] for t in problem['expected']]}")
+            print(f"  {actual_label}: {[t[:40] for t in problem['actual']]}")
+    print(f"{len(PARITY_QUERIES)} queries checked, {len(problems)} mismatches against scikit-learn")
+    sys.exit(1 if problems else 0)
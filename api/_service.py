@@ -0,0 +1,1002 @@
+"""
+Chat pipeline for the chatbot, independent of any HTTP transport
+Loads the knowledge base, retrieves context and calls OpenAI; used by the
+Vercel function (api/chat.py) and local_server.py alike
+"""
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from _admission import AdmissionController, Rejected
+from _artifact import ArtifactError, artifact_path, builder_digest, load_artifact, write_artifact
+from _cache import AnswerCache, SemanticCache, chunk_set_key, chunk_versions_for, make_key
+from _chunking import chunk_knowledge_base
+from _coalesce import CoalesceTimeout, SingleFlight
+from _fallback import FALLBACK_ENABLED, RESERVE_SECONDS, fallback_answer
+from _memprofile import memory_profiler
+from _metrics import RequestTimer, metrics
+from _prompt import PromptBuilder
+from _reload import (WATCH_INTERVAL, KnowledgeBaseError, KnowledgeBaseWatcher, diff_versions, read_knowledge_base,
+                     validate_index)
+from _sessions import SessionStore, valid_session_id
+from _retrieval import DEFAULT_BACKEND, RetrievalIndex
+from _upstream import (AsyncUpstream, CircuitOpenError, Deadline, MIN_ATTEMPT_SECONDS, UpstreamError,
+                       classify_openai_error)
+
+
+def find_knowledge_base_path():
+    """Return the first existing knowledge base path, or None"""
+    # Try multiple paths for Vercel compatibility
+    base_dir = os.path.dirname(__file__)
+    possible_paths = [
+        os.path.join(base_dir, 'knowledge-base.json'),
+        os.path.join(os.path.dirname(base_dir), 'api', 'knowledge-base.json'),
+        'knowledge-base.json'
+    ]
+    for file_path in possible_paths:
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+def load_knowledge_base(file_path=None):
+    """Load the knowledge base from JSON file"""
+    try:
+        file_path = file_path or find_knowledge_base_path()
+        if file_path:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        # If file not found, return empty dict
+        return {}
+    except Exception:
+        return {}
+
+
+# Warm-process index cache, invalidated when knowledge-base.json changes
+_index_lock = threading.Lock()
+_index = None
+_index_stat = None
+_kb_path = None
+_index_source: Dict[str, Optional[str]] = {'source': None, 'artifact': None}
+# Set while a KnowledgeBaseWatcher keeps the index current (long-running servers)
+_kb_watched = False
+_reload_lock = threading.Lock()
+
+# Open the compiled artifact (api/_artifact.py) instead of indexing the JSON, and
+# recompile it when it is stale and the filesystem is writable
+USE_ARTIFACT = os.environ.get('CHAT_USE_ARTIFACT', '1') not in ('0', 'false', 'no')
+
+
+def _file_digest(file_path):
+    """SHA-256 of a file's contents"""
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _build_index(file_path, fingerprint, timer, kb=None):
+    """Index the knowledge base at file_path: the compiled artifact if current, else the JSON
+    
+    kb: the knowledge base already parsed (from exactly the bytes fingerprinted)
+    """
+    compiled = file_path is not None and USE_ARTIFACT and DEFAULT_BACKEND == 'tfidf'
+    if compiled:
+        build_digest = builder_digest('_chunking')
+        try:
+            with timer.stage('kb_load'):
+                chunks, backend = load_artifact(artifact_path(file_path), fingerprint, build_digest)
+            _index_source.update(source='artifact', artifact='loaded')
+            return RetrievalIndex.from_backend(chunks, backend, fingerprint)
+        except ArtifactError as e:
+            # Stale or missing - never serve it; index the JSON instead
+            _index_source['artifact'] = str(e)
+    
+    if kb is None:
+        with timer.stage('kb_load'):
+            kb = load_knowledge_base(file_path) if file_path else {}
+    with timer.stage('chunk'):
+        chunks = chunk_knowledge_base(kb)
+    with timer.stage('index'):
+        index = RetrievalIndex(chunks, fingerprint)
+    _index_source['source'] = 'json'
+    
+    if compiled and chunks:
+        # Recompile for the next cold start (read-only deployments just skip this)
+        try:
+            write_artifact(artifact_path(file_path), chunks, fingerprint, build_digest)
+            _index_source['artifact'] = 'rebuilt'
+        except (OSError, ImportError, ArtifactError):
+            pass
+    return index
+
+
+def get_retrieval_index(timer=None):
+    """Return the shared retrieval index, rebuilding it only if the KB file changed
+    
+    timer: optional RequestTimer that is charged for any load/chunk/index work
+    """
+    global _index, _index_stat, _kb_path
+    
+    # A knowledge base watcher swaps new versions in itself; no stat per request
+    index = _index
+    if index is not None and _kb_watched:
+        return index
+    
+    # One stat per request on the remembered path; probe the candidates only if it went away
+    file_path = _kb_path or find_knowledge_base_path()
+    try:
+        stat = os.stat(file_path) if file_path else None
+    except OSError:
+        file_path = find_knowledge_base_path()
+        try:
+            stat = os.stat(file_path) if file_path else None
+        except OSError:
+            stat = None
+    _kb_path = file_path if stat else None
+    stat_key = (file_path, stat.st_mtime_ns, stat.st_size) if stat else None
+    
+    # Fast path: same file, untouched since the index was built
+    if index is not None and stat_key == _index_stat:
+        return index
+    
+    with _index_lock:
+        if _index is not None and stat_key == _index_stat:
+            return _index
+        
+        fingerprint = _file_digest(file_path) if stat_key else None
+        # The mtime moved but the contents did not (e.g. a touch or redeploy)
+        if _index is None or fingerprint != _index.fingerprint:
+            _index = _build_index(file_path if stat_key else None, fingerprint, timer or RequestTimer())
+        _index_stat = stat_key
+        return _index
+
+
+def reload_retrieval_index():
+    """Rebuild the index off the request path and swap it in; returns (old, new), or None if unchanged
+    
+    The new version is built and validated while requests keep using the old
+    one, then replaces it with a single assignment: requests that already hold
+    the old index finish on it. Raises KnowledgeBaseError if the new knowledge
+    base does not validate, leaving the old index in place.
+    """
+    global _index, _index_stat, _kb_path
+    
+    with _reload_lock:
+        file_path = find_knowledge_base_path()
+        if file_path is None:
+            raise KnowledgeBaseError('No knowledge base file found')
+        # Stat before reading: a write that lands after the read moves the stat again
+        stat = os.stat(file_path)
+        kb, fingerprint = read_knowledge_base(file_path)
+        old = _index
+        if old is None or fingerprint != old.fingerprint:
+            new = _build_index(file_path, fingerprint, RequestTimer(), kb=kb)
+            validate_index(kb, new)
+            new.chunk_versions  # Hash the chunks here rather than on the first request
+        else:
+            new = old
+        with _index_lock:
+            _index, _kb_path = new, file_path
+            _index_stat = (file_path, stat.st_mtime_ns, stat.st_size)
+        return None if new is old else (old, new)
+
+
+# Startup mode: 'eager' warms imports, index and client when the module loads
+# (the cold-start init phase); 'lazy' defers each of them to first use
+STARTUP_MODE = os.environ.get('CHAT_STARTUP_MODE', 'eager').lower()
+
+# Time budget for answering one chat request, retries included
+DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', '25'))
+
+# Upstream failures (ChatResult body 'type') -> reason given on a fallback answer
+DEGRADED_REASONS = {
+    'CircuitOpenError': 'circuit_open',
+    'TimeoutError': 'timeout',
+    'DeadlineExceeded': 'timeout',
+    'APITimeoutError': 'timeout',
+}
+
+# Reply length cap; kept short to speed up responses
+MAX_COMPLETION_TOKENS = 300
+
+# Chunks retrieved as context for each question
+CONTEXT_CHUNKS = 5
+
+# Batch endpoint limits: questions per request, and completions running at once
+BATCH_MAX_ITEMS = int(os.environ.get('CHAT_BATCH_MAX_ITEMS', '32'))
+BATCH_PARALLELISM = int(os.environ.get('CHAT_BATCH_PARALLELISM', '4'))
+
+# Cold-start profile: per-dependency import cost and per-request timings
+_process_started = time.perf_counter()
+_startup_timings = {}
+_import_graph = {}
+_request_timings = {'cold_ms': None, 'warm_count': 0, 'warm_total_ms': 0.0, 'last_ms': None}
+_request_timings_lock = threading.Lock()
+
+_upstream_lock = threading.Lock()
+_upstream = None
+
+
+def _timed_import(name, module_name):
+    """Import a module once, recording its wall time and how many modules it pulled in"""
+    if name in _import_graph:
+        return sys.modules[module_name]
+    modules_before = len(sys.modules)
+    started = time.perf_counter()
+    __import__(module_name)
+    _import_graph[name] = {
+        'ms': round((time.perf_counter() - started) * 1000, 2),
+        'modules_loaded': len(sys.modules) - modules_before
+    }
+    return sys.modules[module_name]
+
+
+def get_upstream():
+    """Return the shared upstream client, or None if no API key is configured"""
+    global _upstream
+    
+    openai_key = os.environ.get('OPENAI_API_KEY')
+    if not openai_key:
+        return None
+    if _upstream is not None and _upstream.api_key == openai_key:
+        return _upstream
+    
+    with _upstream_lock:
+        if _upstream is None or _upstream.api_key != openai_key:
+            _timed_import('openai', 'openai')
+            started = time.perf_counter()
+            if _upstream is not None:
+                _upstream.close()
+            _upstream = AsyncUpstream(openai_key)
+            _startup_timings['client_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return _upstream
+
+
+def warm_up():
+    """Pay the import, index and client costs up front so requests start warm"""
+    started = time.perf_counter()
+    try:
+        # Suppress joblib multiprocessing warning (harmless in serverless)
+        import warnings
+        warnings.filterwarnings('ignore', category=UserWarning, module='joblib')
+        
+        # scikit-learn is only needed when it is the selected retrieval backend
+        if DEFAULT_BACKEND == 'sklearn':
+            _timed_import('sklearn', 'sklearn.feature_extraction.text')
+        _timed_import('openai', 'openai')
+        
+        index_started = time.perf_counter()
+        # Chunk versions are hashed up front too, for the answer caches
+        get_retrieval_index().chunk_versions
+        _startup_timings['index_ms'] = round((time.perf_counter() - index_started) * 1000, 2)
+        
+        get_upstream()
+    except Exception as e:
+        # Never fail module import - the request path retries lazily
+        _startup_timings['warm_up_error'] = f'{type(e).__name__}: {str(e)[:100]}'
+    _startup_timings['warm_up_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def record_request_timing(elapsed_ms):
+    """Record a request duration, keeping the first one in the process as the cold start"""
+    with _request_timings_lock:
+        if _request_timings['cold_ms'] is None:
+            _request_timings['cold_ms'] = round(elapsed_ms, 2)
+        else:
+            _request_timings['warm_count'] += 1
+            _request_timings['warm_total_ms'] += elapsed_ms
+        _request_timings['last_ms'] = round(elapsed_ms, 2)
+
+
+def startup_report():
+    """Cold-start vs warm-start timing breakdown for the diagnostics endpoint"""
+    backend = _index.backend if _index is not None else None
+    with _request_timings_lock:
+        warm_count = _request_timings['warm_count']
+        warm_avg = _request_timings['warm_total_ms'] / warm_count if warm_count else None
+        return {
+            'mode': STARTUP_MODE,
+            'retrieval_backend': DEFAULT_BACKEND,
+            'index_source': dict(_index_source),
+            # Model and store details of the dense backend
+            'dense': backend.stats() if backend is not None and hasattr(backend, 'stats') else None,
+            'process_age_s': round(time.perf_counter() - _process_started, 1),
+            'imports': dict(_import_graph),
+            'timings_ms': dict(_startup_timings),
+            'cold_request_ms': _request_timings['cold_ms'],
+            'warm_requests': warm_count,
+            'warm_request_avg_ms': round(warm_avg, 2) if warm_avg is not None else None,
+            'last_request_ms': _request_timings['last_ms']
+        }
+
+
+# System prompt - conversational and human-like
+SYSTEM_PROMPT = """You are a friendly, conversational AI assistant helping visitors learn about Mohammed-Taqi Jalil's portfolio. You're here to chat naturally and share information about his work, experience, and projects.
+
+IMPORTANT GUIDELINES:
+- Be conversational and natural, like you're chatting with a friend
+- Use the information provided in the context below - this is the ONLY information you have about Mohammed-Taqi
+- If asked about something not in the context, politely say you don't have that information and offer to share what you do know
+- NEVER make up or invent projects, companies, or experiences
+- Keep responses concise but friendly - aim for 2-4 sentences typically
+- Use natural language, contractions, and a warm, approachable tone
+- Feel free to ask follow-up questions to keep the conversation engaging"""
+
+
+class ChatResult:
+    """Outcome of a chat request: a JSON body, or a stream of text deltas"""
+    
+    def __init__(self, status=200, body=None, deltas=None, headers=None, timer=None):
+        self.status = status
+        self.body = body
+        self.deltas = deltas
+        self.headers = headers or {}
+        # Per-stage timings; streamed results keep adding to it until the stream ends
+        self.timer = timer
+    
+    @property
+    def is_stream(self):
+        return self.deltas is not None
+    
+    @property
+    def degraded(self):
+        """Why this is a fallback answer rather than the model's, or None"""
+        return self.headers.get('X-Chat-Degraded')
+    
+    def close(self):
+        """Stop a stream early (e.g. the client disconnected)"""
+        close = getattr(self.deltas, 'close', None)
+        if close:
+            close()
+
+
+class ClosingStream:
+    """Iterator over a delta generator whose close() also runs on_close
+    
+    A generator that never started skips its finally on close(), so closing it
+    alone would leave what it wraps (an upstream stream, a shared flight, a
+    batch's executor) running.
+    """
+    
+    def __init__(self, deltas, on_close):
+        self.deltas = deltas
+        self.on_close = on_close
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self.deltas)
+    
+    def close(self):
+        self.deltas.close()
+        self.on_close()
+
+
+class ChatService:
+    """The chat pipeline: request dict in, ChatResult out"""
+    
+    def __init__(self, answer_cache=None, semantic_cache=None, prompt_builder=None, sessions=None,
+                 coalescer=None, admission=None):
+        # Completed answers, shared by every request in the process
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache()
+        # Paraphrases of answered questions, matched in retrieval space
+        self.semantic_cache = semantic_cache if semantic_cache is not None else SemanticCache()
+        # Fits context and history into the prompt token budget
+        self.prompt_builder = prompt_builder if prompt_builder is not None else PromptBuilder()
+        # Server-side histories for clients that opt into sessions
+        self.sessions = sessions if sessions is not None else SessionStore()
+        # Identical questions in flight at the same time share one upstream call
+        self.coalescer = coalescer if coalescer is not None else SingleFlight()
+        # Keeps upstream calls within the OpenAI quota and each client's share of it
+        self.admission = admission if admission is not None else AdmissionController()
+        # Reloads the knowledge base when it changes (long-running servers only)
+        self.kb_watcher = None
+    
+    def warm_up(self):
+        """Build the index and client before the first request arrives"""
+        warm_up()
+    
+    def watch_knowledge_base(self, interval=WATCH_INTERVAL):
+        """Reload the knowledge base in the background whenever the file changes
+        
+        For long-running servers; requests then skip the per-request stat.
+        Returns the started watcher, or None if disabled or there is no file.
+        """
+        global _kb_watched
+        file_path = find_knowledge_base_path()
+        if interval <= 0 or file_path is None:
+            return None
+        self.kb_watcher = KnowledgeBaseWatcher(file_path, self.reload_knowledge_base, interval).start()
+        _kb_watched = True
+        return self.kb_watcher
+    
+    def reload_knowledge_base(self):
+        """Swap in the knowledge base as it is on disk now; a report dict, or None if unchanged"""
+        swapped = reload_retrieval_index()
+        if swapped is None:
+            return None
+        old, new = swapped
+        answers, semantic = self._refresh_caches(new)
+        changed, added, removed = diff_versions(old.chunk_versions if old is not None else {}, new.chunk_versions)
+        return {
+            'fingerprint': new.fingerprint,
+            'chunks': len(new.chunks),
+            'changed': changed,
+            'added': added,
+            'removed': removed,
+            'answers_invalidated': answers,
+            'semantic_invalidated': semantic
+        }
+    
+    def _refresh_caches(self, index):
+        """Move the answer caches to the index's generation, keeping answers whose chunks are unchanged"""
+        if index.fingerprint == self.answer_cache.generation == self.semantic_cache.generation:
+            return 0, 0
+        versions = index.chunk_versions
+        return (
+            self.answer_cache.set_generation(index.fingerprint, versions),
+            self.semantic_cache.set_generation(index.fingerprint, index.vocabulary, versions)
+        )
+    
+    def handle(self, request, timer=None, client=None):
+        """Answer one chat request
+        
+        request: {'message': str, 'history': [...], 'stream': bool}, where
+        'history' may be replaced by 'session_id' (a known session) or
+        'session': true (start one, seeded with 'history')
+        timer: RequestTimer to record stage timings in (a new one if omitted)
+        client: caller identity (IP address) for the per-client rate limit
+        """
+        timer = timer or RequestTimer()
+        result = self._handle(request, timer, client)
+        result.timer = timer
+        return result
+    
+    def handle_batch(self, request, timer=None, client=None):
+        """Answer several chat requests at once
+        
+        request: {'items': [{'message': str, 'history': [...]}, ...], 'stream': bool}
+        Retrieval runs for every item in one pass; completions run concurrently,
+        at most BATCH_PARALLELISM at a time. The body lists one entry per item in
+        request order; with 'stream' the result's deltas yield each entry (a dict)
+        as soon as it finishes instead. A failed item carries its own status and
+        error without failing the batch.
+        """
+        timer = timer or RequestTimer()
+        items = request.get('items')
+        if not isinstance(items, list) or not items:
+            return ChatResult(400, {'error': 'items must be a non-empty list'}, timer=timer)
+        if len(items) > BATCH_MAX_ITEMS:
+            return ChatResult(400, {
+                'error': 'Batch too large',
+                'message': f'At most {BATCH_MAX_ITEMS} items per batch'
+            }, timer=timer)
+        timer.fields['batch_items'] = len(items)
+        
+        # The batch is charged to the client once; every item still passes upstream admission
+        try:
+            self.admission.check_client(client)
+        except Rejected as e:
+            result = self._shed(e, timer)
+            result.timer = timer
+            return result
+        
+        entries: List[Optional[dict]] = [None] * len(items)
+        pending = {}
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(item.get('message', ''), str):
+                entries[i] = {'index': i, 'status': 400, 'error': 'Each item must be an object with a message'}
+            elif not isinstance(item.get('history', []), list):
+                entries[i] = {'index': i, 'status': 400, 'error': 'history must be a list'}
+            else:
+                pending[i] = {'message': item.get('message', ''), 'history': item.get('history', [])}
+        
+        # One retrieval pass for the whole batch
+        retrieved = {}
+        index = None
+        try:
+            index = get_retrieval_index(timer)
+            with timer.stage('retrieval'):
+                messages = [item['message'] for item in pending.values()]
+                query_vectors = [index.query_vector(message) for message in messages]
+                results = index.search_many(messages, top_k=CONTEXT_CHUNKS, query_vectors=query_vectors)
+                retrieved = {i: (index, found, vector) for i, found, vector in zip(pending, results, query_vectors)}
+        except Exception:
+            # Same fallback as a single request: answer without context
+            pass
+        
+        def run(i):
+            # Items share the batch's deadline: one that starts late gets only what is left
+            budget = DEADLINE_SECONDS - timer.elapsed()
+            return self._batch_item(i, pending[i], retrieved.get(i, (index, [], {})), budget)
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_PARALLELISM, len(pending))),
+                                      thread_name_prefix='chat-batch')
+        futures = {executor.submit(run, i): i for i in pending}
+        if request.get('stream'):
+            cancel = functools.partial(executor.shutdown, wait=False, cancel_futures=True)
+            return ChatResult(deltas=ClosingStream(self._stream_batch(entries, futures), cancel), timer=timer)
+        try:
+            for future, i in futures.items():
+                entries[i] = future.result()
+        finally:
+            executor.shutdown(wait=False)
+        return ChatResult(body={'results': entries}, timer=timer)
+    
+    def _batch_item(self, i, request, retrieved, budget):
+        """One batch item as a result entry; its errors stay in the entry
+        
+        budget: seconds left of the batch's deadline when the item started
+        """
+        timer = RequestTimer()
+        timer.fields['batch_index'] = i
+        status = 500
+        try:
+            result = self._handle(request, timer, None, retrieved, budget)
+            status = result.status
+            entry = dict(result.body or {})
+        except Exception as e:
+            timer.fields['error'] = type(e).__name__
+            entry = {'error': 'Internal server error', 'message': str(e)[:200], 'type': type(e).__name__}
+        finally:
+            metrics.record_request(timer, status)
+        return {'index': i, 'status': status, **entry}
+    
+    def _stream_batch(self, entries, futures):
+        """Yield the rejected items, then each answered item as it finishes
+        
+        Closing the ChatResult shuts the executor down, dropping the items that
+        have not started (e.g. the client went away).
+        """
+        for entry in entries:
+            if entry is not None:
+                yield entry
+        for future in as_completed(futures):
+            yield future.result()
+    
+    def _handle(self, request, timer, client, retrieved=None, budget=DEADLINE_SECONDS):
+        # Reuse the process-wide upstream client (created during warm-up or on first use)
+        upstream = get_upstream()
+        if upstream is None:
+            return ChatResult(500, {
+                'error': 'OpenAI API key not configured',
+                'message': 'Please set OPENAI_API_KEY in Vercel environment variables'
+            })
+        
+        message = request.get('message', '')
+        history = request.get('history', [])[-10:]
+        stream = bool(request.get('stream'))
+        
+        if not message:
+            return ChatResult(400, {'error': 'Message is required'})
+        
+        # The whole request, not just the upstream call, must finish in time;
+        # keep back enough to answer from the chunks if OpenAI does not
+        reserve = RESERVE_SECONDS if FALLBACK_ENABLED else 0.0
+        deadline = Deadline(max(0.0, budget - timer.elapsed() - reserve))
+        
+        # Session mode: the conversation so far lives on the server
+        session_id = request.get('session_id')
+        if session_id is not None:
+            if not valid_session_id(session_id):
+                return ChatResult(400, {'error': 'Invalid session_id'})
+            history = self.sessions.get(session_id)
+            if history is None:
+                # Evicted, expired or held by another instance - the client resends its history
+                return ChatResult(409, {
+                    'error': 'Session expired',
+                    'message': 'Unknown or expired session. Start a new one with the conversation history.',
+                    'type': 'SessionExpired'
+                })
+        elif request.get('session'):
+            session_id = self.sessions.create(history)
+            history = self.sessions.get(session_id)
+        timer.fields['session'] = session_id is not None
+        
+        def remember(answer):
+            if session_id is not None and answer:
+                self.sessions.append(session_id, {'role': 'user', 'content': message},
+                                     {'role': 'assistant', 'content': answer})
+        
+        # Perform semantic search against the warm index; the whole request
+        # stays on this version even if a reload swaps in a new one meanwhile
+        if retrieved is not None:
+            # Batch items are retrieved together, up front
+            index, search_results, query_vector = retrieved
+        else:
+            index = None
+            try:
+                index = get_retrieval_index(timer)
+                with timer.stage('retrieval'):
+                    query_vector = index.query_vector(message)
+                    search_results = self.semantic_search(message, top_k=CONTEXT_CHUNKS,
+                                                          query_vector=query_vector, index=index)
+            except Exception:
+                # Fallback: use empty context if the index can't be built or search fails
+                search_results = []
+                query_vector = {}
+        
+        timer.fields['chunks'] = len(search_results)
+        
+        # Answer cache: same question, same retrieved chunks, same history
+        with timer.stage('cache'):
+            if index is not None and index is _index:
+                # A request still on a replaced index must not move the caches back to it
+                self._refresh_caches(index)
+            chunk_ids = [c.get('id') for c in search_results]
+            cache_key = make_key(message, chunk_ids, history)
+            cached_answer = self.answer_cache.get(cache_key)
+            timer.fields['cache'] = 'exact' if cached_answer is not None else None
+            
+            # Near-duplicate tier: a paraphrase that retrieved the same chunks
+            set_key = chunk_set_key(chunk_ids, history)
+            if cached_answer is None:
+                cached_answer = self.semantic_cache.get(query_vector, set_key)
+                if cached_answer is not None:
+                    timer.fields['cache'] = 'semantic'
+        
+        if cached_answer is not None:
+            remember(cached_answer)
+            if stream:
+                return self._with_session(ChatResult(deltas=iter([cached_answer])), session_id)
+            return self._with_session(ChatResult(body={'response': cached_answer, 'cached': True}), session_id)
+        
+        def degrade(reason):
+            return self._fallback(message, search_results, stream, reason, remember, timer)
+        
+        if deadline.expired:
+            # No time left for OpenAI (a batch item that started late): don't try
+            timer.fields['error'] = 'DeadlineExceeded'
+            if FALLBACK_ENABLED:
+                return self._with_session(degrade('timeout'), session_id)
+            return self._with_session(ChatResult(504, {
+                'error': 'OpenAI API error',
+                'message': 'Request timed out. Please try again.',
+                'type': 'DeadlineExceeded'
+            }), session_id)
+        
+        # Per-client quota; only requests that may reach OpenAI are charged
+        try:
+            self.admission.check_client(client)
+        except Rejected as e:
+            return self._with_session(self._shed(e, timer), session_id)
+        
+        # Single flight: the same question is already on its way to OpenAI
+        flight, role = self.coalescer.join(cache_key)
+        if role:
+            timer.fields['coalesced'] = role
+        
+        if role == 'follower':
+            return self._with_session(self._follow(flight, stream, remember, degrade, timer, deadline), session_id)
+        
+        def store(answer):
+            # Without an index there is no generation to file the answer under
+            if index is not None:
+                versions = chunk_versions_for(chunk_ids, index.chunk_versions)
+                self.answer_cache.put(cache_key, answer, versions, index.fingerprint)
+                self.semantic_cache.put(query_vector, set_key, answer, versions, index.fingerprint)
+            remember(answer)
+        
+        try:
+            with timer.stage('prompt'):
+                messages, prompt_report = self.prompt_builder.build(
+                    message, history, search_results, self.render_prompt
+                )
+            timer.fields['prompt_tokens_before'] = prompt_report['tokens_before']
+            timer.fields['prompt_tokens_saved'] = prompt_report['tokens_saved']
+            
+            # Wait for upstream quota (briefly) or shed the request
+            try:
+                with timer.stage('admission'):
+                    # OpenAI counts max_tokens against the token quota, so do we
+                    waited = self.admission.admit(
+                        prompt_report['tokens_after'] + MAX_COMPLETION_TOKENS,
+                        deadline.remaining() - MIN_ATTEMPT_SECONDS
+                    )
+                timer.fields['admission'] = 'queued' if waited else 'admitted'
+                result = self.complete(upstream, messages, stream, store, timer, deadline)
+                if result.status >= 500 and FALLBACK_ENABLED:
+                    # Slow, failing or circuit open - answer from the chunks instead
+                    result = degrade(DEGRADED_REASONS.get(result.body.get('type'), 'upstream_error'))
+            except Rejected as e:
+                result = self._shed(e, timer)
+        except BaseException as e:
+            if flight is not None:
+                self.coalescer.finish(flight, error=e)
+            raise
+        if flight is not None:
+            result = self.coalescer.lead(flight, result)
+        return self._with_session(result, session_id)
+    
+    def _shed(self, rejection, timer):
+        """429/503 response for a request turned away by admission control"""
+        timer.fields['admission'] = f'rejected_{rejection.reason}'
+        retry_after = int(rejection.retry_after_header)
+        if rejection.status == 429:
+            body = {
+                'error': 'Rate limit exceeded',
+                'message': 'Too many messages in a short time. Please wait a moment and try again.',
+                'type': 'RateLimited',
+                'retry_after': retry_after
+            }
+        else:
+            body = {
+                'error': 'Service busy',
+                'message': 'The assistant is busy right now. Please try again shortly.',
+                'type': 'Overloaded',
+                'retry_after': retry_after
+            }
+        return ChatResult(rejection.status, body, headers={'Retry-After': rejection.retry_after_header})
+    
+    def _fallback(self, message, search_results, stream, reason, remember, timer):
+        """Degraded answer built from the retrieved chunks without OpenAI"""
+        with timer.stage('fallback'):
+            answer = fallback_answer(message, search_results)
+        timer.fields['degraded'] = reason
+        # Remembered so the conversation reads right, but never cached
+        remember(answer)
+        headers = {'X-Chat-Degraded': reason}
+        if stream:
+            return ChatResult(deltas=iter([answer]), headers=headers)
+        return ChatResult(body={'response': answer, 'degraded': True, 'degraded_reason': reason}, headers=headers)
+    
+    def _follow(self, flight, stream, remember, degrade, timer, deadline):
+        """Answer with the upstream call another request already made"""
+        # Never wait past the request deadline for somebody else's answer
+        timeout = min(self.coalescer.wait_timeout, deadline.remaining())
+        deltas = self.coalescer.follow(flight, max(timeout, 0.001))
+        try:
+            with timer.stage('coalesce'):
+                # Like complete(): anything that fails before the first token is a JSON error
+                head = list(itertools.islice(deltas, 1)) if stream else list(deltas)
+        except CoalesceTimeout:
+            self.coalescer.timed_out()
+            timer.fields['error'] = 'CoalesceTimeout'
+            if FALLBACK_ENABLED:
+                return degrade('timeout')
+            return ChatResult(504, {
+                'error': 'OpenAI API error',
+                'message': 'Request timed out. Please try again.',
+                'type': 'CoalesceTimeout'
+            })
+        except Exception as e:
+            error = e.error if isinstance(e, UpstreamError) else e
+            timer.fields['error'] = type(error).__name__
+            if FALLBACK_ENABLED:
+                return degrade('upstream_error')
+            return ChatResult(500, {
+                'error': 'OpenAI API error',
+                'message': classify_openai_error(error)[1],
+                'type': type(error).__name__
+            })
+        
+        if flight.result is not None:
+            # Ended without an answer; done with the flight
+            deltas.close()
+        if flight.result is not None and flight.result.degraded:
+            # The leader fell back; each follower builds its own (cheap) fallback
+            return degrade(flight.result.degraded)
+        if flight.result is not None:
+            # The leader got an error response - so does everyone waiting on it
+            shared = flight.result
+            return ChatResult(shared.status, dict(shared.body or {}), headers=dict(shared.headers))
+        if stream:
+            return ChatResult(deltas=ClosingStream(self._follow_stream(head, deltas, remember), deltas.close))
+        answer = ''.join(head)
+        remember(answer)
+        return ChatResult(body={'response': answer})
+    
+    def _follow_stream(self, head, deltas, remember):
+        """Yield a shared stream from the first delta on, remembering the full answer"""
+        parts = list(head)
+        yield from head
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield delta
+        except CoalesceTimeout:
+            self.coalescer.timed_out()
+            raise
+        remember(''.join(parts))
+    
+    def _with_session(self, result, session_id):
+        """Tell the client which session the answer belongs to"""
+        if session_id is not None:
+            result.headers['X-Chat-Session'] = session_id
+            if result.status == 200 and result.body is not None:
+                result.body['session_id'] = session_id
+        return result
+    
+    def render_prompt(self, message, history, chunks, summary=None):
+        """Message list for the chunks and turns chosen by the prompt builder"""
+        return self.build_messages(message, history, self.build_context(chunks), summary)
+    
+    def build_messages(self, message, history, context, summary=None):
+        """Assemble the OpenAI message list"""
+        # Build messages for OpenAI
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        
+        # Add context if available
+        if context:
+            messages.append({
+                "role": "system",
+                "content": f"IMPORTANT: The following is the ONLY information available about Mohammed-Taqi Jalil. You MUST use ONLY this information when answering questions about him:\n\n{context}\n\nIf asked about something not mentioned above, you must say you don't have that information rather than making something up."
+            })
+        else:
+            # If no context found, add a reminder to be honest
+            messages.append({
+                "role": "system",
+                "content": "You do not have specific information about this topic in Mohammed-Taqi's portfolio. Please say you don't have that information rather than inventing details."
+            })
+        
+        # Older turns that did not fit the prompt budget, condensed
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary}"
+            })
+        
+        # Add conversation history (already fitted to the prompt budget)
+        for msg in history:
+            if msg.get('role') in ['user', 'assistant']:
+                messages.append({
+                    "role": msg['role'],
+                    "content": msg.get('content', '')
+                })
+        
+        # Add current message
+        messages.append({"role": "user", "content": message})
+        return messages
+    
+    def complete(self, upstream, messages, stream, store, timer=None, deadline=None):
+        """Call OpenAI within the request deadline, passing the finished answer to store()"""
+        timer = timer or RequestTimer()
+        deadline = deadline or Deadline(DEADLINE_SECONDS)
+        params = {
+            'model': "gpt-3.5-turbo",
+            'temperature': 0.7,
+            'max_tokens': MAX_COMPLETION_TOKENS
+        }
+        try:
+            if stream:
+                # Errors before the first token surface here and still get a JSON error
+                # 'upstream' is time to the first token; the rest is charged to 'stream'
+                with timer.stage('upstream'):
+                    deltas, retries, usage = upstream.stream(messages, deadline, **params)
+                    try:
+                        # Wait for the first token too, so a stalled stream can still fall back
+                        head = list(itertools.islice(deltas, 1))
+                    except Exception as e:
+                        deltas.close()
+                        raise UpstreamError(e, retries)
+                timer.fields['retries'] = retries
+                return ChatResult(deltas=ClosingStream(self._stream_and_store(deltas, store, timer, usage, head), deltas.close))
+            
+            with timer.stage('upstream'):
+                assistant_message, retries, usage = upstream.complete(messages, deadline, **params)
+            timer.fields['retries'] = retries
+            timer.fields.update(usage or {})
+            store(assistant_message)
+            return ChatResult(body={'response': assistant_message})
+        
+        except CircuitOpenError as e:
+            timer.fields['error'] = 'CircuitOpenError'
+            # Upstream has been failing - answer immediately instead of waiting on it
+            return ChatResult(503, {
+                'error': 'OpenAI API error',
+                'message': 'The assistant is temporarily unavailable. Please try again shortly.',
+                'type': 'CircuitOpenError',
+                'retries': 0
+            }, headers={'Retry-After': str(int(e.retry_after))})
+        
+        except UpstreamError as e:
+            # Not retryable, out of retries or out of time
+            _, error_msg = classify_openai_error(e.error)
+            timer.fields['retries'] = e.retries
+            timer.fields['error'] = type(e.error).__name__
+            return ChatResult(500, {
+                'error': 'OpenAI API error',
+                'message': error_msg,
+                'type': type(e.error).__name__,
+                'retries': e.retries,
+                'original_error': str(e.error)[:200]
+            })
+    
+    def _stream_and_store(self, deltas, store, timer, usage, head=()):
+        """Yield deltas from an upstream stream, storing the answer once it completes"""
+        parts = list(head)
+        completed = False
+        started = time.perf_counter()
+        try:
+            yield from head
+            for delta in deltas:
+                parts.append(delta)
+                yield delta
+            completed = True
+        finally:
+            timer.add('stream', time.perf_counter() - started)
+            timer.fields.update(usage)
+            if not completed:
+                # Client went away or upstream failed - release the connection
+                timer.fields['stream_completed'] = False
+                deltas.close()
+        store(''.join(parts))
+    
+    def semantic_search(self, query, chunks=None, top_k=3, query_vector=None, index=None):
+        """Perform semantic search on knowledge base chunks
+        
+        index: the retrieval index to search (default: the current one)
+        """
+        try:
+            index = index or get_retrieval_index()
+            if chunks is not None and chunks is not index.chunks:
+                # Ad-hoc chunk list - index it for this call only
+                index = RetrievalIndex(chunks)
+                query_vector = None
+            return index.search(query, top_k=top_k, query_vector=query_vector)
+        except Exception:
+            return chunks[:top_k] if chunks else []
+    
+    def build_context(self, search_results):
+        """Build context string from search results"""
+        if not search_results:
+            return ""
+        
+        context_parts = []
+        for result in search_results:
+            context_parts.append(result['text'])
+        
+        return "\n\n".join(context_parts)
+    
+    def diagnostics(self):
+        """Service state for the GET diagnostics endpoint"""
+        openai_key = os.environ.get('OPENAI_API_KEY')
+        
+        # Try a simple test to see if we can reach OpenAI
+        can_reach_openai = 'Unknown'
+        try:
+            # Just check if we can create a client, don't make a real request
+            can_reach_openai = 'Client created' if get_upstream() else 'No API key'
+        except Exception as e:
+            can_reach_openai = f'Error: {str(e)[:50]}'
+        
+        return {
+            'status': 'ok',
+            'function': 'chat',
+            'openai_key_configured': 'Yes' if openai_key else 'No',
+            'openai_key_length': len(openai_key) if openai_key else 0,
+            'openai_key_prefix': openai_key[:7] + '...' if openai_key and len(openai_key) > 7 else 'N/A',
+            'can_reach_openai': can_reach_openai,
+            'startup': startup_report(),
+            'answer_cache': self.answer_cache.stats(),
+            'semantic_cache': self.semantic_cache.stats(),
+            'prompt': self.prompt_builder.stats(),
+            'sessions': self.sessions.stats(),
+            'coalescing': self.coalescer.stats(),
+            'admission': self.admission.stats(),
+            'upstream': _upstream.stats() if _upstream is not None else None,
+            'memory': memory_profiler.stats(),
+            'kb_reload': self.kb_watcher.stats() if self.kb_watcher is not None else None,
+            'latency_ms': metrics.snapshot()
+        }
+
+
+_service_lock = threading.Lock()
+_service = None
+
+
+def get_chat_service():
+    """Return the process-wide ChatService, creating it on first use"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = ChatService()
+    return _service
@@ -0,0 +1,228 @@
+"""
+Server-side conversation sessions for the chatbot
+Keeps each conversation's recent turns in a bounded in-memory store (LRU with
+a session count and byte cap, plus idle expiry), optionally written through to
+SQLite, so clients only send the new message and a session ID
+"""
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from _prompt import TURN_MAX_TOKENS, truncate_to_tokens
+
+# Defaults, overridable through environment variables
+DEFAULT_MAX_SESSIONS = int(os.environ.get('CHAT_SESSION_MAX', '1000'))
+DEFAULT_MAX_BYTES = int(os.environ.get('CHAT_SESSION_MAX_BYTES', str(8 * 1024 * 1024)))
+DEFAULT_TTL_SECONDS = float(os.environ.get('CHAT_SESSION_TTL', '3600'))
+DEFAULT_MAX_MESSAGES = int(os.environ.get('CHAT_SESSION_MAX_MESSAGES', '20'))
+DEFAULT_DB_PATH = os.environ.get('CHAT_SESSION_DB') or None
+
+# Rough per-message bookkeeping cost on top of the text itself
+MESSAGE_OVERHEAD_BYTES = 64
+# Sessions created between two sweeps of expired rows out of SQLite
+PRUNE_EVERY = 100
+
+_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+def valid_session_id(session_id):
+    return isinstance(session_id, str) and bool(_SESSION_ID.match(session_id))
+
+
+def _size(turns):
+    return sum(len(turn['content']) + MESSAGE_OVERHEAD_BYTES for turn in turns)
+
+
+class SessionStore:
+    """Thread-safe LRU of conversation histories keyed by session ID
+
+    With a database path, every change is written through to SQLite and memory
+    only caches parsed turns, so processes sharing the file (prefork workers)
+    share sessions: a follow-up answered by another worker finds the history.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL_SECONDS, max_messages=DEFAULT_MAX_MESSAGES, db_path=DEFAULT_DB_PATH):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.db_path = db_path
+        self.bytes = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.written = 0
+        self.restored = 0
+        self._sessions = OrderedDict()  # id -> [last_used, turns, size, version written]
+        self._lock = threading.Lock()
+        self._db = self._open_db(db_path) if db_path else None
+
+    def create(self, history=None):
+        """Start a session, optionally seeded with client-side history; returns its ID"""
+        session_id = secrets.token_urlsafe(18)
+        turns = self._compact([
+            {'role': msg['role'], 'content': str(msg.get('content', ''))}
+            for msg in (history or [])
+            if isinstance(msg, dict) and msg.get('role') in ['user', 'assistant']
+        ])
+        with self._lock:
+            self.created += 1
+            version = self._write(session_id, turns)
+            if version is not None:
+                self.written += 1
+            self._put(session_id, turns, version)
+            if self._db is not None and self.created % PRUNE_EVERY == 0:
+                self._db.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - self.ttl,))
+        return session_id
+
+    def get(self, session_id):
+        """The session's turns, or None if it is unknown or expired"""
+        with self._lock:
+            entry = self._current(session_id)
+            if entry is None:
+                return None
+            entry[0] = time.time()
+            self._sessions.move_to_end(session_id)
+            return list(entry[1])
+
+    def append(self, session_id, *turns):
+        """Add turns to a session, keeping only its most recent messages"""
+        new_turns = [{'role': turn['role'], 'content': turn['content']} for turn in turns]
+        with self._lock:
+            db = self._db
+            if db is None:
+                entry = self._current(session_id)
+                self._put(session_id, self._compact((entry[1] if entry is not None else []) + new_turns))
+                return
+            # Read-modify-write as one transaction: another process may append too
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                entry = self._current(session_id)
+                history = self._compact((entry[1] if entry is not None else []) + new_turns)
+                version = self._write(session_id, history)
+                db.execute('COMMIT')
+                self.written += 1
+            except BaseException:
+                # Leave neither a half-done write nor an open transaction behind
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                raise
+            # Memory follows only what reached the file
+            self._put(session_id, history, version)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+            if self._db is not None:
+                self._db.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'created': self.created,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'written': self.written,
+                'restored': self.restored,
+                'persistent': self._db is not None
+            }
+
+    def _compact(self, turns):
+        """Most recent messages only, each capped at the prompt's per-turn limit"""
+        return [
+            {'role': turn['role'], 'content': truncate_to_tokens(turn['content'], TURN_MAX_TOKENS)}
+            for turn in turns[-self.max_messages:]
+        ]
+
+    def _current(self, session_id):
+        """The live entry for a session, reconciled with SQLite (caller holds the lock)"""
+        entry = self._sessions.get(session_id)
+        if self._db is None:
+            if entry is not None and entry[0] + self.ttl < time.time():
+                self._remove(session_id)
+                self.expired += 1
+                return None
+            return entry
+        row = self._db.execute('SELECT updated, turns FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            # Deleted, or pruned as expired, by this or another process
+            self._remove(session_id)
+            return None
+        updated, stored_turns = row
+        if max(updated, entry[0] if entry is not None else 0) + self.ttl < time.time():
+            self._remove(session_id)
+            self._db.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            self.expired += 1
+            return None
+        if entry is None or entry[3] != updated:
+            # Unknown here, or another process wrote a newer version
+            entry = self._put(session_id, json.loads(stored_turns), version=updated)
+            self.restored += 1
+        return entry
+
+    def _write(self, session_id, turns):
+        """Write turns through to SQLite; the row's version, or None when memory-only"""
+        if self._db is None:
+            return None
+        version = time.time()
+        self._db.execute(
+            'INSERT OR REPLACE INTO sessions (id, updated, turns) VALUES (?, ?, ?)',
+            (session_id, version, json.dumps(turns))
+        )
+        return version
+
+    def _put(self, session_id, turns, version=None):
+        """Cache turns in memory and evict past the caps (caller holds the lock)
+
+        version: the SQLite row the turns were written to or read from
+        """
+        self._remove(session_id)
+        entry = [time.time(), turns, _size(turns), version]
+        self._sessions[session_id] = entry
+        self.bytes += entry[2]
+        while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions or self.bytes > self.max_bytes):
+            oldest_id, (last_used, _, _, _) = next(iter(self._sessions.items()))
+            # Written through already: dropping it from memory loses nothing
+            self._remove(oldest_id)
+            if last_used + self.ttl < time.time():
+                self.expired += 1
+            else:
+                self.evicted += 1
+        return entry
+
+    def _remove(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _open_db(self, path):
+        """Autocommit SQLite connection with the sessions table, or None to stay memory-only"""
+        try:
+            import sqlite3
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Shared by every worker thread; the store lock serializes access
+            db = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+            # WAL lets other processes read while one writes; a lost last turn on power
+            # failure is an acceptable price for not syncing every write
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, updated REAL, turns TEXT)')
+            db.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - self.ttl,))
+            return db
+        except Exception:
+            # Persistence is an optimization - carry on memory-only
+            return None
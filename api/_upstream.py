@@ -0,0 +1,384 @@
+"""
+Upstream OpenAI access for the chatbot
+AsyncOpenAI on a dedicated event loop thread, with a shared keep-alive connection
+pool, per-request deadlines, jittered exponential backoff and a circuit breaker
+"""
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+
+# Upstream defaults, overridable through environment variables
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', "https://api.openai.com/v1")
+ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get('CHAT_UPSTREAM_TIMEOUT', '20'))
+MAX_RETRIES = int(os.environ.get('CHAT_UPSTREAM_MAX_RETRIES', '2'))
+POOL_SIZE = int(os.environ.get('CHAT_UPSTREAM_POOL_SIZE', '20'))
+KEEPALIVE_SECONDS = float(os.environ.get('CHAT_UPSTREAM_KEEPALIVE', '60'))
+BREAKER_FAILURES = int(os.environ.get('CHAT_BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('CHAT_BREAKER_RESET', '30'))
+
+# Don't start an attempt with less time than this left on the deadline
+MIN_ATTEMPT_SECONDS = 1.0
+
+
+def classify_openai_error(openai_error):
+    """Return (is_retryable, user-facing message) for an upstream exception"""
+    error_str = str(openai_error).lower()
+
+    # Timeouts enforced on our side (deadline or per-attempt)
+    if isinstance(openai_error, (TimeoutError, asyncio.TimeoutError)):
+        return True, 'Request timed out. Please try again.'
+
+    # Import OpenAI-specific exceptions for better error handling
+    try:
+        from openai import APIConnectionError, APITimeoutError, RateLimitError, APIError
+    except ImportError:
+        # Fallback if OpenAI exceptions aren't available
+        is_retryable = any(keyword in error_str for keyword in [
+            'connection', 'timeout', 'network', 'temporary',
+            'rate limit', '503', '502', '504'
+        ])
+        error_msg = str(openai_error)
+        if 'connection' in error_str:
+            error_msg = 'Connection error. Please try again in a moment.'
+        return is_retryable, error_msg
+
+    # Check for specific OpenAI exception types
+    if isinstance(openai_error, APIConnectionError):
+        return True, 'Connection error. Please try again in a moment.'
+    if isinstance(openai_error, APITimeoutError):
+        return True, 'Request timed out. Please try again.'
+    if isinstance(openai_error, RateLimitError):
+        return True, 'Rate limit exceeded. Please try again in a moment.'
+    if isinstance(openai_error, APIError):
+        # Check status code for retryable errors
+        status_code = getattr(openai_error, 'status_code', None)
+        if status_code in [502, 503, 504]:
+            return True, 'OpenAI service temporarily unavailable. Please try again.'
+        return False, f'OpenAI API error: {str(openai_error)}'
+
+    # Generic exception - check error message
+    is_retryable = any(keyword in error_str for keyword in [
+        'connection', 'timeout', 'network', 'temporary',
+        'rate limit', '503', '502', '504', 'unreachable'
+    ])
+    error_msg = str(openai_error)
+    if 'connection' in error_str:
+        error_msg = 'Connection error. Please try again in a moment.'
+    elif 'timeout' in error_str:
+        error_msg = 'Request timed out. Please try again.'
+    return is_retryable, error_msg
+
+
+def token_usage(response):
+    """Prompt/completion token counts reported by OpenAI, or None"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0
+    }
+
+
+class UpstreamError(Exception):
+    """The completion failed after every attempt the deadline allowed"""
+
+    def __init__(self, error, retries):
+        super().__init__(str(error))
+        self.error = error
+        self.retries = retries
+
+
+class DeadlineExceeded(TimeoutError):
+    """Our own request deadline ran out; says nothing about upstream health"""
+
+
+class CircuitOpenError(Exception):
+    """Upstream is considered down; fail fast instead of queueing more calls"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Circuit open, retry after {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """Absolute point in time by which a request must be answered"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def _is_timeout(error):
+    """Whether an attempt failed by running out of time (ours or the SDK's)"""
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError)) or type(error).__name__ == 'APITimeoutError'
+
+
+def backoff_delay(attempt, base=0.25, cap=4.0):
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2^attempt))"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go upstream right now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """Seconds until the breaker lets a probe through"""
+        with self._lock:
+            if self.state == 'closed':
+                return 0.0
+            return max(1.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release(self):
+        """End a call that says nothing about upstream health (e.g. our deadline ran out)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+
+
+class AsyncUpstream:
+    """AsyncOpenAI client on a private event loop, callable from worker threads
+
+    Every request shares one client and therefore one keep-alive connection pool,
+    so TLS handshakes are paid once per process rather than once per request.
+    """
+
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, attempt_timeout=ATTEMPT_TIMEOUT_SECONDS,
+                 max_retries=MAX_RETRIES, breaker=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self._client = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='chat-upstream', daemon=True)
+        self._thread.start()
+        # Create the client on the loop thread so its pool belongs to that loop
+        self._run(self._create_client())
+
+    async def _create_client(self):
+        import openai
+
+        http_client = None
+        try:
+            import httpx
+            http_client = openai.DefaultAsyncHttpxClient(limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=POOL_SIZE,
+                keepalive_expiry=KEEPALIVE_SECONDS
+            ))
+        except (ImportError, AttributeError):
+            # Fall back to the SDK's default pool
+            pass
+        # Note: max_retries=0 because retries are deadline-aware and handled here
+        self._client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,  # Explicit base URL
+            timeout=self.attempt_timeout,
+            max_retries=0,
+            http_client=http_client
+        )
+
+    def _run(self, coroutine, timeout=None):
+        """Run a coroutine on the upstream loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    async def _create(self, messages, deadline, stream, params):
+        """Issue the completion, retrying retryable errors while the deadline allows"""
+        client = self._client
+        if client is None:
+            raise RuntimeError('The upstream client was not created')
+        attempt = 0
+        while True:
+            # Each attempt gets whatever is left of the deadline, up to the per-attempt cap
+            timeout = min(self.attempt_timeout, deadline.remaining())
+            if timeout <= 0:
+                self.failures += 1
+                raise UpstreamError(DeadlineExceeded('Request deadline exceeded'), attempt)
+            if not self.breaker.allow():
+                raise CircuitOpenError(self.breaker.retry_after())
+
+            self.calls += 1
+            try:
+                result = await asyncio.wait_for(
+                    client.chat.completions.create(
+                        messages=messages, stream=stream, timeout=timeout, **params
+                    ),
+                    timeout
+                )
+                self.breaker.record_success()
+                return result, attempt
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if timeout < self.attempt_timeout and _is_timeout(e):
+                    # Cut short by our deadline, not by upstream: no breaker failure, no retry
+                    self.breaker.release()
+                    self.failures += 1
+                    raise UpstreamError(DeadlineExceeded('Request deadline exceeded'), attempt)
+                is_retryable, _ = classify_openai_error(e)
+                if is_retryable:
+                    self.breaker.record_failure()
+                else:
+                    # Upstream answered (e.g. a 400) - it is up, the request is bad
+                    self.breaker.record_success()
+
+                delay = backoff_delay(attempt)
+                if (not is_retryable or attempt >= self.max_retries
+                        or deadline.remaining() < delay + MIN_ATTEMPT_SECONDS):
+                    self.failures += 1
+                    raise UpstreamError(e, attempt)
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def complete(self, messages, deadline, **params):
+        """Blocking completion; returns (text, retries, usage) or raises UpstreamError/CircuitOpenError"""
+        async def call():
+            response, retries = await self._create(messages, deadline, False, params)
+            return response.choices[0].message.content, retries, token_usage(response)
+        return self._run(call())
+
+    def stream(self, messages, deadline, **params):
+        """Start a streamed completion and return (delta generator, retries, usage)
+
+        Errors before the first byte are raised here, so the caller can still
+        answer with a plain error response. Later errors are raised by the generator.
+        usage is a dict that is filled in once the stream has finished.
+        """
+        events = queue.Queue()
+        usage = {}
+        # Ask for a final usage chunk so streamed answers are counted too
+        params = dict(params, stream_options={'include_usage': True})
+
+        async def pump():
+            try:
+                token_stream, retries = await self._create(messages, deadline, True, params)
+            except BaseException as e:
+                events.put(('error', e))
+                return
+            events.put(('started', retries))
+            try:
+                async for chunk in token_stream:
+                    usage.update(token_usage(chunk) or {})
+                    if chunk.choices:
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            events.put(('delta', delta))
+                events.put(('done', None))
+            except BaseException as e:
+                events.put(('error', e))
+            finally:
+                close = getattr(token_stream, 'close', None)
+                if close:
+                    await close()
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        kind, value = events.get()
+        if kind == 'error':
+            raise value
+
+        def deltas():
+            try:
+                while True:
+                    # Idle timeout between tokens, so a stalled stream can't hang a worker,
+                    # and never past the request deadline
+                    try:
+                        kind, value = events.get(timeout=max(0.001, min(self.attempt_timeout, deadline.remaining())))
+                    except queue.Empty:
+                        if deadline.expired:
+                            raise DeadlineExceeded('Request deadline exceeded')
+                        raise TimeoutError('Upstream stream stalled')
+                    if kind == 'delta':
+                        yield value
+                    elif kind == 'done':
+                        return
+                    else:
+                        raise value
+            finally:
+                # Client went away or the stream failed - stop pulling from upstream
+                future.cancel()
+
+        return deltas(), value, usage
+
+    def stats(self):
+        """Counters for the diagnostics endpoint"""
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'attempt_timeout_s': self.attempt_timeout,
+            'max_retries': self.max_retries,
+            'breaker': self.breaker.stats()
+        }
+
+    def close(self):
+        """Close pooled connections and stop the loop thread"""
+        if self._client is not None:
+            try:
+                self._run(self._client.close(), timeout=5)
+            except Exception:
+                pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
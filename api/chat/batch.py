@@ -0,0 +1,22 @@
+"""
+Batch chatbot API endpoint
+Vercel serverless function for /api/chat/batch: many questions in one request,
+served by the same handler as api/chat.py
+"""
+import os
+import sys
+
+# Make the helper modules in api/ importable when loaded as a Vercel function
+_API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _API_DIR not in sys.path:
+    sys.path.insert(0, _API_DIR)
+
+from chat import handler as chat_handler  # noqa: E402
+
+
+class handler(chat_handler):
+    """Vercel handler for batch requests"""
+    
+    def do_POST(self):
+        """Handle POST requests"""
+        self.handle_batch_post()
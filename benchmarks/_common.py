@@ -0,0 +1,118 @@
+"""
+Shared helpers for the benchmark scripts: percentiles and baseline files
+"""
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(ROOT_DIR, 'api')
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# A metric regresses when it is this much worse than the baseline
+DEFAULT_TOLERANCE = 0.25
+
+
+def use_api_modules():
+    """Make the chat function's helper modules importable"""
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (q in 0-100), or None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def latency_summary(samples):
+    """p50/p95/p99/mean/max of latency samples, in the samples' own unit"""
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    return {
+        'p50': round(percentile(samples, 50), 3),
+        'p95': round(percentile(samples, 95), 3),
+        'p99': round(percentile(samples, 99), 3),
+        'mean': round(sum(samples) / len(samples), 3),
+        'max': round(max(samples), 3)
+    }
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f'{name}.json')
+
+
+def save_baseline(name, results):
+    """Write results (a dict of metric -> number) with some machine context"""
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = baseline_path(name)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return path
+
+
+def compare_baseline(name, results, tolerance=DEFAULT_TOLERANCE, higher_is_better=(), gated=None):
+    """Return a list of regression messages against a saved baseline
+
+    Metrics are lower-is-better (latencies) unless listed in higher_is_better.
+    Only metrics for which gated(metric) is true are checked (all by default);
+    metrics missing on either side are skipped.
+    """
+    path = baseline_path(name)
+    with open(path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    for metric, value in sorted(results.items()):
+        if gated is not None and not gated(metric):
+            continue
+        old = baseline.get(metric)
+        if not isinstance(old, (int, float)) or not isinstance(value, (int, float)) or old <= 0:
+            continue
+        if metric in higher_is_better:
+            worse = value < old * (1 - tolerance)
+        else:
+            worse = value > old * (1 + tolerance)
+        if worse:
+            regressions.append(f'{metric}: {old} -> {value} ({(value - old) / old:+.0%})')
+    return regressions
+
+
+def report_baseline(args, name, results, higher_is_better=(), gated=None):
+    """Handle --save/--compare for a script; returns a process exit code"""
+    if args.save:
+        print(f'Baseline saved to {save_baseline(name, results)}')
+    if args.compare:
+        try:
+            regressions = compare_baseline(name, results, args.tolerance, higher_is_better, gated)
+        except OSError:
+            print(f'No baseline at {baseline_path(name)}; run with --save first')
+            return 2
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) beyond {args.tolerance:.0%} of the baseline:')
+            for line in regressions:
+                print(f'  {line}')
+            return 1
+        print(f'\nNo regressions beyond {args.tolerance:.0%} of the baseline')
+    return 0
+
+
+def add_baseline_arguments(parser, default_name):
+    parser.add_argument('--baseline', default=default_name,
+                        help=f"baseline name under benchmarks/baselines/ (default: {default_name})")
+    parser.add_argument('--save', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--compare', action='store_true',
+                        help="compare with the baseline and exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f"allowed slowdown before --compare fails (default: {DEFAULT_TOLERANCE})")
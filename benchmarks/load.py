@@ -0,0 +1,232 @@
+"""
+End-to-end load generator for local_server.py
+
+Replays a JSONL corpus of chat requests (one {"message": ..., "history": [...]}
+object per line) against the chat endpoint at a fixed concurrency and reports
+throughput, latency percentiles, time to first token and per-stage Server-Timing.
+
+Usage:
+    python benchmarks/stub_openai.py &
+    OPENAI_API_KEY=sk-stub OPENAI_BASE_URL=http://127.0.0.1:8999/v1 python local_server.py &
+    python benchmarks/load.py --concurrency 16 --requests 500
+    python benchmarks/load.py --stream --duration 30 --save
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import add_baseline_arguments, latency_summary, report_baseline
+
+DEFAULT_URL = 'http://localhost:3001/api/chat'
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.jsonl')
+
+
+def load_corpus(path):
+    """Chat requests from a JSONL file
+
+    Lines may use "message" or "question" for the user message; backlog-style
+    lines with a "title" are replayed using the title as the message.
+    """
+    requests = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            message = record.get('message') or record.get('question') or record.get('title')
+            if message:
+                requests.append({'message': message, 'history': record.get('history', [])})
+    if not requests:
+        raise SystemExit(f"No requests found in {path}")
+    return requests
+
+
+def parse_server_timing(header):
+    """{'stage': ms} from a Server-Timing header value"""
+    stages = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    stages[name] = float(value)
+                except ValueError:
+                    pass
+    return stages
+
+
+def send(url, request, stream, timeout):
+    """Issue one chat request; returns a result dict"""
+    payload = json.dumps(request).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if stream:
+        headers['Accept'] = 'text/event-stream'
+    started = time.perf_counter()
+    result = {'status': None, 'ttfb_ms': None, 'cached': False, 'stages': {}}
+    try:
+        req = urllib.request.Request(url, data=payload, headers=headers, method='POST')
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            result['status'] = response.status
+            result['stages'] = parse_server_timing(response.headers.get('Server-Timing'))
+            if stream:
+                for line in response:
+                    if line.startswith(b'event:'):
+                        event = line[6:].strip().decode('utf-8')
+                        if event == 'token' and result['ttfb_ms'] is None:
+                            result['ttfb_ms'] = (time.perf_counter() - started) * 1000
+                        elif event == 'error':
+                            result['status'] = 'stream_error'
+            else:
+                body = json.loads(response.read() or b'{}')
+                result['cached'] = bool(body.get('cached'))
+                result['ttfb_ms'] = (time.perf_counter() - started) * 1000
+    except urllib.error.HTTPError as e:
+        result['status'] = e.code
+        result['stages'] = parse_server_timing(e.headers.get('Server-Timing'))
+        e.read()
+    except (OSError, ValueError) as e:
+        result['status'] = type(e).__name__
+    result['latency_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def run(url, corpus, concurrency, total, duration, stream, timeout):
+    """Replay the corpus until `total` requests were sent or `duration` seconds passed"""
+    source = itertools.cycle(corpus)
+    source_lock = threading.Lock()
+    results = []
+    results_lock = threading.Lock()
+    sent = [0]
+    deadline = time.monotonic() + duration if duration else None
+
+    def next_request():
+        with source_lock:
+            if total is not None and sent[0] >= total:
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            sent[0] += 1
+            return next(source)
+
+    def worker():
+        while True:
+            request = next_request()
+            if request is None:
+                return
+            result = send(url, request, stream, timeout)
+            with results_lock:
+                results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r['status'] == 200]
+    statuses = {}
+    for r in results:
+        statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+
+    stage_samples = {}
+    for r in ok:
+        for stage, ms in r['stages'].items():
+            stage_samples.setdefault(stage, []).append(ms)
+
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'statuses': statuses,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else None,
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else None,
+        'cached_share': round(sum(r['cached'] for r in ok) / len(ok), 3) if ok else None,
+        'latency_ms': latency_summary([r['latency_ms'] for r in ok]),
+        'ttfb_ms': latency_summary([r['ttfb_ms'] for r in ok if r['ttfb_ms'] is not None]),
+        'server_timing_ms': {stage: latency_summary(samples) for stage, samples in sorted(stage_samples.items())}
+    }
+
+
+def print_summary(summary):
+    print(f"\nRequests: {summary['requests']} ({summary['ok']} ok) in {summary['elapsed_s']}s")
+    print(f"Statuses: {summary['statuses']}")
+    print(f"Throughput: {summary['throughput_rps']} req/s")
+    print(f"Error rate: {summary['error_rate'] or 0:.2%}   Cached answers: {summary['cached_share']}")
+    print(f"\n{'':<18} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    rows = [('latency', summary['latency_ms']), ('first token', summary['ttfb_ms'])]
+    rows += [(f'  {stage}', s) for stage, s in summary['server_timing_ms'].items()]
+    for label, s in rows:
+        if s['p50'] is None:
+            continue
+        print(f"{label:<18} {s['p50']:>10.1f} {s['p95']:>10.1f} {s['p99']:>10.1f} {s['max']:>10.1f}")
+
+
+def flatten(summary):
+    """Numeric metrics for the baseline file"""
+    results = {
+        'throughput_rps': summary['throughput_rps'],
+        'error_rate': summary['error_rate']
+    }
+    for group in ('latency_ms', 'ttfb_ms'):
+        for q in ('p50', 'p95', 'p99'):
+            results[f'{group}.{q}'] = summary[group][q]
+    for stage, s in summary['server_timing_ms'].items():
+        results[f'server_timing_ms.{stage}.p50'] = s['p50']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a chat corpus against local_server.py")
+    parser.add_argument('--url', default=DEFAULT_URL)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="JSONL file of chat requests")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=None,
+                        help="total requests to send (default: one pass over the corpus)")
+    parser.add_argument('--duration', type=float, default=None, help="run for this many seconds instead")
+    parser.add_argument('--stream', action='store_true', help="request Server-Sent Events")
+    parser.add_argument('--timeout', type=float, default=60.0, help="per-request timeout in seconds")
+    parser.add_argument('--warmup', type=int, default=0, help="requests to send before measuring")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    add_baseline_arguments(parser, 'load')
+    args = parser.parse_args(argv)
+
+    if args.stream and args.baseline == 'load':
+        # Streamed and JSON runs measure different things; keep separate baselines
+        args.baseline = 'load-stream'
+    corpus = load_corpus(args.corpus)
+    total = args.requests if args.requests is not None or args.duration else len(corpus)
+    if args.warmup:
+        run(args.url, corpus, min(args.concurrency, args.warmup), args.warmup, None, args.stream, args.timeout)
+
+    mode = 'stream' if args.stream else 'json'
+    print(f"Replaying {len(corpus)} requests against {args.url} ({mode}, concurrency {args.concurrency})")
+    results, elapsed = run(args.url, corpus, args.concurrency, total, args.duration, args.stream, args.timeout)
+    summary = summarize(results, elapsed)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+    # End-to-end medians and p95 are stable enough to gate on; p99 of a short run is not
+    return report_baseline(
+        args, args.baseline, flatten(summary),
+        higher_is_better=('throughput_rps',),
+        gated=lambda metric: metric == 'throughput_rps' or metric in (
+            'latency_ms.p50', 'latency_ms.p95', 'ttfb_ms.p50', 'ttfb_ms.p95')
+    )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
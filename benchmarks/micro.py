@@ -0,0 +1,174 @@
+"""
+Microbenchmarks for the retrieval path on synthetic knowledge bases
+
+Times chunk_knowledge_base, index construction, semantic search and
+build_context on knowledge bases of 10 to 10,000 chunks.
+
+Usage:
+    python benchmarks/micro.py
+    python benchmarks/micro.py --sizes 10 1000 --backend bm25
+    python benchmarks/micro.py --save            # record a baseline
+    python benchmarks/micro.py --compare         # fail on a regression
+"""
+import argparse
+import itertools
+import random
+import sys
+import time
+
+from _common import add_baseline_arguments, latency_summary, report_baseline, use_api_modules
+
+use_api_modules()
+from _retrieval import BACKENDS, DEFAULT_BACKEND, RetrievalIndex  # noqa: E402
+from _service import ChatService, chunk_knowledge_base  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+QUERIES = [
+    "What projects has he worked on?",
+    "Tell me about his machine learning experience",
+    "Which databases does he know?",
+    "Where did he study and what courses did he take?",
+    "Has he used XGBoost or random forests?",
+    "What did he do as a data analyst?",
+]
+
+# Domain words plus filler, drawn with a skewed distribution so term
+# frequencies look like real text rather than uniform noise
+_DOMAIN_WORDS = (
+    "python sql pandas numpy scikit learn xgboost tableau power bi postgresql mysql "
+    "mongodb machine learning model regression classification forecasting dashboard "
+    "pipeline etl analytics data analyst engineer scientist research university "
+    "statistics visualization customer churn sales revenue marketing experiment "
+    "feature engineering deployment api cloud aws docker spark hadoop airflow "
+    "recommendation clustering nlp sentiment time series optimization reporting"
+).split()
+_FILLER_WORDS = (
+    "built designed improved led developed analyzed created automated reduced "
+    "increased delivered team project results using across multiple new key "
+    "weekly monthly stakeholders insights process quality accuracy performance"
+).split()
+
+
+def _sentence(rng, words=12):
+    vocabulary = _DOMAIN_WORDS + _FILLER_WORDS
+    # Zipf-like: early words in the list are picked far more often
+    picks = [vocabulary[min(len(vocabulary) - 1, int(rng.paretovariate(1.2)) - 1)] for _ in range(words // 2)]
+    picks += rng.sample(vocabulary, words - len(picks))
+    rng.shuffle(picks)
+    return ' '.join(picks).capitalize() + '.'
+
+
+def synthetic_knowledge_base(chunks, seed=0):
+    """A knowledge-base.json-shaped dict that chunks into exactly `chunks` chunks
+
+    Under the field-level chunker an experience entry is a parent plus one chunk
+    per responsibility, and a project a parent plus description, problem,
+    outcome and technologies chunks.
+    """
+    rng = random.Random(seed)
+    skills = {
+        'programming': ['Python', 'SQL', 'R'],
+        'libraries': ['pandas', 'NumPy', 'scikit-learn', 'XGBoost'],
+        'databases': ['PostgreSQL', 'MySQL'],
+        'visualization': ['Tableau', 'Power BI']
+    }
+    kb = {'about': {'name': 'Synthetic Person', 'summary': ' '.join(_sentence(rng) for _ in range(3))}}
+    remaining = chunks - 1
+    if remaining >= 1:
+        kb['education'] = {
+            'degree': 'BSc Statistics',
+            'institution': 'Synthetic University',
+            'graduation': '2020',
+            'coursework': ['Machine Learning', 'Databases', 'Probability']
+        }
+        remaining -= 1
+    if remaining >= 1:
+        # The skills parent, then one chunk per category
+        categories = min(len(skills), remaining - 1)
+        kb['about']['skills'] = dict(list(skills.items())[:categories])
+        remaining -= 1 + categories
+    kb['experience'], kb['projects'] = [], []
+    i = 0
+    while remaining > 0:
+        if i % 3 == 0 or remaining < 5:
+            responsibilities = min(3, remaining - 1)
+            kb['experience'].append({
+                'role': 'Data Analyst',
+                'company': f'Company {i}',
+                'period': '2021 - 2023',
+                'responsibilities': [_sentence(rng) for _ in range(responsibilities)]
+            })
+            remaining -= 1 + responsibilities
+        else:
+            kb['projects'].append({
+                'id': f'project-{i}',
+                'title': f'Project {i}',
+                'category': rng.choice(['Machine Learning', 'Analytics', 'Data Engineering']),
+                'description': _sentence(rng, 20),
+                'problem': _sentence(rng),
+                'outcome': _sentence(rng),
+                'technologies': rng.sample(_DOMAIN_WORDS, 4)
+            })
+            remaining -= 5
+        i += 1
+    return kb
+
+
+def measure(func, min_time=0.2, max_runs=10000):
+    """Run func repeatedly for about min_time seconds; return per-call latencies in microseconds"""
+    func()  # Warm-up
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs and (time.perf_counter() - started < min_time or len(samples) < 5):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1e6)
+    return samples
+
+
+def run(sizes, backend, min_time):
+    service = ChatService()
+    results = {}
+    print(f"{'chunks':>7} {'stage':<16} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10} {'runs':>7}")
+    for size in sizes:
+        kb = synthetic_knowledge_base(size)
+        chunks = chunk_knowledge_base(kb)
+        index = RetrievalIndex(chunks, backend=backend)
+        query_iter = itertools.cycle(QUERIES)
+        search_results = index.search(QUERIES[0], top_k=5)
+
+        stages = [
+            ('chunk', lambda: chunk_knowledge_base(kb), min_time),
+            ('index_build', lambda: RetrievalIndex(chunks, backend=backend), min_time),
+            # What ChatService.semantic_search does against the warm process index
+            ('semantic_search', lambda: index.search(next(query_iter), top_k=5), min_time),
+            ('build_context', lambda: service.build_context(search_results), min_time),
+        ]
+        for stage, func, budget in stages:
+            samples = measure(func, budget)
+            summary = latency_summary(samples)
+            print(f"{len(chunks):>7} {stage:<16} {summary['p50']:>10.1f} {summary['p95']:>10.1f} "
+                  f"{summary['p99']:>10.1f} {len(samples):>7}")
+            for q in ('p50', 'p95', 'p99'):
+                results[f'{backend}.{size}.{stage}.{q}_us'] = summary[q]
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retrieval microbenchmarks on synthetic knowledge bases")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="knowledge base sizes in chunks")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default=DEFAULT_BACKEND)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="seconds spent timing each stage per size")
+    add_baseline_arguments(parser, 'micro')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.backend, args.min_time)
+    # Tail latencies of microsecond-scale calls are mostly scheduler noise; gate on medians
+    return report_baseline(args, args.baseline, results, gated=lambda metric: metric.endswith('.p50_us'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""
+Dense embedding retrieval against the TF-IDF path
+
+Part one asks labelled questions about the real knowledge base
+(retrieval_queries.jsonl, mostly paraphrases that share few words with the
+chunks) and reports recall@k and search latency per backend. Part two times
+search on synthetic knowledge bases of growing size, and measures how much of
+exact float32 search's top-k the int8 store and IVF probing keep.
+
+Usage:
+    python benchmarks/retrieval.py --model models/potion-base-8M
+    python benchmarks/retrieval.py --model models/potion-base-8M --sizes 10000 100000 --ivf-lists 256
+    python benchmarks/retrieval.py --model random    # random weights: latency only, recall is meaningless
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+from _common import add_baseline_arguments, latency_summary, report_baseline, use_api_modules
+from load import DEFAULT_CORPUS, load_corpus
+from micro import _DOMAIN_WORDS, _FILLER_WORDS, QUERIES, measure, synthetic_knowledge_base
+
+use_api_modules()
+import numpy as np  # noqa: E402
+from _embeddings import MODEL_PATH, DenseBackend, EmbeddingError, StaticEmbeddingModel, load_model  # noqa: E402
+from _retrieval import RetrievalIndex, partition_top  # noqa: E402
+from _service import chunk_knowledge_base, load_knowledge_base  # noqa: E402
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrieval_queries.jsonl')
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+
+def random_model(texts, dimensions=256, seed=0):
+    """Random static embeddings over the words in texts: realistic cost, meaningless neighbours"""
+    words = sorted({word for text in texts for word in re.findall(r'\w+', text.lower())})
+    vocabulary = {'[UNK]': 0, **{word: i + 1 for i, word in enumerate(words)}}
+    embeddings = np.random.default_rng(seed).standard_normal((len(vocabulary), dimensions)).astype(np.float32)
+    return StaticEmbeddingModel(embeddings, vocabulary, name='random')
+
+
+def retrieved_ids(results):
+    """Chunk IDs behind search results; merged chunks list their members"""
+    return {chunk_id for chunk in results for chunk_id in chunk['id'].split('+')}
+
+
+def labelled(index, questions, top_k, min_time):
+    """(mean recall@k, search latency summary in us) of an index on labelled questions"""
+    recalls = []
+    for question in questions:
+        found = retrieved_ids(index.search(question['query'], top_k))
+        relevant = set(question['relevant'])
+        recalls.append(len(relevant & found) / len(relevant))
+    cycle = iter(questions * 10000)
+    samples = measure(lambda: index.search(next(cycle)['query'], top_k), min_time)
+    return sum(recalls) / len(recalls), latency_summary(samples)
+
+
+def overlap(expected, actual):
+    """Share of the expected top-k indices that made it into the actual top-k"""
+    return sum(len(set(e) & set(a)) / len(e) for e, a in zip(expected, actual)) / len(expected)
+
+
+def run_labelled(model, questions, top_k, min_time):
+    chunks = chunk_knowledge_base(load_knowledge_base())
+    indexes = [('tfidf', RetrievalIndex(chunks, backend='tfidf'))]
+    if model is not None:
+        backend = DenseBackend([chunk['text'] for chunk in chunks], model, store_path=None, ivf_lists=0)
+        indexes.append(('dense', RetrievalIndex.from_backend(chunks, backend)))
+    results = {}
+    print(f"Knowledge base: {len(chunks)} chunks, {len(questions)} labelled questions\n")
+    print(f"{'backend':<8} {f'recall@{top_k}':>10} {'p50 us':>10} {'p95 us':>10}")
+    for name, index in indexes:
+        recall, summary = labelled(index, questions, top_k, min_time)
+        print(f"{name:<8} {recall:>10.3f} {summary['p50']:>10.1f} {summary['p95']:>10.1f}")
+        results[f'kb.{name}.recall_at_{top_k}'] = round(recall, 3)
+        results[f'kb.{name}.search.p50_us'] = summary['p50']
+    return results
+
+
+def run_synthetic(model, sizes, queries, top_k, ivf_lists, probe, min_time):
+    results = {}
+    print(f"\n{'chunks':>7} {'variant':<10} {'top-k us':>10} {'search us':>10} {'p95 us':>10} {f'recall@{top_k}':>10}")
+    for size in sizes:
+        chunks = chunk_knowledge_base(synthetic_knowledge_base(size))
+        texts = [chunk['text'] for chunk in chunks]
+        variants = [('tfidf', RetrievalIndex(chunks, backend='tfidf'), None)]
+        if model is not None:
+            # Exact float32 search is the reference the int8 and IVF variants are held to
+            vectors = model.encode(texts)
+            query_vectors = model.encode(queries)
+            exact = [partition_top(vectors @ query, top_k).tolist() for query in query_vectors]
+            backends = [('int8', DenseBackend(texts, model, store_path=None, ivf_lists=0))]
+            ivf = DenseBackend(texts, model, store_path=None, ivf_lists=ivf_lists, probe=probe)
+            if ivf.centroids is not None:
+                backends.append((f'ivf{ivf_lists}/{probe}', ivf))
+            for name, backend in backends:
+                found = [partition_top(row, top_k).tolist() for row in backend.similarity_matrix(queries)]
+                variants.append((name, RetrievalIndex.from_backend(chunks, backend), overlap(exact, found)))
+        for name, index, recall in variants:
+            # top-k: the backend's scores and argpartition alone; search: the whole hybrid
+            # path the chat service runs (keyword blend, thresholds, merging under parents)
+            cycle = iter(queries * 100000)
+            backend_only = latency_summary(measure(
+                lambda: partition_top(np.asarray(index.backend.similarities(next(cycle)), dtype=np.float64), top_k),
+                min_time
+            ))
+            summary = latency_summary(measure(lambda: index.search(next(cycle), top_k), min_time))
+            shown = f'{recall:>10.3f}' if recall is not None else f"{'-':>10}"
+            print(f"{len(chunks):>7} {name:<10} {backend_only['p50']:>10.1f} {summary['p50']:>10.1f} "
+                  f"{summary['p95']:>10.1f} {shown}")
+            key = name.split('/')[0]
+            results[f'{key}.{size}.top_k.p50_us'] = backend_only['p50']
+            results[f'{key}.{size}.search.p50_us'] = summary['p50']
+            if recall is not None:
+                results[f'{key}.{size}.recall_at_{top_k}'] = round(recall, 3)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall and latency of dense retrieval against TF-IDF")
+    parser.add_argument('--model', default=MODEL_PATH,
+                        help="embedding model directory, or 'random' (default: CHAT_EMBEDDING_MODEL)")
+    parser.add_argument('--queries', default=DEFAULT_QUERIES, help="JSONL of labelled questions")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="synthetic knowledge base sizes in chunks")
+    parser.add_argument('-k', '--top-k', type=int, default=5)
+    parser.add_argument('--ivf-lists', type=int, default=64)
+    parser.add_argument('--probe', type=int, default=8, help="IVF lists scanned per query")
+    parser.add_argument('--min-time', type=float, default=0.3, help="seconds spent timing each variant")
+    add_baseline_arguments(parser, 'retrieval')
+    args = parser.parse_args(argv)
+
+    with open(args.queries, 'r', encoding='utf-8') as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    queries = list(dict.fromkeys(QUERIES + [item['message'] for item in load_corpus(DEFAULT_CORPUS)]))
+
+    model = None
+    if args.model == 'random':
+        texts = [c['text'] for c in chunk_knowledge_base(load_knowledge_base())]
+        texts += [q['query'] for q in questions] + queries + [' '.join(_DOMAIN_WORDS + _FILLER_WORDS)]
+        model = random_model(texts)
+        print("Random embeddings: latencies are real, recall against the labels is not\n")
+    elif args.model:
+        try:
+            model = load_model(args.model)
+        except EmbeddingError as e:
+            sys.exit(str(e))
+    else:
+        print("No embedding model (--model or CHAT_EMBEDDING_MODEL): TF-IDF only\n")
+
+    results = run_labelled(model, questions, args.top_k, args.min_time)
+    results.update(run_synthetic(model, args.sizes, queries, args.top_k, args.ivf_lists, args.probe, args.min_time))
+    recall_metrics = tuple(metric for metric in results if '.recall_at_' in metric)
+    return report_baseline(args, args.baseline, results, higher_is_better=recall_metrics,
+                           gated=lambda metric: metric.endswith('.p50_us') or metric in recall_metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
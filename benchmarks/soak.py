@@ -0,0 +1,191 @@
+"""
+Memory soak test for local_server.py
+
+Drives thousands of chat requests through a server backed by the stub upstream
+and fails when the server's resident memory grows by more than a threshold per
+request, the signature of a per-request leak. By default it starts the stub and
+a server itself, with the caches off so every request runs the whole pipeline.
+
+Usage:
+    python benchmarks/soak.py --requests 20000
+    python benchmarks/soak.py --tracemalloc --max-bytes-per-request 512
+    python benchmarks/soak.py --url http://localhost:3001/api/chat   # an already running server
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from _common import ROOT_DIR, add_baseline_arguments, report_baseline
+from load import DEFAULT_CORPUS, load_corpus, run, summarize
+
+# A request may leave this much resident memory behind on average
+DEFAULT_MAX_BYTES_PER_REQUEST = 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_gauges(metrics_url):
+    """Unlabelled gauge values from a Prometheus /metrics page"""
+    with urllib.request.urlopen(metrics_url, timeout=10) as response:
+        text = response.read().decode('utf-8')
+    gauges = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '{' in line:
+            continue
+        name, _, value = line.partition(' ')
+        try:
+            gauges[name] = float(value)
+        except ValueError:
+            pass
+    return gauges
+
+
+def wait_until_ready(url, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return
+        except (OSError, urllib.error.URLError):
+            time.sleep(0.2)
+    raise SystemExit(f"Server at {url} did not come up in {timeout:g}s")
+
+
+def spawn(args):
+    """Start the stub upstream and a local_server.py process; returns (chat URL, processes)"""
+    stub_port, server_port = free_port(), free_port()
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, 'benchmarks', 'stub_openai.py'), '--port', str(stub_port),
+         '--latency', str(args.stub_latency), '--jitter', '0', '--token-delay', '0'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='sk-stub',
+        OPENAI_BASE_URL=f'http://127.0.0.1:{stub_port}/v1',
+        CHAT_LOG_JSON='0',
+        CHAT_CACHE_PATH='',
+        CHAT_SESSION_DB='',
+        CHAT_CACHE_SIZE='0',
+        CHAT_SEMANTIC_CACHE_SIZE='0',
+        # One client sends everything; keep admission control out of the way
+        CHAT_CLIENT_RPM='0',
+        CHAT_UPSTREAM_RPM='1000000',
+        CHAT_UPSTREAM_TPM='1000000000',
+        # Latency windows fill up during the warm-up instead of growing through the soak
+        CHAT_METRICS_WINDOW='256',
+        CHAT_MEMPROFILE='1' if args.tracemalloc else '0',
+        CHAT_MEMPROFILE_EVERY=str(args.snapshot_every),
+    )
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, 'local_server.py'), '--port', str(server_port),
+         '--threads', str(args.concurrency), '--no-static'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{server_port}/api/chat'
+    try:
+        wait_until_ready(url)
+    except BaseException:
+        stop([stub, server])
+        raise
+    return url, [stub, server]
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fail when local_server.py leaks memory per request")
+    parser.add_argument('--url', default=None, help="chat endpoint of a running server (default: start one)")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="JSONL file of chat requests")
+    parser.add_argument('--requests', type=int, default=10000, help="requests in the measured phase")
+    parser.add_argument('--warmup', type=int, default=1000,
+                        help="requests before the first reading, so pools and caches reach steady state")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--stream', action='store_true', help="request Server-Sent Events")
+    parser.add_argument('--max-bytes-per-request', type=float, default=DEFAULT_MAX_BYTES_PER_REQUEST,
+                        help="memory growth per request that fails the run: RSS, or traced memory with "
+                             f"--tracemalloc (default: {DEFAULT_MAX_BYTES_PER_REQUEST})")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="run the spawned server with CHAT_MEMPROFILE=1 and show its top growth sites")
+    parser.add_argument('--snapshot-every', type=int, default=2000, help="requests between tracemalloc snapshots")
+    parser.add_argument('--stub-latency', type=float, default=5.0, help="stub time to first byte in ms")
+    add_baseline_arguments(parser, 'soak')
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus)
+    processes = []
+    url = args.url
+    if url is None:
+        url, processes = spawn(args)
+    metrics_url = url.split('/api/', 1)[0] + '/metrics'
+    try:
+        print(f"Warming up with {args.warmup} requests against {url}")
+        run(url, corpus, args.concurrency, args.warmup, None, args.stream, 60.0)
+        before = read_gauges(metrics_url)
+        if 'process_resident_memory_bytes' not in before:
+            raise SystemExit(f"{metrics_url} does not report process_resident_memory_bytes")
+
+        print(f"Soaking with {args.requests} requests (concurrency {args.concurrency})")
+        results, elapsed = run(url, corpus, args.concurrency, args.requests, None, args.stream, 60.0)
+        after = read_gauges(metrics_url)
+        with urllib.request.urlopen(url, timeout=10) as response:
+            memory = json.loads(response.read()).get('memory') or {}
+    finally:
+        stop(processes)
+
+    summary = summarize(results, elapsed)
+    growth = after['process_resident_memory_bytes'] - before['process_resident_memory_bytes']
+    per_request = growth / max(1, len(results))
+    print(f"\nRequests: {summary['requests']} ({summary['ok']} ok) in {summary['elapsed_s']}s, "
+          f"{summary['throughput_rps']} req/s, statuses {summary['statuses']}")
+    print(f"RSS: {before['process_resident_memory_bytes'] / 2**20:.1f} MB -> "
+          f"{after['process_resident_memory_bytes'] / 2**20:.1f} MB "
+          f"({growth / 2**10:+.0f} KB, {per_request:+.1f} bytes/request)")
+    results_for_baseline = {'rss_bytes_per_request': round(max(per_request, 0.0), 1)}
+    if 'chat_traced_memory_bytes' in before and 'chat_traced_memory_bytes' in after:
+        traced = (after['chat_traced_memory_bytes'] - before['chat_traced_memory_bytes']) / max(1, len(results))
+        print(f"Traced Python memory: {traced:+.1f} bytes/request")
+        results_for_baseline['traced_bytes_per_request'] = round(max(traced, 0.0), 1)
+    snapshot = memory.get('last_snapshot')
+    if snapshot and snapshot.get('top_growth'):
+        print(f"\nTop growth in the last snapshot (at request {snapshot['requests']}):")
+        for site in snapshot['top_growth']:
+            print(f"  {site['size_diff']:>+10} B {site['count_diff']:>+7} blocks  {site['site']}")
+
+    # tracemalloc's own bookkeeping inflates RSS, so a traced run is judged on traced memory
+    gated, label = per_request, 'RSS'
+    if 'traced_bytes_per_request' in results_for_baseline:
+        gated, label = results_for_baseline['traced_bytes_per_request'], 'traced'
+    failed = False
+    if summary['ok'] < len(results):
+        print(f"\nFAIL: {len(results) - summary['ok']} requests did not succeed")
+        failed = True
+    if gated > args.max_bytes_per_request:
+        print(f"\nFAIL: {gated:.1f} {label} bytes/request exceeds {args.max_bytes_per_request:g}")
+        failed = True
+    elif not failed:
+        print(f"\nOK: {gated:.1f} {label} bytes/request is within {args.max_bytes_per_request:g}")
+    code = report_baseline(args, args.baseline, results_for_baseline)
+    return 1 if failed else code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+OpenAI-compatible stub server for load tests
+
+Answers POST /v1/chat/completions (plain and streamed) with canned text after a
+configurable delay, and injects errors and hangs at configurable rates, so the
+chat path can be load-tested without an API key or API costs.
+
+Usage:
+    python benchmarks/stub_openai.py --port 8999 --latency 300 --token-delay 20
+    python benchmarks/stub_openai.py --error-rate 0.05 --error-status 429
+
+Point the chat server at it with:
+    OPENAI_API_KEY=sk-stub OPENAI_BASE_URL=http://127.0.0.1:8999/v1 python local_server.py
+"""
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+ANSWER = (
+    "He has worked on several data science projects, including machine learning models "
+    "for forecasting and classification, interactive dashboards and automated data "
+    "pipelines. Feel free to ask about any of them in more detail!"
+)
+
+
+class StubConfig:
+    """Latency and fault-injection settings, shared by every request"""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, token_delay_ms=15.0, tokens=40,
+                 error_rate=0.0, error_status=503, hang_rate=0.0, hang_seconds=60.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_delay_ms = token_delay_ms
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'streamed': 0, 'errors': 0, 'hangs': 0}
+        self.lock = threading.Lock()
+
+    def decide(self):
+        """Pick this request's fate: 'ok', 'error' or 'hang', plus its first-byte delay"""
+        with self.lock:
+            self.counts['requests'] += 1
+            roll = self.random.random()
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            if roll < self.error_rate:
+                self.counts['errors'] += 1
+                return 'error', delay
+            if roll < self.error_rate + self.hang_rate:
+                self.counts['hangs'] += 1
+                return 'hang', delay
+            return 'ok', delay
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions implementation"""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            with self.config.lock:
+                self.send_json(200, dict(self.config.counts))
+        else:
+            self.send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400, {'error': {'message': 'Invalid JSON', 'type': 'invalid_request_error'}})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+            return
+
+        fate, delay = self.config.decide()
+        time.sleep(delay)
+        if fate == 'error':
+            status = self.config.error_status
+            self.send_json(status, {'error': {'message': f'Injected {status} from stub', 'type': 'stub_error'}})
+            return
+        if fate == 'hang':
+            # Hold the connection without answering, like a stalled upstream
+            time.sleep(self.config.hang_seconds)
+            self.close_connection = True
+            return
+
+        words = (ANSWER.split(' ') * (self.config.tokens // len(ANSWER.split(' ')) + 1))[:self.config.tokens]
+        prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in body.get('messages', []))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(words),
+            'total_tokens': prompt_tokens + len(words)
+        }
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage')
+            self.send_stream(body.get('model', 'stub'), words, usage if include_usage else None)
+        else:
+            self.send_json(200, {
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'stub'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ' '.join(words)},
+                    'finish_reason': 'stop'
+                }],
+                'usage': usage
+            })
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, model, words, usage):
+        """Server-Sent Events in the chat.completion.chunk format, chunked transfer encoding"""
+        with self.config.lock:
+            self.config.counts['streamed'] += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(data):
+            frame = f'data: {data}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(frame):x}\r\n'.encode('ascii') + frame + b'\r\n')
+            self.wfile.flush()
+
+        def event(choices, **extra):
+            return json.dumps({
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': choices,
+                **extra
+            })
+
+        try:
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(self.config.token_delay_ms / 1000)
+                content = word if i == 0 else ' ' + word
+                chunk(event([{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]))
+            chunk(event([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+            if usage:
+                chunk(event([], usage=usage))
+            chunk('[DONE]')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, config):
+        self.config = config
+        super().__init__(server_address, StubHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for load tests")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--latency', type=float, default=200.0, help="time to first byte in ms")
+    parser.add_argument('--jitter', type=float, default=50.0, help="uniform +/- jitter on the latency in ms")
+    parser.add_argument('--token-delay', type=float, default=15.0, help="delay between streamed tokens in ms")
+    parser.add_argument('--tokens', type=int, default=40, help="words per answer")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of injected failures")
+    parser.add_argument('--hang-rate', type=float, default=0.0, help="fraction of requests that never answer")
+    parser.add_argument('--hang-seconds', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config = StubConfig(
+        latency_ms=args.latency, jitter_ms=args.jitter, token_delay_ms=args.token_delay,
+        tokens=args.tokens, error_rate=args.error_rate, error_status=args.error_status,
+        hang_rate=args.hang_rate, hang_seconds=args.hang_seconds, seed=args.seed
+    )
+    server = StubServer((args.host, args.port), config)
+    print(f"OpenAI stub listening on http://{args.host}:{args.port}/v1 "
+          f"(latency {args.latency:.0f}ms, errors {args.error_rate:.0%}, hangs {args.hang_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
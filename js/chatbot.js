@@ -3,6 +3,7 @@
   'use strict';
 
   const STORAGE_KEY = 'chatbot-history';
+  const SESSION_KEY = 'chatbot-session';
   // Use local server if running on localhost, otherwise use production
   const API_ENDPOINT = (typeof window !== 'undefined' && 
                         window.location && 
@@ -10,6 +11,12 @@
                          window.location.hostname === '127.0.0.1')) 
                         ? 'http://localhost:3001/api/chat' 
                         : '/api/chat';
+  // Stream tokens as Server-Sent Events; falls back to JSON if the server doesn't
+  const STREAM_RESPONSES = true;
+  // Keep the conversation on the server and send only the new message plus a session ID
+  const USE_SESSIONS = true;
+  // Wait out a busy server once if it asks for no more than this (seconds)
+  const MAX_RETRY_AFTER = 10;
 
   function initChatbot() {
     console.log('Chatbot: Initializing...');
@@ -30,6 +37,7 @@
     const clearHistoryButton = chatbot.querySelector('.chatbot__clear-history');
 
     let conversationHistory = loadHistory();
+    let sessionId = loadSessionId();
     let isProcessing = false;
 
     // Initialize UI
@@ -133,11 +141,7 @@
       const typingId = showTypingIndicator();
 
       try {
-        // Log the request for debugging
-        const requestBody = {
-          message: message,
-          history: conversationHistory.slice(-10), // Last 10 messages for context
-        };
+        let requestBody = buildRequestBody(message);
         
         // Use absolute URL if on Vercel to avoid path resolution issues
         let endpoint = API_ENDPOINT;
@@ -149,36 +153,22 @@
           // If still relative, use as-is (browser will resolve it)
         }
         
-        // Try the fetch with error handling
-        // Use cache: 'no-store' to bypass service worker cache
-        let response;
-        try {
-          response = await fetch(endpoint, {
-            method: 'POST',
-            headers: {
-              'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(requestBody),
-            mode: 'cors',
-            credentials: 'omit',
-            cache: 'no-store', // Bypass any caching
-          });
-        } catch (fetchError) {
-          // Try one more time with a slight delay in case of timing issues
-          await new Promise(resolve => setTimeout(resolve, 100));
-          try {
-            response = await fetch(endpoint, {
-              method: 'POST',
-              headers: {
-                'Content-Type': 'application/json',
-              },
-              body: JSON.stringify(requestBody),
-              mode: 'cors',
-              credentials: 'omit',
-              cache: 'no-store',
-            });
-          } catch (retryError) {
-            throw fetchError; // Throw original error
+        let response = await postChat(endpoint, requestBody);
+        
+        // The server lost the session (expired or another instance) - start over from local history
+        if (response.status === 409 && requestBody.session_id) {
+          sessionId = null;
+          saveSessionId();
+          requestBody = buildRequestBody(message);
+          response = await postChat(endpoint, requestBody);
+        }
+
+        // Rate limited or shed under load - wait as told, then try once more
+        if (response.status === 429 || response.status === 503) {
+          const retryAfter = Number(response.headers.get('Retry-After'));
+          if (retryAfter > 0 && retryAfter <= MAX_RETRY_AFTER) {
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            response = await postChat(endpoint, requestBody);
           }
         }
 
@@ -198,6 +188,23 @@
           throw new Error(`Server error (${response.status}): ${errorText.substring(0, 100)}`);
         }
 
+        if (USE_SESSIONS && response.headers.get('X-Chat-Session')) {
+          sessionId = response.headers.get('X-Chat-Session');
+          saveSessionId();
+        }
+
+        const contentType = response.headers.get('Content-Type') || '';
+        if (contentType.includes('text/event-stream') && response.body) {
+          hideTypingIndicator(typingId);
+          const reply = await renderStreamedMessage(response);
+          conversationHistory.push({ role: 'assistant', content: reply });
+          saveHistory();
+          if (clearHistoryButton && conversationHistory.length > 1) {
+            clearHistoryButton.style.display = 'block';
+          }
+          return;
+        }
+
         let data;
         try {
           data = await response.json();
@@ -315,6 +322,84 @@
       }
     }
 
+    async function renderStreamedMessage(response) {
+      // Render tokens into a new assistant message as the server sends them
+      const messageDiv = document.createElement('div');
+      messageDiv.className = 'chatbot__message chatbot__message--assistant';
+
+      const avatar = document.createElement('div');
+      avatar.className = 'chatbot__message-avatar';
+      avatar.textContent = 'AI';
+
+      const messageContent = document.createElement('div');
+      messageContent.className = 'chatbot__message-content';
+
+      messageDiv.appendChild(avatar);
+      messageDiv.appendChild(messageContent);
+      messagesContainer.appendChild(messageDiv);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let text = '';
+
+      try {
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          // Events are separated by a blank line
+          let boundary;
+          while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const event = parseEvent(frame);
+            if (!event) continue;
+
+            if (event.type === 'token') {
+              text += event.data.content || '';
+              messageContent.textContent = text;
+              scrollToBottom();
+            } else if (event.type === 'done') {
+              text = event.data.response || text;
+              messageContent.textContent = text;
+              return text;
+            } else if (event.type === 'error') {
+              throw new Error(event.data.message || event.data.error || 'Stream error');
+            }
+          }
+        }
+      } catch (error) {
+        messageDiv.remove();
+        throw error;
+      }
+
+      if (!text) {
+        messageDiv.remove();
+        throw new Error('No response from server');
+      }
+      return text;
+    }
+
+    function parseEvent(frame) {
+      let type = 'message';
+      let data = '';
+      frame.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+          type = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          data += line.slice(5).trim();
+        }
+      });
+      if (!data) return null;
+      try {
+        return { type: type, data: JSON.parse(data) };
+      } catch (e) {
+        return null;
+      }
+    }
+
     function showTypingIndicator() {
       const typingDiv = document.createElement('div');
       typingDiv.className = 'chatbot__message chatbot__message--assistant';
@@ -382,6 +467,67 @@
       }, 100);
     }
 
+    function buildRequestBody(message) {
+      const body = { message: message, stream: STREAM_RESPONSES };
+      if (USE_SESSIONS && sessionId) {
+        body.session_id = sessionId;
+      } else if (USE_SESSIONS) {
+        // Seed a new session with the earlier turns; the new message is sent separately
+        body.session = true;
+        body.history = conversationHistory.slice(0, -1).slice(-10);
+      } else {
+        body.history = conversationHistory.slice(-10); // Last 10 messages for context
+      }
+      return body;
+    }
+
+    async function postChat(endpoint, requestBody) {
+      // Try the fetch with error handling
+      // Use cache: 'no-store' to bypass service worker cache
+      const options = {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Accept': STREAM_RESPONSES ? 'text/event-stream, application/json' : 'application/json',
+        },
+        body: JSON.stringify(requestBody),
+        mode: 'cors',
+        credentials: 'omit',
+        cache: 'no-store', // Bypass any caching
+      };
+      try {
+        return await fetch(endpoint, options);
+      } catch (fetchError) {
+        // Try one more time with a slight delay in case of timing issues
+        await new Promise(resolve => setTimeout(resolve, 100));
+        try {
+          return await fetch(endpoint, options);
+        } catch (retryError) {
+          throw fetchError; // Throw original error
+        }
+      }
+    }
+
+    function loadSessionId() {
+      try {
+        return localStorage.getItem(SESSION_KEY);
+      } catch (error) {
+        return null;
+      }
+    }
+
+    function saveSessionId() {
+      try {
+        if (sessionId) {
+          localStorage.setItem(SESSION_KEY, sessionId);
+        } else {
+          localStorage.removeItem(SESSION_KEY);
+        }
+      } catch (error) {
+        // Silently fail - the next message starts a new session
+      }
+    }
+
     function loadHistory() {
       try {
         const stored = localStorage.getItem(STORAGE_KEY);
@@ -415,6 +561,8 @@
     function clearHistory() {
       conversationHistory = [];
       localStorage.removeItem(STORAGE_KEY);
+      sessionId = null;
+      saveSessionId();
       messagesContainer.innerHTML = '';
       if (clearHistoryButton) {
         clearHistoryButton.style.display = 'none';
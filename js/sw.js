@@ -37,8 +37,12 @@ self.addEventListener('fetch', (e) => {
   e.respondWith(
     caches.match(req).then((cached) =>
       cached || fetch(req).then((res) => {
-        const copy = res.clone();
-        caches.open(CACHE).then((c) => c.put(req, copy));
+        // Only whole, successful responses: a 206 from a Range request (the resume
+        // PDF) can't be stored, and an error page shouldn't be served offline
+        if (res.status === 200) {
+          const copy = res.clone();
+          caches.open(CACHE).then((c) => c.put(req, copy));
+        }
         return res;
       })
     )
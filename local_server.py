@@ -1,16 +1,27 @@
 """
 Local development server for testing the chatbot API
-Run this script to test the chatbot locally before deploying to Vercel
+Run this script to test the chatbot locally before deploying to Vercel; it also
+serves the site itself (index.html, css/, js/, assets/) from an in-memory cache
 
 Usage:
     python local_server.py
+    python local_server.py --mode threaded --threads 16
+    python local_server.py --mode prefork --workers 4 --threads 8
 """
+import argparse
+import gzip
+import hashlib
 import http.server
-import socketserver
 import json
+import mimetypes
 import os
+import signal
+import socket
 import sys
-from http.server import BaseHTTPRequestHandler
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 
 # Load environment variables from .env file
 try:
@@ -23,8 +34,207 @@ except ImportError:
 
 PORT = 3001
 
-class ChatHandler(http.server.BaseHTTPRequestHandler):
-    """HTTP handler that wraps the Vercel chat function"""
+# Serving defaults: threads per process and processes in prefork mode
+DEFAULT_THREADS = 8
+DEFAULT_WORKERS = os.cpu_count() or 2
+
+# Persist the answer cache so it survives restarts of this server
+os.environ.setdefault('CHAT_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'answer-cache.json'))
+# Conversation sessions are written through to SQLite, so prefork workers share them
+os.environ.setdefault('CHAT_SESSION_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'sessions.sqlite3'))
+# Clients connect directly, so X-Forwarded-For cannot be trusted for rate limits
+os.environ.setdefault('CHAT_TRUST_PROXY', '0')
+# Each server process warms up explicitly once it is ready to serve (after fork in prefork mode)
+os.environ.setdefault('CHAT_STARTUP_MODE', 'lazy')
+
+# Brotli is optional; without it the site is precompressed with gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Site files served next to the API; nothing else in the repository is exposed
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_ENTRIES = ('index.html', 'resume.html', 'manifest.json', 'robots.txt', 'sitemap.xml', 'css', 'js', 'assets')
+# Files up to this size are kept in memory; larger ones are sent with sendfile()
+STATIC_MEMORY_MAX = 256 * 1024
+# Text-like types that get gzip/brotli variants at startup
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/manifest+json',
+                      'application/xml', 'image/svg+xml')
+# Requested as ?v=<fingerprint>, a URL always names the same bytes and may be cached for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Plain URLs are revalidated on every use (a 304 when unchanged); js/sw.js keeps the offline copy
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+mimetypes.add_type('image/svg+xml', '.svg')
+
+# The chat pipeline and its HTTP transport live in api/, shared with the Vercel function
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+from chat import ChatHTTPMixin  # noqa: E402
+from _memprofile import memory_profiler  # noqa: E402
+from _metrics import metrics  # noqa: E402
+from _service import get_chat_service  # noqa: E402
+
+
+class StaticFile:
+    """One site file: its metadata, fingerprint and in-memory variants"""
+    
+    def __init__(self, path, stat):
+        self.path = path
+        self.stat_key = (stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+        self.last_modified = formatdate(int(stat.st_mtime), usegmt=True)
+        self.mtime = int(stat.st_mtime)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.compressible = content_type.startswith(COMPRESSIBLE_TYPES)
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        
+        # Small and compressible files live in memory; the rest are hashed in blocks
+        digest = hashlib.sha256()
+        self.data = None
+        with open(path, 'rb') as f:
+            if self.compressible or self.size <= STATIC_MEMORY_MAX:
+                self.data = f.read()
+                digest.update(self.data)
+            else:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+        self.fingerprint = digest.hexdigest()[:16]
+        
+        # encoding -> compressed bytes, kept only when smaller than the original
+        self.variants = {}
+        if self.compressible and self.data:
+            candidates = {'gzip': gzip.compress(self.data, 9, mtime=0)}
+            if brotli is not None:
+                candidates['br'] = brotli.compress(self.data, quality=11)
+            for encoding, body in candidates.items():
+                if len(body) < len(self.data):
+                    self.variants[encoding] = body
+    
+    def etag(self, encoding=None):
+        """Strong ETag of one representation; each encoding has its own"""
+        return f'"{self.fingerprint}-{encoding}"' if encoding else f'"{self.fingerprint}"'
+
+
+class StaticSite:
+    """In-memory cache of the site files, reloaded when a file changes on disk"""
+    
+    def __init__(self, root=STATIC_ROOT, entries=STATIC_ENTRIES):
+        self.root = os.path.realpath(root)
+        self.entries = entries
+        self.files = {}  # URL path -> StaticFile
+        self._lock = threading.Lock()
+        for entry in entries:
+            top = os.path.join(self.root, entry)
+            if os.path.isfile(top):
+                self._load('/' + entry)
+            for directory, _, names in os.walk(top):
+                for name in names:
+                    relative = os.path.relpath(os.path.join(directory, name), self.root)
+                    self._load('/' + relative.replace(os.sep, '/'))
+    
+    def _resolve(self, url_path):
+        """Filesystem path for a URL path, or None if it is outside the served entries"""
+        parts = [p for p in url_path.split('/') if p]
+        if not parts or parts[0] not in self.entries or any(p in ('.', '..') for p in parts):
+            return None
+        path = os.path.realpath(os.path.join(self.root, *parts))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+    
+    def _load(self, url_path):
+        path = self._resolve(url_path)
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        if stat is None or not os.path.isfile(path) or os.path.basename(path).startswith('.'):
+            self.files.pop(url_path, None)
+            return None
+        static_file = self.files[url_path] = StaticFile(path, stat)
+        return static_file
+    
+    def get(self, url_path):
+        """The StaticFile for a URL path, or None; one stat() checks it is current"""
+        if url_path.endswith('/'):
+            url_path += 'index.html'
+        static_file = self.files.get(url_path)
+        if static_file is not None:
+            try:
+                stat = os.stat(static_file.path)
+                if (stat.st_mtime_ns, stat.st_size) == static_file.stat_key:
+                    return static_file
+            except OSError:
+                pass
+        with self._lock:
+            return self._load(url_path)
+    
+    def stats(self):
+        files = list(self.files.values())
+        return {
+            'files': len(files),
+            'memory_bytes': sum(len(f.data or b'') + sum(map(len, f.variants.values())) for f in files),
+            'precompressed': sum(1 for f in files if f.variants),
+            'sendfile': sum(1 for f in files if f.data is None)
+        }
+
+
+def accepted_encodings(header):
+    """Content codings a client accepts (q > 0), from its Accept-Encoding header"""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def parse_range(header, size):
+    """(start, end) of a single byte range, 'unsatisfiable', or None to send the whole file"""
+    if not header.startswith('bytes=') or ',' in header:
+        return None  # Multiple ranges: the full body is a valid answer
+    start, _, end = header[6:].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return 'unsatisfiable'
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if end < start:
+        return None  # Invalid range: RFC 9110 says to ignore the header
+    if start >= size:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+
+def etag_matches(header, etag):
+    """If-None-Match comparison (weak, as RFC 9110 asks for it)"""
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+class ChatHandler(ChatHTTPMixin, http.server.BaseHTTPRequestHandler):
+    """HTTP handler that serves the chat API through the process-wide ChatService"""
+    
+    def get_chat_service(self):
+        """The ChatService created when this server process started"""
+        return self.server.chat_service
     
     def do_GET(self):
         """Handle GET requests - return API info"""
@@ -33,11 +243,23 @@ class ChatHandler(http.server.BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({
-                'message': 'Chatbot API is running',
-                'endpoint': '/api/chat',
-                'methods': ['POST', 'OPTIONS', 'GET']
-            }).encode('utf-8'))
+            # Same diagnostics as the Vercel function: caches, sessions, upstream, latency
+            response = self.get_chat_service().diagnostics()
+            response['message'] = 'Chatbot API is running'
+            response['endpoint'] = '/api/chat'
+            response['methods'] = ['POST', 'OPTIONS', 'GET']
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+        elif self.path == '/metrics':
+            # Prometheus scrape target; in prefork mode each worker reports its own numbers
+            body = metrics.render_prometheus(memory_profiler.gauges()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.server.static_site is not None:
+            # The site itself, from the in-memory file cache
+            self.send_static()
         elif self.path == '/' or self.path == '':
             # Root path - show helpful message
             self.send_response(200)
@@ -70,6 +292,94 @@ class ChatHandler(http.server.BaseHTTPRequestHandler):
         else:
             self.send_error(404, "Not Found")
     
+    def do_HEAD(self):
+        """Handle HEAD requests for site files"""
+        if self.server.static_site is None:
+            self.send_error(404, "Not Found")
+            return
+        self.send_static(head=True)
+    
+    def send_static(self, head=False):
+        """Serve a site file: precompressed variants, conditional GETs and byte ranges"""
+        url = urllib.parse.urlsplit(self.path)
+        static_file = self.server.static_site.get(urllib.parse.unquote(url.path) or '/')
+        if static_file is None:
+            self.send_error(404, "Not Found")
+            return
+        
+        # Only a URL that names the current fingerprint may be cached for good
+        version = urllib.parse.parse_qs(url.query).get('v', [None])[0]
+        cache_control = IMMUTABLE_CACHE_CONTROL if version == static_file.fingerprint else REVALIDATE_CACHE_CONTROL
+        
+        # Byte ranges are served from the identity representation
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if range_header:
+            if_range = self.headers.get('If-Range')
+            if not if_range or if_range.strip() in (static_file.etag(), static_file.last_modified):
+                byte_range = parse_range(range_header, static_file.size)
+        encoding = None
+        if byte_range is None:
+            accepted = accepted_encodings(self.headers.get('Accept-Encoding', ''))
+            encoding = next((e for e in ('br', 'gzip') if e in static_file.variants and e in accepted), None)
+        etag = static_file.etag(encoding)
+        
+        def common_headers():
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', static_file.last_modified)
+            self.send_header('Cache-Control', cache_control)
+            if static_file.variants:
+                self.send_header('Vary', 'Accept-Encoding')
+        
+        # Conditional GET: If-None-Match wins over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, etag)
+        elif self.headers.get('If-Modified-Since'):
+            try:
+                not_modified = static_file.mtime <= parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp()
+            except (TypeError, ValueError):
+                pass
+        if not_modified:
+            self.send_response(304)
+            common_headers()
+            self.end_headers()
+            return
+        
+        if byte_range == 'unsatisfiable':
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{static_file.size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        start, end = byte_range or (0, static_file.size - 1)
+        body = static_file.variants[encoding] if encoding else static_file.data
+        length = len(body) if encoding else end - start + 1
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', static_file.content_type)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{static_file.size}')
+        common_headers()
+        self.end_headers()
+        if head or length <= 0:
+            return
+        
+        try:
+            if body is not None:
+                self.wfile.write(memoryview(body)[start:end + 1] if not encoding else body)
+            else:
+                # Large file: the kernel copies it straight from the page cache to the socket
+                with open(static_file.path, 'rb') as f:
+                    self.connection.sendfile(f, start, length)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
@@ -80,81 +390,198 @@ class ChatHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
     
     def do_POST(self):
-        """Handle POST requests to /api/chat"""
+        """Handle POST requests to /api/chat and /api/chat/batch"""
+        if self.path in ('/api/chat/batch', '/api/chat/batch/'):
+            self.handle_batch_post()
+            return
         if self.path != '/api/chat' and self.path != '/api/chat/':
             self.send_error(404, "Not Found")
             return
         
-        try:
-            # Import the Vercel handler class
-            sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'api'))
-            from chat import handler as ChatHandlerClass
-            
-            # Create a simple wrapper that mimics BaseHTTPRequestHandler
-            # We'll directly use the handler's methods by creating a minimal instance
-            class SimpleHandler(ChatHandlerClass):
-                def __init__(self, real_handler):
-                    # Don't call parent __init__ - just copy what we need
-                    self.rfile = real_handler.rfile
-                    self.wfile = real_handler.wfile
-                    self.headers = real_handler.headers
-                    self.command = real_handler.command
-                    self.path = real_handler.path
-                    self.request_version = real_handler.request_version
-                    self.close_connection = real_handler.close_connection
-                    self.requestline = real_handler.requestline
-                    self.client_address = real_handler.client_address
-                    self.server = real_handler.server
-                    self.request = real_handler.request
-            
-            # Create wrapper instance
-            wrapper = SimpleHandler(self)
-            
-            # Call the POST handler
-            wrapper.do_POST()
-            
-        except Exception as e:
-            print(f"❌ Error handling request: {e}")
-            import traceback
-            traceback.print_exc()
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({
-                'error': 'Internal Server Error',
-                'message': str(e)
-            }).encode('utf-8'))
+        self.handle_chat_post()
     
     def log_message(self, format, *args):
         """Override to prevent default logging"""
         pass
 
+
+class ThreadPoolHTTPServer(http.server.HTTPServer):
+    """HTTP server that hands each connection to a bounded pool of worker threads"""
+    
+    allow_reuse_address = True
+    
+    def __init__(self, server_address, handler_class, chat_service, threads=DEFAULT_THREADS, reuse_port=False,
+                 static_site=None):
+        self.chat_service = chat_service
+        self.static_site = static_site
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='chat-worker')
+        # Connections accepted but not finished; when full, accept() waits
+        # instead of queueing unbounded work behind slow OpenAI calls
+        self._slots = threading.BoundedSemaphore(threads * 2)
+    
+    def server_bind(self):
+        """Bind with SO_REUSEPORT so several processes can share the port"""
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def process_request(self, request, client_address):
+        """Queue the connection on the worker pool"""
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._process, request, client_address)
+        except RuntimeError:
+            # Pool already shut down - drop the connection
+            self._slots.release()
+            self.shutdown_request(request)
+    
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+    
+    def server_close(self):
+        """Stop accepting, then let in-flight requests finish"""
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
+def install_shutdown_handlers(httpd):
+    """Stop serve_forever on SIGINT/SIGTERM without killing in-flight requests"""
+    def request_shutdown(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off the main thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+
+def serve(port, threads, reuse_port=False, label='Server', static_site=None):
+    """Run one warm, threaded server process until it is asked to stop"""
+    # One ChatService per process: warm index, client and caches shared by every thread
+    chat_service = get_chat_service()
+    chat_service.warm_up()
+    # Knowledge base edits are picked up in the background (CHAT_KB_WATCH_INTERVAL=0 turns this off)
+    chat_service.watch_knowledge_base()
+    # RSS growth is measured from here; tracing (CHAT_MEMPROFILE=1) starts here too
+    memory_profiler.start()
+    httpd = ThreadPoolHTTPServer(("", port), ChatHandler, chat_service, threads=threads, reuse_port=reuse_port,
+                                 static_site=static_site)
+    install_shutdown_handlers(httpd)
+    print(f"{label} (pid {os.getpid()}) ready with {threads} threads")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if chat_service.kb_watcher is not None:
+            chat_service.kb_watcher.stop()
+        chat_service.answer_cache.flush()
+    print(f"{label} (pid {os.getpid()}) stopped.")
+
+
+def serve_prefork(port, workers, threads, static_site=None):
+    """Fork worker processes that share the listening port via SO_REUSEPORT"""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("Prefork mode needs fork() and SO_REUSEPORT (Linux/macOS). Use --mode threaded.")
+    
+    children = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Each worker warms up its own service: clients and locks must not cross fork()
+            exit_code = 0
+            try:
+                serve(port, threads, reuse_port=True, label=f"Worker {worker_id}", static_site=static_site)
+            except OSError as e:
+                print(f"Worker {worker_id} failed to start: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children.append(pid)
+    
+    def forward_signal(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    # Ctrl+C reaches the whole process group; SIGTERM to the parent is forwarded
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, forward_signal)
+    for child in children:
+        while True:
+            try:
+                os.waitpid(child, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+    print("\n\nServer stopped.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local development server for the chatbot API")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--mode', choices=['threaded', 'prefork'], default='threaded',
+                        help="threaded: one process with a thread pool; prefork: several processes")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="worker threads per process")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="processes in prefork mode")
+    parser.add_argument('--no-static', action='store_true',
+                        help="serve only the API, not the site files")
+    return parser.parse_args(argv)
+
+
 def main():
     """Start the local development server"""
+    args = parse_args()
+    port = args.port
     print(f"\n{'='*60}")
     print("Chatbot Local Development Server")
     print(f"{'='*60}")
-    print(f"\nStarting server on http://localhost:{PORT}")
-    print(f"API endpoint: http://localhost:{PORT}/api/chat")
+    print(f"\nStarting server on http://localhost:{port}")
+    print(f"API endpoint: http://localhost:{port}/api/chat")
+    print(f"Batch endpoint: http://localhost:{port}/api/chat/batch")
+    print(f"Metrics: http://localhost:{port}/metrics")
+    # Loaded before forking, so prefork workers share the cached files
+    static_site = None if args.no_static else StaticSite()
+    if static_site is not None:
+        stats = static_site.stats()
+        print(f"Site: http://localhost:{port}/ ({stats['files']} files, {stats['memory_bytes'] // 1024} KB cached, "
+              f"{stats['precompressed']} precompressed{'' if brotli else ' with gzip only'})")
+    if args.mode == 'prefork':
+        print(f"Mode: prefork ({args.workers} processes x {args.threads} threads)")
+    else:
+        print(f"Mode: threaded ({args.threads} threads)")
     print(f"\nMake sure to:")
     print(f"  1. Create a .env file with your OPENAI_API_KEY")
-    print(f"  2. Update js/chatbot.js to use: const API_ENDPOINT = 'http://localhost:{PORT}/api/chat';")
+    print(f"  2. Update js/chatbot.js to use: const API_ENDPOINT = 'http://localhost:{port}/api/chat';")
     print(f"\nPress Ctrl+C to stop the server\n")
     print(f"{'='*60}\n")
     
     try:
-        with socketserver.TCPServer(("", PORT), ChatHandler) as httpd:
-            httpd.serve_forever()
+        if args.mode == 'prefork':
+            serve_prefork(port, args.workers, args.threads, static_site)
+        else:
+            serve(port, args.threads, static_site=static_site)
     except KeyboardInterrupt:
         print("\n\nServer stopped.")
     except OSError as e:
         if e.errno == 98 or "Address already in use" in str(e):
-            print(f"\nError: Port {PORT} is already in use.")
-            print(f"Either stop the other process or change PORT in local_server.py")
+            print(f"\nError: Port {port} is already in use.")
+            print(f"Either stop the other process or use --port to pick another one")
         else:
             raise
 
+
 if __name__ == '__main__':
     main()
-